@@ -5,5 +5,9 @@
 from process_demux_proto_tests import process_demux_proto_tests
 
 dirname = ''
+# During a test campaign only the files added since the last run are processed
+incremental = False
 
-process_demux_proto_tests(dirname, verbose=True)
+# The guard is needed because the processing uses pools of processes
+if __name__ == "__main__":
+    process_demux_proto_tests(dirname, verbose=True, incremental=incremental)
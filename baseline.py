@@ -1,4 +1,4 @@
-import get_data, general_tools
+import get_data, general_tools, session_index, plot_tools, results_store
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -20,11 +20,8 @@ def check_baseline(fulldirname, config):
 
     pltfilename = os.path.join(plotdirname, "PLOT_BASELINE")
 
-    i_test_deb, i_test_fin = 21, 40
     test = "IQ-ALL_Science-Data"
-    fichlist = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-4:]=='.dat' and f[i_test_deb:i_test_fin]==test]
+    fichlist = session_index.get_files(datadirname, ext='.dat', test_prefix=test)
 
     # -----------------------------------------------------------------------
     # Processing baseline 
@@ -41,43 +38,74 @@ def check_baseline(fulldirname, config):
         pix_on = general_tools.non_empty_lines(mod)
 
         t = np.arange(l)/(config['fs']/2**config['power_to_fs2'])
-        n_boxes=npix
-        n_lines=6
-        n_cols=7
-
-        fig = plt.figure(figsize=(18, 12))
-        for box in range(n_boxes):
-            if pix_on[box]:
-                marge = 0.5
-                ymax = mod[:,box].max() + (mod[:,box].max() - mod[:,box].min())*marge
-                ymin = mod[:,box].min() - (mod[:,box].max() - mod[:,box].min())*marge
-                ax = fig.add_subplot(n_lines, n_cols, box+1)
-                ax.plot(t, mod[:,box])
-                ax.set_ylim([ymin, ymax])
-                ax.set_title(r'Pixel {0:2d}'.format(box))
-                plt.gca().get_yaxis().get_major_formatter().set_useOffset(False)
-                ratio = 100/2**15
-                ax2 = plt.gca().twinx()
-                ax2.set_ylim([ymin*ratio, ymax*ratio])
-                plt.gca().get_yaxis().get_major_formatter().set_useOffset(False)
-                if box//n_cols == n_lines-1:
-                    ax.set_xlabel(r'Time (s)')
-                else:
-                    plt.xticks(visible=False)
-                if box%n_cols == 0:
-                    ax.set_ylabel(r'Module (A.U.)')
-                if box%n_cols == n_cols-1:
-                    ax2.set_ylabel(r'Module (% of FSR)')
-
-                for item in ([ax.title, ax.xaxis.label, ax.yaxis.label, ax2.yaxis.label]):
-                    item.set_fontsize(10)
-                    item.set_weight('bold')
-                for item in (ax.get_xticklabels() + ax.get_yticklabels() + ax2.get_yticklabels()):
-                    item.set_fontsize(8)
-                for item in (ax.get_yticklabels() + ax2.get_yticklabels()):
-                    item.set_rotation(45)
-
-        fig.tight_layout()
-        plt.savefig(pltfilename+'_40pix.png', bbox_inches='tight')
+        plot_tools.submit(plot_baseline, t, mod, pix_on, pltfilename)
+
+        items = ['pix{0:02d}'.format(pix) for pix in np.where(pix_on)[0]]
+        results_store.record(fulldirname, config, 'check_baseline', \
+            results_store.make_records('baseline_mean', mod[:, pix_on].mean(axis=0), 'ADU', items) \
+            + results_store.make_records('baseline_std', mod[:, pix_on].std(axis=0), 'ADU', items))
+
+# ---------------------------------------------------------------------------
+def plot_baseline(t, mod, pix_on, pltfilename):
+    r"""
+        This function plots the mosaic of the modulus of the pixels.
+
+        Parameters
+        ----------
+        t : array
+        Time (s)
+
+        mod : 2-dimensional array
+        Modulus of the pixels (one column per pixel)
+
+        pix_on : array_like
+        booleans (indicates which pixels are on)
+
+        pltfilename : string
+        Used to specify the plot file name.
+
+        Returns
+        -------
+        Nothing
+
+        """
+    n_boxes=len(mod[0,:])
+    n_lines=6
+    n_cols=7
+
+    fig = plt.figure(figsize=(18, 12))
+    for box in range(n_boxes):
+        if pix_on[box]:
+            marge = 0.5
+            ymax = mod[:,box].max() + (mod[:,box].max() - mod[:,box].min())*marge
+            ymin = mod[:,box].min() - (mod[:,box].max() - mod[:,box].min())*marge
+            ax = fig.add_subplot(n_lines, n_cols, box+1)
+            plot_tools.plot_envelope(ax, t, mod[:,box])
+            ax.set_ylim([ymin, ymax])
+            ax.set_title(r'Pixel {0:2d}'.format(box))
+            plt.gca().get_yaxis().get_major_formatter().set_useOffset(False)
+            ratio = 100/2**15
+            ax2 = plt.gca().twinx()
+            ax2.set_ylim([ymin*ratio, ymax*ratio])
+            plt.gca().get_yaxis().get_major_formatter().set_useOffset(False)
+            if box//n_cols == n_lines-1:
+                ax.set_xlabel(r'Time (s)')
+            else:
+                plt.xticks(visible=False)
+            if box%n_cols == 0:
+                ax.set_ylabel(r'Module (A.U.)')
+            if box%n_cols == n_cols-1:
+                ax2.set_ylabel(r'Module (% of FSR)')
+
+            for item in ([ax.title, ax.xaxis.label, ax.yaxis.label, ax2.yaxis.label]):
+                item.set_fontsize(10)
+                item.set_weight('bold')
+            for item in (ax.get_xticklabels() + ax.get_yticklabels() + ax2.get_yticklabels()):
+                item.set_fontsize(8)
+            for item in (ax.get_yticklabels() + ax2.get_yticklabels()):
+                item.set_rotation(45)
+
+    fig.tight_layout()
+    plt.savefig(pltfilename+'_40pix.png', bbox_inches='tight')
 
 # ---------------------------------------------------------------------------
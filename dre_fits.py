@@ -37,19 +37,28 @@ def read_fits(filename, verbose=False):
     ftype=header['FILETYPE']
 
     if verbose:
-        print("  Informations of FITS file:")
-        print("    Date:      ", header['DATE'])
-        print("    Origin:    ", header['ORIGIN'])
-        print("    Project:   ", header['INSTRUME'])
-        print("    File type: ", ftype)
+        print_fits_info(header)
 
     return(ftype, header, data)
 
 # -----------------------------------------------------------------------------
-def read_iq(filename, verbose=False):
+def print_fits_info(header):
+    r"""
+        This function prints the informations of the header of a DRE fits file.
+        """
+    print("  Informations of FITS file:")
+    print("    Date:      ", header['DATE'])
+    print("    Origin:    ", header['ORIGIN'])
+    print("    Project:   ", header['INSTRUME'])
+    print("    File type: ", header['FILETYPE'])
+
+# -----------------------------------------------------------------------------
+def read_iq(filename, verbose=False, pixels=None, start=0, stop=None, dtype='float'):
     r"""
         This function reads IQ data from a DRE fits file.
         (this corresponds to standard observation data)
+        The file is memory mapped and only the samples of the requested
+        pixels are read.
 
         Parameters
         ----------
@@ -59,27 +68,54 @@ def read_iq(filename, verbose=False):
         verbose : boolean
         If True informations are written by the routine (default=False)
 
+        pixels : list of integers
+        The pixels to be read (default=None, all the pixels). Negative
+        values are counted from the end (-1 is the test pixel).
+
+        start, stop : integers
+        The range of samples to be read (default=0, None: all the samples)
+
+        dtype : data type
+        The type of the returned values (default='float'). If None the
+        type of the values in the file is kept (integers).
+
         Returns
         -------
-        i, q : array type of floats
-        contains the values of the I and Q science data.
+        i, q : array type
+        contains the values of the I and Q science data (one column per
+        requested pixel, the columns of inactive pixels are null).
                     
         """
-    ftype, header, data = read_fits(filename, verbose)
-
-    if ftype != 'IQ':
-        raise ValueError('Wrong file type!')
+    if pixels is None:
+        pixels = range(params.npix)
+    # negative indexes are counted from the last pixel (test pixel)
+    pixels = [pix % params.npix for pix in pixels]
 
-    nval=len(data['timestamp'][0])
-    
-    i=np.zeros((nval, params.npix))
-    q=np.zeros((nval, params.npix))
-    for pix in range(params.npix):
-        if header['PIXEL_{0:d}'.format(pix)]==1:  # pixel is active
-            i[:,pix]=data['I{0:d}'.format(pix)][0]
-            q[:,pix]=data['Q{0:d}'.format(pix)][0]
-
-    return(i.astype('float'), q.astype('float'))
+    print("Reading data from fits file...")
+    with fits.open(filename, memmap=True) as hdul:
+        header=hdul[1].header
+        if verbose:
+            print_fits_info(header)
+        if header['FILETYPE'] != 'IQ':
+            raise ValueError('Wrong file type!')
+
+        data=hdul[1].data
+        nval=hdul[1].columns['I0'].format.repeat
+        first, last, _ = slice(start, stop).indices(nval)
+        last=max(first, last)
+
+        if dtype is None:
+            # integer type of the file (in the byte order of the machine)
+            dtype=data.field('I0').dtype.newbyteorder('=')
+        i=np.zeros((last-first, len(pixels)), dtype=dtype)
+        q=np.zeros((last-first, len(pixels)), dtype=dtype)
+        for k, pix in enumerate(pixels):
+            if header['PIXEL_{0:d}'.format(pix)]==1:  # pixel is active
+                # only the requested samples of the column are decoded
+                i[:,k]=data.field('I{0:d}'.format(pix))[0][first:last]
+                q[:,k]=data.field('Q{0:d}'.format(pix))[0][first:last]
+
+    return(i, q)
 
 # -----------------------------------------------------------------------------
 def read_dump(filename, checktype='NO-CHECK', verbose=False):
@@ -115,7 +151,7 @@ def read_dump(filename, checktype='NO-CHECK', verbose=False):
     return(data['Field1'][0].astype('float'), data['Field2'][0].astype('float'), ftype)
 
 # -----------------------------------------------------------------------------
-def read_records(filename, verbose=False):
+def read_records(filename, verbose=False, channels=None, pixels=None, start=0, stop=None, dtype='float'):
     r"""
         This function reads sample records from a fits file.
 
@@ -127,28 +163,116 @@ def read_records(filename, verbose=False):
         verbose: boolean
         If True informations are written by the routine (default=False)
 
+        channels, pixels, start, stop, dtype:
+        Selection of the records and of the samples (see iter_records)
+
         Returns
         -------
         Returns: arrays containing the channel id, the pixel id, the records of module, the time stamp
     """
+    # all the selected records in a single batch
+    return(next(iter_records(filename, None, channels, pixels, start, stop, dtype, verbose)))
 
-    hdul = fits.open(filename)
-    data=hdul[1].data
-    t=data['Timestamp']
-    chid=data['channelNum']
-    pixid=data['pixelNum']
-    i=data['i'].astype("float")
-    q=data['q'].astype("float")
-    module=np.sqrt(i**2+q**2)
-    if verbose:
-        print("  Informations of FITS file:")
-        print("    Date:    ", hdul[1].header['DATE'])
-        print("    Origin:  ", hdul[1].header['ORIGIN'])
-        print("    Project: ", hdul[1].header['INSTRUME'])
-        print("    Number of records: ", len(i))
-        print("    Length of records: ", int(len(i[0])))
-    
-    return(chid, pixid, module, t)
+# -----------------------------------------------------------------------------
+def print_records_info(hdu):
+    r"""
+        This function prints the informations of a table of sample records.
+    """
+    print("  Informations of FITS file:")
+    print("    Date:    ", hdu.header['DATE'])
+    print("    Origin:  ", hdu.header['ORIGIN'])
+    print("    Project: ", hdu.header['INSTRUME'])
+    print("    Number of records: ", hdu.header['NAXIS2'])
+    print("    Length of records: ", hdu.columns['i'].format.repeat)
+
+# -----------------------------------------------------------------------------
+def get_records_shape(filename, verbose=False):
+    r"""
+        This function returns the number and the length of the sample
+        records of a fits file (the data are not read).
+
+        Parameters:
+        ----------
+        filename: string
+        The name of the fits file (with the path and the extension)
+
+        verbose: boolean
+        If True informations are written by the routine (default=False)
+
+        Returns
+        -------
+        nb_records, record_length: integers
+    """
+    with fits.open(filename, memmap=True) as hdul:
+        if verbose:
+            print_records_info(hdul[1])
+        return(hdul[1].header['NAXIS2'], hdul[1].columns['i'].format.repeat)
+
+# -----------------------------------------------------------------------------
+def iter_records(filename, batch_size=1024, channels=None, pixels=None, start=0, stop=None, dtype='float', \
+                 verbose=False):
+    r"""
+        This function reads sample records from a fits file by batches
+        (generator). The file is memory mapped, only the records of a batch
+        are decoded, so that the memory needed does not depend on the size
+        of the file.
+
+        Parameters:
+        ----------
+        filename: string
+        The name of the fits file (with the path and the extension)
+
+        batch_size: integer
+        Number of records of a batch (default=1024). If None all the
+        selected records are returned in a single batch.
+
+        channels, pixels: lists of integers
+        Only the records of these channels and pixels are read
+        (default=None, no selection)
+
+        start, stop: integers
+        Range of the samples of the records to be read (default=0, None:
+        all the samples)
+
+        dtype: data type
+        Type used to compute the module (default='float', 'float32' halves
+        the memory needed)
+
+        verbose: boolean
+        If True informations are written by the routine (default=False)
+
+        Yields
+        -------
+        Arrays containing the channel id, the pixel id, the records of module,
+        the time stamp of a batch of records
+    """
+    with fits.open(filename, memmap=True) as hdul:
+        data=hdul[1].data
+        chid=np.asarray(data['channelNum'])
+        pixid=np.asarray(data['pixelNum'])
+        if verbose:
+            print_records_info(hdul[1])
+
+        selection=np.ones(len(chid), dtype=bool)
+        if channels is not None:
+            selection&=np.isin(chid, channels)
+        if pixels is not None:
+            selection&=np.isin(pixid, pixels)
+        rows=np.where(selection)[0]
+
+        # views on the memory mapped columns (nothing is read here)
+        i_col=data.field('i')
+        q_col=data.field('q')
+        t_col=data.field('Timestamp')
+        if batch_size is None:
+            batch_size=max(1, len(rows))
+        # at least one batch (empty if no record is selected)
+        for first in range(0, max(1, len(rows)), batch_size):
+            batch=rows[first:first+batch_size]
+            i=i_col[batch, start:stop].astype(dtype)
+            q=q_col[batch, start:stop].astype(dtype)
+            module=np.sqrt(i**2+q**2)
+            yield(chid[batch], pixid[batch], module, t_col[batch])
 
 # -----------------------------------------------------------------------------
 
@@ -1,25 +1,50 @@
 import numpy as np
-from numpy.fft import rfft
+from numpy.fft import rfft, irfft
+from scipy.signal import get_window
 import os
 import matplotlib.pyplot as plt
-import get_data, general_tools
+from concurrent.futures import ProcessPoolExecutor
+import get_data, general_tools, session_index, plot_tools, results_store
 
 
 # -----------------------------------------------------------------------------
-def analyse_dump(sig, nb, config):
+def analyse_dump(sig, nb, config, cachedirname=None, cachekey=None):
 
     print("------------------------------------")
     sigfdb = np.array([])  
     f_carriers = np.array([])  
     io_str=""
+    measures={}
     if abs(sig).max()==0:
         print("Data stream is empty!")
     else:
-        sigfdb, f_carriers, _, io_str = makeanalysis(sig, nb, config)
-    return(sigfdb, f_carriers, io_str)
+        sigfdb, f_carriers, _, io_str, measures = makeanalysis(sig, nb, config, cachedirname, cachekey)
+    return(sigfdb, f_carriers, io_str, measures)
+
+# -----------------------------------------------------------------------------
+def dump_records(stream, measures):
+    r"""
+        This function converts the measurements done on a data stream (see
+        makeanalysis) to records of the results store. The measurements done
+        around each carrier are recorded with the items <stream>:<carrier>
+        and their mean values with the item <stream>.
+        """
+    units = {'peakpeak': 'ADU', 'crest_factor': '', 'carrier_frequency': 'Hz', \
+             'noise_db': 'dBFS', 'snr_db': 'dB', 'spur_dbc': 'dBc'}
+    records = []
+    for metric in measures.keys():
+        values = measures[metric]
+        if np.ndim(values) == 0:
+            records.append((metric, stream, float(values), units[metric]))
+        elif len(values) > 0:
+            items = ['{0:s}:{1:02d}'.format(stream, i) for i in range(len(values))]
+            records += results_store.make_records(metric, values, units[metric], items)
+            if metric in ('noise_db', 'spur_dbc'):
+                records.append(('mean_'+metric, stream, float(np.mean(values)), units[metric]))
+    return(records)
  
 # -----------------------------------------------------------------------------
-def process_dump(fulldirname, config, max_duration=0.2, pix_id=0):
+def process_dump(fulldirname, config, max_duration=0.2, pix_id=0, use_cache=True):
     r"""
         This function reads and process the data of DRE-DEMUX data dumps.
 
@@ -37,6 +62,10 @@ def process_dump(fulldirname, config, max_duration=0.2, pix_id=0):
         pix_id : number
         AC-carrier position for the zoom.
 
+        use_cache : boolean
+        If True the spectra are saved in (or read from) the spectra cache
+        of the session LOGS directory (default is True).
+
         Returns
         -------
         Nothing
@@ -47,18 +76,14 @@ def process_dump(fulldirname, config, max_duration=0.2, pix_id=0):
     datadirname = os.path.join(fulldirname, config['dir_data'])
     plotdirname = os.path.join(fulldirname, config['dir_plots'])
     general_tools.checkdir(plotdirname)
+    logdirname = os.path.join(fulldirname, config['dir_logs'])
 
     nbc, name_c = 16, "BIAS" # INPUT signal over 12 bits
     nbb, name_b = 16, "FBCK" # FEEDBACK signal over 16 bits
     nba, name_a = 12, "INPT" # BIAS signal over 16 bits
 
-    f_type_deb = 21
-    dumpfilenames1 = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[f_type_deb:]=="IN-BIA.dat"]
-    dumpfilenames2 = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[f_type_deb:]=="IN-FBK.dat"]
+    dumpfilenames1 = session_index.get_files(datadirname, ext='.dat', test="IN-BIA")
+    dumpfilenames2 = session_index.get_files(datadirname, ext='.dat', test="IN-FBK")
 
     if len(dumpfilenames1)>0 and len(dumpfilenames2)>0:
         dumpfilename1 = os.path.join(datadirname, dumpfilenames1[0])
@@ -129,9 +154,20 @@ def process_dump(fulldirname, config, max_duration=0.2, pix_id=0):
         plot_str = ', Number of samples--> {0:8d},   Dump duration--> {1:6.2f} s,   Resolution BW--> {2:8.2f} Hz\n' \
         .format(nval, nval / fs, fs / nval)
 
+        # Keys of the spectra in the cache (one per data stream)
+        cachedirname, key_c, key_a, key_b = None, None, None, None
+        if use_cache:
+            cachedirname = logdirname
+            params = {'nval': nval, 'fs': fs, 'ScBandMin': config['ScBandMin'], 'ScBandMax': config['ScBandMax']}
+            key_c = general_tools.get_cache_key([dumpfilename1], dict(params, stream=name_c, nb=nbc))
+            key_a = general_tools.get_cache_key([dumpfilename1], dict(params, stream=name_a, nb=nba))
+            key_b = general_tools.get_cache_key([dumpfilename2], dict(params, stream=name_b, nb=nbb))
+
         ###########################################################################
         print("Processing datastream of BIAS signal...")
-        cfdb, f_carriers, io_str = analyse_dump(c, nbc, config)
+        records = []
+        cfdb, f_carriers, io_str, measures = analyse_dump(c, nbc, config, cachedirname, key_c)
+        records += dump_records(name_c, measures)
         if (len(cfdb)>0):
             plot_dump(c, nbc, cfdb, f_carriers, config, "Signal "+name_c+plot_str, plotfilename_c, pix_id)
             io_str = '\
@@ -142,7 +178,8 @@ def process_dump(fulldirname, config, max_duration=0.2, pix_id=0):
             flog.write("Bias signal data stream is empty")
     
         print("Processing datastream of INPUT signal...")
-        afdb, _, io_str = analyse_dump(a, nba, config)
+        afdb, _, io_str, measures = analyse_dump(a, nba, config, cachedirname, key_a)
+        records += dump_records(name_a, measures)
         if (len(afdb)>0):
             plot_dump(a, nba, afdb, f_carriers, config, "Signal "+name_a+plot_str, plotfilename_a, pix_id)
             io_str = '\
@@ -153,7 +190,8 @@ def process_dump(fulldirname, config, max_duration=0.2, pix_id=0):
             flog.write("Input signal data stream is empty")
             
         print("Processing datastream of FEEDBACK signal...")
-        bfdb, _, io_str = analyse_dump(b, nbb, config)
+        bfdb, _, io_str, measures = analyse_dump(b, nbb, config, cachedirname, key_b)
+        records += dump_records(name_b, measures)
         if (len(bfdb)>0):
             plot_dump(b, nbb, bfdb, f_carriers, config, "Signal "+name_b+plot_str, plotfilename_b, pix_id)
             io_str = '\
@@ -164,15 +202,18 @@ def process_dump(fulldirname, config, max_duration=0.2, pix_id=0):
             flog.write("Feedback signal data stream is empty")
 
         flog.close()
+        results_store.record(fulldirname, config, 'process_dump', records)
 
     print("Done!")
     print("------------------------------------")
 
 # -----------------------------------------------------------------------------
-def makeanalysis(sig, nb, config):
+def makeanalysis(sig, nb, config, cachedirname=None, cachekey=None):
     r"""
         This function does the analysis of a signal. In time domain (measurment
         of the power) but mostly in frequency domain (fft, normalisation, ...).
+        If a cache directory and a key are given, the results are saved in
+        the spectra cache and read from it when the analysis is done again.
 
         Parameters
         ----------
@@ -185,6 +226,13 @@ def makeanalysis(sig, nb, config):
         config : dictionnary
         Contains path and constants definitions
 
+        cachedirname : string
+        The name of the cache directory (default is None, no cache)
+
+        cachekey : string
+        The key identifying the signal and the analysis parameters
+        (see general_tools.get_cache_key, default is None)
+
         Returns
         -------
         sigfdb : array_like
@@ -199,8 +247,20 @@ def makeanalysis(sig, nb, config):
         io_str : string
         The log message.
 
+        measures : dictionnary
+        The measurements (peakpeak, crest_factor and for bias and feedback
+        signals carrier_frequency, noise_db, snr_db, spur_dbc, one value per
+        carrier)
+
     """
 
+    if cachedirname is not None and cachekey is not None:
+        cache = general_tools.cache_load(cachedirname, 'SPECTRUM_DUMP', cachekey)
+        if cache is not None and 'm_crest_factor' in cache:
+            print("Spectrum read from the cache.")
+            measures = {key[2:]: cache[key] for key in cache.keys() if key.startswith('m_')}
+            return(cache['sigfdb'], cache['fcarriers'], cache['noise_power'], str(cache['io_str']), measures)
+
     nval=len(sig)
     df = float(config["fs"])/nval    # spectral resolution
 
@@ -232,6 +292,7 @@ Peak Peak amplitude--------------> {0:9.2f} \n\
 Measured crest factor------------> {1:9.2f} \n\
 Max of spectrum------------------> {2:9.2f} dB\n'\
     .format(peakpeak, cf, sigfdb.max())
+    measures = {'peakpeak': peakpeak, 'crest_factor': cf}
 
     ##### Noise power measurement around each carriers
     fcarriers=np.array([])
@@ -241,19 +302,31 @@ Max of spectrum------------------> {2:9.2f} dB\n'\
         icarriers = peakdetect(sigfdb)
         fcarriers = icarriers*df
         ncar=len(fcarriers)
+        measures['carrier_frequency'] = fcarriers
         print(" => {0:3d} carriers detected. \nCarrier frequencies (Hz):".format(ncar))
-        freq_str, power_str =  " > ",  " > "
+        freq_str, power_str, snr_str, spur_str =  " > ",  " > ", " > ", " > "
         if ncar > 0 and ncar < 80:
-            noise_power = noiseandspurpower(sigf, icarriers, df, config) - e_freq_db + e_time_db - e_fsr_db
+            table = carrier_noise_table(sigf, icarriers, df, config, offset_db=-e_freq_db+e_time_db-e_fsr_db)
+            noise_power = table['noise_db']
+            for key in ('noise_db', 'snr_db', 'spur_dbc'):
+                measures[key] = table[key]
             for carrier in range(ncar):
                 freq_str += '{0:12.2f}'.format(fcarriers[carrier])
                 power_str += '{0:12.2f}'.format(noise_power[carrier])
+                snr_str += '{0:12.2f}'.format(table['snr_db'][carrier])
+                spur_str += '{0:12.2f}'.format(table['spur_dbc'][carrier])
                 if (carrier+1) % 8 == 0:
                     freq_str += "\n > "
                     power_str += "\n > "
+                    snr_str += "\n > "
+                    spur_str += "\n > "
             print(freq_str)
             print("\nNoise power calculation... \nMeasured power (dBFS / 2 x Binfo)")
             print(power_str)
+            print("\nCarrier to noise ratio (dB / 2 x Binfo)")
+            print(snr_str)
+            print("\nStrongest spurious in the science bands (dBc)")
+            print(spur_str)
 
         io_str += 'Number of carriers detected------> {0:9d} : \n'\
         .format(ncar)
@@ -266,8 +339,15 @@ Noise power around carriers-> (dBFS / 2 x Binfo)\n\
         print("Calculation of mean noise power... (dBFS / 2 x Binfo)")
         noise_power = 10*np.log10(np.sum(sig**2)) - 10*np.log10(df*nval/2) - e_fsr_db 
         print(noise_power)
+        measures['noise_db'] = noise_power
+
+    if cachedirname is not None and cachekey is not None:
+        cache = {'sigfdb': sigfdb, 'fcarriers': fcarriers, 'noise_power': noise_power, 'io_str': io_str}
+        for key in measures.keys():
+            cache['m_'+key] = measures[key]
+        general_tools.cache_save(cachedirname, 'SPECTRUM_DUMP', cachekey, cache)
  
-    return(sigfdb, fcarriers, noise_power, io_str)
+    return(sigfdb, fcarriers, noise_power, io_str, measures)
 
 
 # -----------------------------------------------------------------------------
@@ -438,10 +518,11 @@ def plot_dump(sig, nb, sigfdb, f_car, config, io_str, plotfilename, pix_id=0):
     fig.tight_layout()
     #plt.show()
     plt.savefig(plotfilename, bbox_inches='tight')
+    plt.close()
     print('Plots done')
 
 # -----------------------------------------------------------------------------
-def spurdetect(sig, nb, margin=6):
+def spurdetect(sig, nb, margin=6, spread=1):
     r"""
         This function detects spuriouses in a 1D signal. A threshold is used
         to define the spurious level.
@@ -459,17 +540,28 @@ def spurdetect(sig, nb, margin=6):
         The minimum spurious level. 
         (default is 6).
 
+        spread : number
+        Distance (in bins) of the neighbours used to measure the spurious level.
+        It shall be greater than 1 when the spectrum has been computed with
+        a window which spreads the spuriouses over several bins (default is 1).
+
         Returns
         -------
         detected_spurious_indexes : array_like
         Indexes of detected spurious according to the input array
         """
 
-    delta1 = sig - np.concatenate((sig[1:], [sig[-1]]))
-    delta2 = sig - np.concatenate(([sig[0]], sig[:-1]))
+    delta1 = sig - np.concatenate((sig[spread:], [sig[-1]]*spread))
+    delta2 = sig - np.concatenate(([sig[0]]*spread, sig[:-spread]))
 
     i_spurs=np.intersect1d(np.where(delta1 > margin)[0], np.where(delta2 > margin)[0])
 
+    if spread > 1:
+        # only the local maxima are kept
+        local_max = np.lib.stride_tricks.sliding_window_view( \
+            np.pad(sig, spread-1, mode='edge'), 2*spread-1).max(axis=1)
+        i_spurs = i_spurs[sig[i_spurs] >= local_max[i_spurs]]
+
     i_spur_max=np.array(()).astype(int)
     sigcopy=sig.copy()            
 
@@ -480,6 +572,36 @@ def spurdetect(sig, nb, margin=6):
 
     return(i_spurs, i_spur_max)
 
+# -----------------------------------------------------------------------------
+def strongest_spurs(sptdb, margin=6, spread=1):
+    r"""
+        This function measures the level of the strongest spurious of
+        carrier spectra (the carrier is at the first bin).
+
+        Parameters
+        ----------
+        sptdb : array_like
+        The spectra in dB (1 or 2 dimensions, one spectrum per line).
+
+        margin, spread : numbers
+        See spurdetect.
+
+        Returns
+        -------
+        spur_dbc : array_like
+        Level of the strongest spurious wrt the carrier (dBc) of each
+        spectrum (nan if no spurious is detected).
+        """
+    spectra = np.atleast_2d(sptdb)
+    spur_dbc = np.nan*np.ones(len(spectra))
+    for i in range(len(spectra)):
+        _, i_spur_max = spurdetect(spectra[i], 1, margin, spread)
+        if len(i_spur_max) > 0:
+            spur_dbc[i] = spectra[i, i_spur_max[0]] - spectra[i, 0]
+    if np.ndim(sptdb) == 1:
+        return(spur_dbc[0])
+    return(spur_dbc)
+
 # -----------------------------------------------------------------------------
 def peakdetect(sig, margin=6):
     r"""
@@ -520,12 +642,13 @@ def peakdetect(sig, margin=6):
     return(ithreshold[i])
 
 # -----------------------------------------------------------------------------
-def crestfactor(signal, verbose=False):
+def crestfactor(signal, verbose=False, nmax=2**20):
     r"""
         This function computes the crest factor (cf) of a signal.
 
         The cf is defined as the ratio between the peak value of a signal and
-        its rms value.
+        its rms value. If the signal is periodic the cf is computed over an
+        exact number of periods (see get_periodicity).
 
         Parameters
         ----------
@@ -535,6 +658,9 @@ def crestfactor(signal, verbose=False):
         verbose: boolean
         if True some informations are printed (Default=False)
 
+        nmax: number
+        Maximum number of samples considered (Default=2**20)
+
         Returns
         -------
         cf : number
@@ -550,22 +676,89 @@ def crestfactor(signal, verbose=False):
         """
 
     # searching for signal periodicity
-    period=search_period(signal, verbose=verbose)
+    period, _, cf = get_periodicity(signal, nmax)
+    if verbose:
+        if period==0:
+            print("This signal is not periodic")
+        else:
+            print("The period of the signal is {0:5d} samples".format(period))
     if period==0:
         period=len(signal)
-
-    peak = abs(signal[:period]).max()
-    cf=peak / signal[:period].std()
     if verbose:
         print("The crest factor is {0:6.4f}".format(cf))
 
     return(cf, period)
 
 # -----------------------------------------------------------------------------
+def sideband_bounds(indexes, n, df, config):
+    r"""
+        This function computes the limits of the science bands on the left
+        and on the right of the carriers. The limits follow the python
+        slicing rules (negative values count from the end, values are clipped).
+
+        Parameters
+        ----------
+        indexes : array_like
+        An array containing the indexes of the carriers.
+
+        n : number
+        The length of the spectrum.
+
+        df : number
+        The frequency resolution.
+
+        config : dictionnary
+        Contains path and constants definitions
+
+        Returns
+        -------
+        l_side_1, l_side_2, r_side_1, r_side_2 : arrays
+        The bounds of the left [l_side_1, l_side_2[ and right [r_side_1, r_side_2[ bands.
+
+    """
+    indexes = np.asarray(indexes, dtype=int)
+    d_min = int(np.ceil(config['ScBandMin']/df))
+    d_max = int(np.ceil(config['ScBandMax']/df))
+
+    def normalise(i):
+        return(np.clip(np.where(i < 0, i+n, i), 0, n))
+
+    l_side_1, l_side_2 = normalise(indexes-d_max), normalise(indexes-d_min)
+    r_side_1, r_side_2 = normalise(indexes+d_min), normalise(indexes+d_max)
+    # empty bands
+    l_side_2 = np.maximum(l_side_1, l_side_2)
+    r_side_2 = np.maximum(r_side_1, r_side_2)
+    return(l_side_1, l_side_2, r_side_1, r_side_2)
+
+# -----------------------------------------------------------------------
+def band_max(values, starts, stops):
+    r"""
+        This function computes the maximum of values over several bands
+        [starts, stops[ (-inf for the empty bands).
+    """
+    maxi = -np.inf*np.ones(len(starts))
+    not_empty = stops > starts
+    if not_empty.any():
+        bounds = np.ravel(np.column_stack((starts[not_empty], stops[not_empty])))
+        maxi[not_empty] = np.maximum.reduceat(np.append(values, -np.inf), bounds)[::2]
+    return(maxi)
+
+# -----------------------------------------------------------------------
+def to_db(powers):
+    r"""
+        This function converts powers to dB (-inf for null powers).
+    """
+    powers_db=-1*np.inf*np.ones(len(powers))
+    inotzero=np.where(powers != 0)[0]
+    powers_db[inotzero] = 10*np.log10(powers[inotzero])
+    return(powers_db)
+
+# -----------------------------------------------------------------------
 def noiseandspurpower(sigf, indexes, df, config):
     r"""
         This function measures the power of the signal in a band around
-        specific frequency indexes.
+        specific frequency indexes. The powers of all the bands are
+        obtained from a single cumulative sum of the power spectrum.
 
         Parameters
         ----------
@@ -587,19 +780,67 @@ def noiseandspurpower(sigf, indexes, df, config):
 
     """
 
-    powers = np.zeros(len(indexes))
-    for k, index in enumerate(indexes):
-        l_side_1 = index - int(np.ceil(config['ScBandMax']/df))
-        l_side_2 = index - int(np.ceil(config['ScBandMin']/df))
-        r_side_1 = index + int(np.ceil(config['ScBandMin']/df))
-        r_side_2 = index + int(np.ceil(config['ScBandMax']/df))
-        powers[k] = np.sum(sigf.astype(float)[l_side_1:l_side_2]**2) \
-                    + np.sum(sigf.astype(float)[r_side_1:r_side_2]**2)
+    cumpower = np.concatenate(([0.], np.cumsum(np.square(sigf, dtype=float))))
+    l_side_1, l_side_2, r_side_1, r_side_2 = sideband_bounds(indexes, len(sigf), df, config)
+    powers = cumpower[l_side_2] - cumpower[l_side_1] + cumpower[r_side_2] - cumpower[r_side_1]
+    return(to_db(powers))
 
-    powers_db=-1*np.inf*np.ones(len(powers))
-    inotzero=np.where(powers != 0)[0]
-    powers_db[inotzero] = 10*np.log10(powers[inotzero])
-    return(powers_db)
+# -----------------------------------------------------------------------
+def carrier_noise_table(sigf, indexes, df, config, offset_db=0.):
+    r"""
+        This function measures the carriers, the noise and the strongest
+        spurious in the science bands around each carrier. The power
+        spectrum is computed once and the band powers are obtained from
+        its cumulative sum (O(1) per carrier).
+
+        Parameters
+        ----------
+        sigf : array_like
+        The modulus of the spectrum (rfft) of the signal.
+
+        indexes : array_like
+        An array containing the indexes of the carriers.
+
+        df : number
+        The frequency resolution.
+
+        config : dictionnary
+        Contains path and constants definitions
+
+        offset_db : number
+        Normalisation applied to all the levels (for instance to get dBFS values).
+        Default is 0.
+
+        Returns
+        -------
+        table : dictionnary of arrays (one entry per carrier)
+        index, frequency,
+        carrier_db (power of the carrier bin),
+        noise_db (power in the science bands, as noiseandspurpower),
+        spur_db (power of the strongest bin in the science bands),
+        spur_dbc (spur_db - carrier_db),
+        snr_db (carrier_db - noise_db)
+
+    """
+    indexes = np.asarray(indexes, dtype=int)
+    power = np.square(sigf, dtype=float)
+    cumpower = np.concatenate(([0.], np.cumsum(power)))
+    l_side_1, l_side_2, r_side_1, r_side_2 = sideband_bounds(indexes, len(sigf), df, config)
+
+    noise = cumpower[l_side_2] - cumpower[l_side_1] + cumpower[r_side_2] - cumpower[r_side_1]
+    spur = np.maximum(band_max(power, l_side_1, l_side_2), band_max(power, r_side_1, r_side_2))
+    spur[np.isinf(spur)] = 0
+
+    table = {
+        'index': indexes,
+        'frequency': indexes*df,
+        'carrier_db': to_db(power[indexes]) + offset_db,
+        'noise_db': to_db(noise) + offset_db,
+        'spur_db': to_db(spur) + offset_db
+        }
+    table['spur_dbc'] = table['spur_db'] - table['carrier_db']
+    table['snr_db'] = table['carrier_db'] - table['noise_db']
+    return(table)
 
 # -----------------------------------------------------------------------
 def process_dump_pulses_adc_dac(fulldirname, config, dump_type, zoom_factor=20):
@@ -634,9 +875,7 @@ def process_dump_pulses_adc_dac(fulldirname, config, dump_type, zoom_factor=20):
     fs = config["fs"]
     nba, nbb = 12, 16 # INPUT and BIAS (or FEEDBACK) signals over 12 and 16 bits respectively
 
-    dumpfilenames = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-16:]==dump_type+'.dat']
+    dumpfilenames = session_index.get_files(datadirname, suffix=dump_type+'.dat')
 
     if len(dumpfilenames)>0:
         dumpfilename = os.path.join(datadirname, dumpfilenames[0])
@@ -692,7 +931,7 @@ def process_dump_pulses_adc_dac(fulldirname, config, dump_type, zoom_factor=20):
             ytext = -0.1 * fsr_peak
 
             ax = fig.add_subplot(2, 1, 1)
-            ax.plot(t[ideb:ifin]*1e3, a[ideb:ifin])
+            plot_tools.plot_envelope(ax, t[ideb:ifin]*1e3, a[ideb:ifin])
             ax.plot([t[ideb]*1e3,t[ifin]*1e3], [twelve_kev_peak, twelve_kev_peak], '--g', linewidth=0.5)
             ax.plot([t[ideb]*1e3,t[ifin]*1e3], [-twelve_kev_peak, -twelve_kev_peak], '--g', linewidth=0.5)
             plt.annotate(s='',xytext=(t[i1]*1e3, 0), xycoords='data',
@@ -726,13 +965,14 @@ def process_dump_pulses_adc_dac(fulldirname, config, dump_type, zoom_factor=20):
             ax.set_ylim([-2**(nba-1), 2**(nba-1)])
 
             ax2 = fig.add_subplot(2, 1, 2)
-            ax2.plot(t[ideb_zoom:ifin_zoom]*1e3, a[ideb_zoom:ifin_zoom])
+            plot_tools.plot_envelope(ax2, t[ideb_zoom:ifin_zoom]*1e3, a[ideb_zoom:ifin_zoom])
             ax2.set_ylabel("ADC unit (FSR range)")
             ax2.set_xlabel("Time (ms)")
             ax2.set_ylim([1.1*a.min(), 1.1*a.max()])
 
             fig.tight_layout()
             plt.savefig(plotfilenamea, bbox_inches='tight')
+            plt.close()
 
 
         # Making plot of bias or feedback signal
@@ -742,19 +982,20 @@ def process_dump_pulses_adc_dac(fulldirname, config, dump_type, zoom_factor=20):
             fig.text(0.1, 0.987, io_str, family='monospace')
 
             ax = fig.add_subplot(2, 1, 1)
-            ax.plot(t[ideb:ifin]*1e3, b[ideb:ifin])
+            plot_tools.plot_envelope(ax, t[ideb:ifin]*1e3, b[ideb:ifin])
             ax.set_ylabel("DAC unit (FSR range)")
             ax.set_xlabel("Time (ms)")
             ax.set_ylim([-2**(nbb-1), 2**(nbb-1)])
 
             ax2 = fig.add_subplot(2, 1, 2)
-            ax2.plot(t[ideb_zoom:ifin_zoom]*1e3, b[ideb_zoom:ifin_zoom])
+            plot_tools.plot_envelope(ax2, t[ideb_zoom:ifin_zoom]*1e3, b[ideb_zoom:ifin_zoom])
             ax2.set_ylabel("DAC unit (FSR range)")
             ax2.set_xlabel("Time (ms)")
             ax2.set_ylim([1.1*b.min(), 1.1*b.max()])
 
             fig.tight_layout()
             plt.savefig(plotfilenameb, bbox_inches='tight')
+            plt.close()
 
 # -----------------------------------------------------------------------
 def process_dump_pulses_iq(fulldirname, config):
@@ -782,11 +1023,7 @@ def process_dump_pulses_iq(fulldirname, config):
 
     fs = config["fs"]/2**config["power_to_fs2"]
 
-    f_type_deb, f_type_fin = 21, 33
-    dumpfilenames = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-4:]=='.dat'\
-                and f[f_type_deb:f_type_fin]=="IQ-ALL_PULSE"]
+    dumpfilenames = session_index.get_files(datadirname, ext='.dat', test_prefix="IQ-ALL_PULSE")
 
     if len(dumpfilenames)>0:
         dumpfilename = os.path.join(datadirname, dumpfilenames[0])
@@ -812,7 +1049,7 @@ def process_dump_pulses_iq(fulldirname, config):
         fig.text(0.1, 0.982, io_str, family='monospace')
 
         ax1 = fig.add_subplot(2, 1, 1)
-        ax1.plot(t[ideb:ifin]*1e3, modulus[ideb:ifin, :])
+        plot_tools.plot_envelope(ax1, t[ideb:ifin]*1e3, modulus[ideb:ifin, :])
         ax1.set_ylim(0, 2**(16-1))
         ax1.set_title("All pixels")
         ax1.set_ylabel("Module")
@@ -820,7 +1057,7 @@ def process_dump_pulses_iq(fulldirname, config):
 
         ax2 = fig.add_subplot(2, 1, 2)
         slice = modulus[ideb:ifin, pix]
-        ax2.plot(t[ideb:ifin]*1e3, slice)
+        plot_tools.plot_envelope(ax2, t[ideb:ifin]*1e3, slice)
         ax2.set_ylim(0, 2**(16-1))
         ax2.set_title("Test pixel")
         ax2.set_ylabel("Module")
@@ -831,6 +1068,7 @@ def process_dump_pulses_iq(fulldirname, config):
         fig.tight_layout()
         #plt.show()
         plt.savefig(plotfilename, bbox_inches='tight')
+        plt.close()
 
 # -----------------------------------------------------------------------
 def mosaic_labels(ax, box, n_cols, n_lines, x_lab, y_lab):
@@ -905,6 +1143,27 @@ def plot_spectra(sptdb, config, pltfilename, cf, fsr_over_peakpeak, suffixe, bw_
         booleans (indicates which pixels are on)           
         """
 
+    # Checking which pixel is on (the test pixel is not considered)
+    n_boxes=40 
+    pix_on = np.ones((n_boxes), dtype=bool)
+    for pix in range(n_boxes):
+        if sptdb[pix,1:].max()==sptdb[pix,1:].min():
+            pix_on[pix]=False
+            print("\n------------------> Pixel {0:2d} is off.".format(pix))
+
+    plot_tools.submit(render_spectra, sptdb, config, pltfilename, cf, fsr_over_peakpeak, \
+                      suffixe, bw_correction_factor_db, pix_on, pix_zoom)
+
+    return(pix_on)
+
+# -----------------------------------------------------------------------
+def render_spectra(sptdb, config, pltfilename, cf, fsr_over_peakpeak, suffixe, bw_correction_factor_db, pix_on, pix_zoom=40):
+    r"""
+        This function renders the plots of plot_spectra (zoom on a pixel and
+        mosaic of the 40 pixels). The parameters are the ones of plot_spectra,
+        pix_on indicates which pixels are on.
+        """
+
     npts = len(sptdb[0,:])
     ncar = len(sptdb[:,0])
     fs=float(config["fs"])/2**float(config["power_to_fs2"])
@@ -991,13 +1250,6 @@ def plot_spectra(sptdb, config, pltfilename, cf, fsr_over_peakpeak, suffixe, bw_
     n_lines=5
     n_cols =8
 
-    # Checking which pixel is on
-    pix_on = np.ones((n_boxes), dtype=bool)
-    for pix in range(n_boxes):
-        if sptdb[pix,1:].max()==sptdb[pix,1:].min():
-            pix_on[pix]=False
-            print("\n------------------> Pixel {0:2d} is off.".format(pix))
-
     fig = plt.figure(figsize=(18, 12))
     for box in range(n_boxes):
         if pix_on[box]:
@@ -1018,8 +1270,6 @@ def plot_spectra(sptdb, config, pltfilename, cf, fsr_over_peakpeak, suffixe, bw_
     fig.tight_layout()
     plt.savefig(pltfilename+suffixe+'_40pix.png', bbox_inches='tight')
 
-    return(pix_on)
-
 # -----------------------------------------------------------------------
 def get_cf_and_fsroverpeakpeak_from_file(fulldirname, quiet=True):
     r"""   
@@ -1032,18 +1282,15 @@ def get_cf_and_fsroverpeakpeak_from_file(fulldirname, quiet=True):
         Name of the directory
         """
 
-    f_type_deb, f_type_fin = 21, 27
-    dumpfilenames = [f for f in os.listdir(fulldirname) \
-            if os.path.isfile(os.path.join(fulldirname, f)) \
-            and f[-4:]=='.dat'\
-            and f[f_type_deb:f_type_fin]=="IN-FBK"]
+    dumpfilenames = session_index.get_files(fulldirname, ext='.dat', test_prefix="IN-FBK")
 
     if len(dumpfilenames)>0:
         filename = os.path.join(fulldirname, dumpfilenames[0])
 
         data, _ = get_data.readfile(filename)
         feedback = data[1:,1].astype(float)
-        cf,_ = crestfactor(feedback)
+        # The crest factor is measured over an exact number of periods
+        cf,_ = crestfactor(feedback, nmax=2**20)
         peakpeak = 2.*max(abs(feedback))
         fsr_over_peakpeak = 2.**16/peakpeak
         
@@ -1093,10 +1340,103 @@ def win(window, npts):
 
 
 # -----------------------------------------------------------------------
-def process_iq_multi(fulldirname, config, pix_zoom=40, window=False, bw_correction=True):
+def accumulate_iq_spectra(filenames, npts, window=False):
+    r"""
+        This function reads several DRE IQ data files and accumulates the power
+        spectra of the modulus of the pixels of channel 0. The FFTs of all the
+        pixels of a file are computed at once (2-D rfft along the time axis).
+        It is the elementary task of the process_iq_multi spectrum accumulation
+        engine (one call per worker).
+
+        Parameters
+        ----------
+        filenames : list of strings
+        The names of the IQ data files (with the path)
+
+        npts: integer
+        Number of samples to be used in each file
+
+        window: boolean
+        Specifies if a windowing shall be done before the FFT.
+        (Default is False)
+
+        Returns
+        ------- 
+        total_spt0 : array
+        Accumulated power spectra (npix x npts//2+1)
+
+        errors_counter : integer
+        Number of corrupted files
+
+        nb_short_files : integer
+        Number of files too short to be processed
+
+        chan0_empty : boolean
+        True if no data have been found in the files
+           
+        """
+    npix=41
+    total_spt0=np.zeros((npix, npts//2+1))
+    errors_counter = 0
+    nb_short_files = 0
+    chan0_empty = True
+    w = np.reshape(win(window, npts), (-1, 1))
+    for filename in filenames:
+        print('Processing file ' + os.path.basename(filename))
+        chan0_i, chan0_q, _, _, flag_error = get_data.read_iq(filename)
+        npts_current = len(chan0_i[:,0])
+        if flag_error:
+            errors_counter += 1
+
+        if npts_current >= npts:
+            chan0_modulus = \
+                np.sqrt(chan0_i[0:npts,:].astype('float')**2 + chan0_q[0:npts,:].astype('float')**2)
+
+            if chan0_modulus.max() > 0: # data exists
+                chan0_empty=False
+                total_spt0 += (abs(rfft(chan0_modulus*w, axis=0))**2).T
+        else:
+            print("File is too short!")
+            nb_short_files += 1 
+
+    return(total_spt0, errors_counter, nb_short_files, chan0_empty)
+
+# -----------------------------------------------------------------------
+def spectra_cache_key(filenames, datadirname, params):
+    r"""
+        This function computes the key of accumulated spectra in the spectra
+        cache. The key depends on the content of the data files, on the
+        content of the feedback dump file (used for the crest factor) and
+        on the processing parameters.
+
+        Parameters
+        ----------
+        filenames : list of strings
+        The names of the data files (with the path)
+
+        datadirname : string
+        The name of the directory containing the data files
+
+        params : dictionnary
+        The processing parameters
+
+        Returns
+        -------
+        key : string
+
+        """
+    fbk_filenames = [os.path.join(datadirname, f) for f in \
+                     session_index.get_files(datadirname, ext='.dat', test_prefix="IN-FBK")[:1]]
+    return(general_tools.get_cache_key(list(filenames)+fbk_filenames, params))
+
+# -----------------------------------------------------------------------
+def process_iq_multi(fulldirname, config, pix_zoom=40, window=False, bw_correction=True, n_workers=None, use_cache=True, \
+                     incremental=False):
     r"""
         This function reads data from several DRE IQ data files.
         It computes the accumulated spectra and makes the plots.
+        The files are spread over a pool of processes, each process returns
+        a partial accumulated spectrum and the partial spectra are summed.
         
         Parameters
         ----------
@@ -1118,6 +1458,21 @@ def process_iq_multi(fulldirname, config, pix_zoom=40, window=False, bw_correcti
         Specifies if a correction factor has to be applied to take into account the resolution BW (Default is True).
         If this factor is applied the measurment will be wrong for spuriouses (Default is True).
 
+        n_workers: integer
+        Number of processes used to compute the spectra (Default is None: number of cores).
+        If n_workers is 1 the files are processed in the current process.
+
+        use_cache: boolean
+        If True the accumulated spectra are saved in (or read from) the
+        spectra cache of the session LOGS directory. The cache key depends
+        on the content of the files and on the processing parameters (Default is True).
+
+        incremental: boolean
+        If True the accumulated spectra and the list of the files already
+        processed are kept in the LOGS directory, a new run only processes
+        the new files (Default is False). In this mode the spectra cache is
+        not used (it would need to read all the files).
+
         Returns
         ------- 
         spt0dB : Array containing the accumulated pixels spectra
@@ -1129,29 +1484,26 @@ def process_iq_multi(fulldirname, config, pix_zoom=40, window=False, bw_correcti
 
     npix=41
     npts_max=2**17
-    nb_short_files=0
 
     datadirname = os.path.join(fulldirname, config['dir_data'])
     plotdirname = os.path.join(fulldirname, config['dir_plots'])
     general_tools.checkdir(plotdirname)
 
+    logdirname = os.path.join(fulldirname, config['dir_logs'])
+
     pltfilename = os.path.join(plotdirname, "PLOT_carrier_spt")
 
-    i_test_deb, i_test_fin = 21, 40
     test = "IQ-ALL_Science-Data"
-    fichlist = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-4:]=='.dat' and f[i_test_deb:i_test_fin]==test]
+    fichlist = session_index.get_files(datadirname, ext='.dat', test_prefix=test)
 
+    spt0db=0
+    pix_pos=0
     if len(fichlist)>0:
-        print('Measurment of signal crest factor from feedback dump files if they exist')
-        cf0, fsr_over_peakpeak0, _ = get_cf_and_fsroverpeakpeak_from_file(datadirname)
-
         # definning file length
         chan0_i, _, _, _, FLAG_ERROR = get_data.read_iq(os.path.join(datadirname, fichlist[0]))
         npts = len(chan0_i[:,0])
         print('Npts:', npts)
-        npts=min(npts_max, 2**np.int(np.log(npts)/np.log(2)))
+        npts=min(npts_max, 2**int(np.log(npts)/np.log(2)))
         duration=npts/fs
         # Factor to correct the resolution BW effect on noise
         bw_correction_factor_db=10*np.log10(duration)
@@ -1159,68 +1511,153 @@ def process_iq_multi(fulldirname, config, pix_zoom=40, window=False, bw_correcti
         print("WARNING, a bandwidth correction factor of {0:6.4f}dB is applied on the spectra.".format(bw_correction_factor_db))
         print("This offset needs to be taken into account when considering spurious values.")
 
-        spt0db=-300*np.ones((npix, npts//2+1))
-        total_spt0=np.zeros((npix, npts//2+1))
-        spt = np.zeros((npix, npts//2+1))
-    
-        nfiles = len(fichlist)
-        print("{0:3d} files to process...".format(nfiles))
-        file=0
-        errors_counter = 0
-        CHAN0_EMPTY=True
-        for fich in fichlist:
-            file+=1
-            print('Processing file {0:3d}/{1:3d} '.format(file, nfiles), end='')
-            print(fich)
-            chan0_i, chan0_q, _, _, FLAG_ERROR = get_data.read_iq(os.path.join(datadirname, fich))
-            npts_current = len(chan0_i[:,0])
-            if FLAG_ERROR:
-                errors_counter += 1
-
-            if npts_current >= npts:
-
-                chan0_modulus = \
-                    np.sqrt(chan0_i[0:npts,:].astype('float')**2 + chan0_q[0:npts,:].astype('float')**2)
-                            
-                if chan0_modulus.max() > 0: # data exists
-                    CHAN0_EMPTY=False
-                    for pix in range(npix):
-                        spt[pix,:] = abs(rfft((chan0_modulus[:,pix])*win(window, npts)))
-                    total_spt0 += spt**2
-                                
-            else:
-                print("File is too short!")
-                nb_short_files += 1 
-
-        print("Data processing is done.")
-        print("{0:4d} corrupted files found.".format(errors_counter))
-        print("{0:4d} files were too short for processing.".format(nb_short_files))
-        print("Doing the plots...")
-    
-        if not CHAN0_EMPTY:
-            # Normalisation wrt each carrier
-            for pix in range(npix): 
-                i_good = np.where(total_spt0[pix,:] > 0)[0]
-                spt0db[pix,i_good] = 10*np.log10(total_spt0[pix,i_good])
-                spt0db[pix,:] = spt0db[pix,:] - spt0db[pix,:].max()
-            # 3 dB correction to compensate the impact of the rfft on DC bin
-            spt0db[:,1:] += 3
-            # Normalisation to a RBW of 1Hz
-            if bw_correction:
-                spt0db[:,1:] += bw_correction_factor_db
-            pix_on=plot_spectra(spt0db, config, pltfilename, cf0, fsr_over_peakpeak0, '', bw_correction_factor_db, pix_zoom)
-            pix_pos=int(np.where(pix_on==False)[0][0])
-    else:
-        spt0db=0
-        pix_pos=0
+        filenames = [os.path.join(datadirname, fich) for fich in fichlist]
+        use_cache = use_cache and not incremental
+        cache = None
+        if use_cache:
+            cachekey = spectra_cache_key(filenames, datadirname, \
+                {'npts': npts, 'window': window, 'bw_correction': bw_correction, 'fs': fs})
+            cache = general_tools.cache_load(logdirname, 'SPECTRA_IQ-ALL', cachekey)
+        if cache is not None:
+            print("Accumulated spectra read from the cache.")
+        else:
+            print('Measurment of signal crest factor from feedback dump files if they exist')
+            cf0, fsr_over_peakpeak0, _ = get_cf_and_fsroverpeakpeak_from_file(datadirname)
+
+            spt0db=-300*np.ones((npix, npts//2+1))
+
+            total_spt0 = np.zeros((npix, npts//2+1))
+            errors_counter, nb_short_files, CHAN0_EMPTY = 0, 0, True
+            new_filenames = filenames
+            if incremental:
+                stateparams = {'npts': npts, 'window': window}
+                state, new_filenames = general_tools.state_load(logdirname, 'STATE_IQ-ALL', stateparams, filenames)
+                if state is not None:
+                    total_spt0 = state['total_spt0']
+                    errors_counter = int(state['errors_counter'])
+                    nb_short_files = int(state['nb_short_files'])
+                    CHAN0_EMPTY = bool(state['chan0_empty'])
+        
+            nfiles = len(new_filenames)
+            print("{0:3d} files to process...".format(nfiles))
+            partials = []
+            if nfiles > 0:
+                if n_workers is None:
+                    n_workers = os.cpu_count()
+                n_workers = max(1, min(n_workers, nfiles))
+                if n_workers == 1:
+                    partials = [accumulate_iq_spectra(new_filenames, npts, window)]
+                else:
+                    chunks = [new_filenames[k::n_workers] for k in range(n_workers)]
+                    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                        partials = list(executor.map(accumulate_iq_spectra, chunks, \
+                            [npts]*n_workers, [window]*n_workers))
+
+            # reduction of the partial results
+            for partial_spt0, partial_errors, partial_short, partial_empty in partials:
+                total_spt0 += partial_spt0
+                errors_counter += partial_errors
+                nb_short_files += partial_short
+                CHAN0_EMPTY = CHAN0_EMPTY and partial_empty
+
+            if incremental:
+                general_tools.state_save(logdirname, 'STATE_IQ-ALL', stateparams, filenames, \
+                    {'total_spt0': total_spt0, 'errors_counter': errors_counter, \
+                     'nb_short_files': nb_short_files, 'chan0_empty': CHAN0_EMPTY})
+
+            print("Data processing is done.")
+            print("{0:4d} corrupted files found.".format(errors_counter))
+            print("{0:4d} files were too short for processing.".format(nb_short_files))
         
+            if not CHAN0_EMPTY:
+                # Normalisation wrt each carrier
+                for pix in range(npix): 
+                    i_good = np.where(total_spt0[pix,:] > 0)[0]
+                    spt0db[pix,i_good] = 10*np.log10(total_spt0[pix,i_good])
+                    spt0db[pix,:] = spt0db[pix,:] - spt0db[pix,:].max()
+                # 3 dB correction to compensate the impact of the rfft on DC bin
+                spt0db[:,1:] += 3
+                # Normalisation to a RBW of 1Hz
+                if bw_correction:
+                    spt0db[:,1:] += bw_correction_factor_db
+
+            cache = {'spt0db': spt0db, 'cf': cf0, 'fsr_over_peakpeak': fsr_over_peakpeak0, \
+                     'bw_correction_factor_db': bw_correction_factor_db, 'chan0_empty': CHAN0_EMPTY}
+            if use_cache:
+                general_tools.cache_save(logdirname, 'SPECTRA_IQ-ALL', cachekey, cache)
+
+        spt0db = cache['spt0db']
+        if not cache['chan0_empty']:
+            print("Doing the plots...")
+            pix_on=plot_spectra(spt0db, config, pltfilename, float(cache['cf']), float(cache['fsr_over_peakpeak']), \
+                                '', float(cache['bw_correction_factor_db']), pix_zoom)
+            pix_pos=int(np.where(pix_on==False)[0][0])
+
+            spur_dbc = strongest_spurs(spt0db[:len(pix_on)])[pix_on]
+            items = ['pix{0:02d}'.format(pix) for pix in np.where(pix_on)[0]]
+            records = [('crest_factor', '', float(cache['cf']), ''), \
+                       ('fsr_over_peakpeak', '', float(cache['fsr_over_peakpeak']), ''), \
+                       ('pix_off', '', pix_pos, ''), \
+                       ('mean_spur_dbc', '', np.nanmean(spur_dbc) if len(spur_dbc) > 0 else np.nan, 'dBc')]
+            records += results_store.make_records('spur_dbc', spur_dbc, 'dBc', items)
+            results_store.record(fulldirname, config, 'process_iq_multi', records)
+
     return(spt0db, pix_pos)
 
 # -----------------------------------------------------------------------
-def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True):
+def welch_accumulate(i, q, w, noverlap, nbatch=2**22):
+    r"""
+        This function accumulates the periodograms of overlapping segments of
+        the modulus of an IQ signal (averaged periodogram, Welch method).
+        The segments are processed by batches so that the memory needed is
+        bounded by nbatch samples whatever the length of the signal.
+
+        Parameters
+        ----------
+        i, q: arrays
+        I and Q values of the signal (any numerical format)
+
+        w: array
+        The window applied on each segment (its length defines the
+        length of the segments)
+
+        noverlap: integer
+        Number of samples shared by two consecutive segments
+
+        nbatch: integer
+        Maximum number of samples processed at once (default is 2**22)
+
+        Returns
+        ------- 
+        total_spt: array
+        Sum of the periodograms of the segments (length: len(w)//2+1)
+
+        nseg: integer
+        Number of segments
+        """
+    nperseg = len(w)
+    step = nperseg - noverlap
+    seg_i = np.lib.stride_tricks.sliding_window_view(i, nperseg)[::step]
+    seg_q = np.lib.stride_tricks.sliding_window_view(q, nperseg)[::step]
+    nseg = len(seg_i)
+    seg_per_batch = max(1, nbatch // nperseg)
+
+    total_spt = np.zeros(nperseg//2+1)
+    for first in range(0, nseg, seg_per_batch):
+        modulus = np.sqrt(seg_i[first:first+seg_per_batch].astype('float')**2 \
+            + seg_q[first:first+seg_per_batch].astype('float')**2)
+        total_spt += (abs(rfft(modulus*w, axis=1))**2).sum(axis=0)
+    return(total_spt, nseg)
+
+# -----------------------------------------------------------------------
+def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True, \
+                         welch=False, nperseg=2**20, overlap=0.5, welch_window='hann', use_cache=True, \
+                         incremental=False):
     r"""
         This function reads data from several DRE IQ-TST data files.
         It computes the accumulated spectra and makes the plots.
+        If welch is True, the spectrum of each file is an averaged periodogram
+        computed on overlapping segments (Welch method) instead of a single FFT.
         
         Parameters
         ----------
@@ -1237,6 +1674,31 @@ def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True):
         bw_correction: boolean
         Specifies if a correction factor has to be applied to take into account the resolution BW (Default is True).
         If this factor is applied the measurment will be wrong for spuriouses (Default is True).
+
+        welch: boolean
+        If True the averaged periodogram mode is used (Default is False).
+
+        nperseg: integer
+        Length of the segments in welch mode (Default is 2**20).
+
+        overlap: number
+        Fraction of overlap between two consecutive segments in welch mode (Default is 0.5).
+
+        welch_window: string or tuple
+        Window applied on the segments in welch mode, as accepted by
+        scipy.signal.get_window (Default is 'hann').
+        The equivalent noise bandwidth of the window is taken into account
+        in the bandwidth correction factor.
+
+        use_cache: boolean
+        If True the accumulated spectrum is saved in (or read from) the
+        spectra cache of the session LOGS directory (Default is True).
+
+        incremental: boolean
+        If True the accumulated spectrum and the list of the files already
+        processed are kept in the LOGS directory, a new run only processes
+        the new files (Default is False). In this mode the spectra cache is
+        not used.
         
         Returns
         ------- 
@@ -1254,19 +1716,14 @@ def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True):
     if not os.path.isdir(plotdirname):
         os.mkdir(plotdirname)
 
+    logdirname = os.path.join(fulldirname, config['dir_logs'])
+
     pltfilename = os.path.join(plotdirname, "PLOT_carrier-TST_spt")
 
-    i_test_deb, i_test_fin = 21, 40
     test = "IQ-TST_Science-Data"
-    fichlist = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-4:]=='.dat' \
-                and f[i_test_deb:i_test_fin]==test]
+    fichlist = session_index.get_files(datadirname, ext='.dat', test_prefix=test)
 
     if len(fichlist)>0:
-        print('Measurment of signal crest factor from feedback dump files if they exist')
-        cf, fsr_over_peakpeak, ncar = get_cf_and_fsroverpeakpeak_from_file(datadirname)
-
         # definning file length
         data, dumptype = get_data.readfile(os.path.join(datadirname, fichlist[0]))
         if dumptype != 9:
@@ -1275,61 +1732,120 @@ def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True):
         # decommutation des donnees        
         npts = len(data[1:,0])   
         print('Npts:', npts)
-        npts=min(npts_max, 2**np.int(np.log(npts)/np.log(2)))
+        if welch:
+            # the length of the spectrum is defined by the length of the segments
+            npts=min(nperseg, 2**int(np.log(npts)/np.log(2)))
+            noverlap=int(npts*overlap)
+            w=get_window(welch_window, npts)
+            # equivalent noise bandwidth of the window (in bins)
+            enbw=npts*np.sum(w**2)/np.sum(w)**2
+            # the window spreads the spuriouses over several bins
+            spur_spread=int(np.ceil(enbw))+1
+        else:
+            npts=min(npts_max, 2**int(np.log(npts)/np.log(2)))
+            enbw=1
+            spur_spread=1
         duration=npts/fs
         # Factor to correct the resolution BW effect on noise
-        bw_correction_factor_db=10*np.log10(duration)
+        bw_correction_factor_db=10*np.log10(duration/enbw)
         print("Scan duration is about: {0:6.4f}".format(duration))
         print("WARNING, a bandwidth correction factor of {0:6.4f}dB is applied on the spectra.".format(bw_correction_factor_db))
         print("This offset needs to be taken into account when considering spurious values.")
 
-        sptdb=np.zeros((npts//2+1))
-        total_spt=np.zeros((npts//2+1))
+        filenames = [os.path.join(datadirname, fich) for fich in fichlist]
+        use_cache = use_cache and not incremental
+        cache = None
+        if use_cache:
+            cachekey = spectra_cache_key(filenames, datadirname, \
+                {'npts': npts, 'window': window, 'bw_correction': bw_correction, 'welch': welch, \
+                 'nperseg': nperseg, 'overlap': overlap, 'welch_window': welch_window, 'fs': fs})
+            cache = general_tools.cache_load(logdirname, 'SPECTRA_IQ-TST', cachekey)
+        if cache is not None:
+            print("Accumulated spectrum read from the cache.")
+        else:
+            print('Measurment of signal crest factor from feedback dump files if they exist')
+            cf, fsr_over_peakpeak, ncar = get_cf_and_fsroverpeakpeak_from_file(datadirname)
+
+            sptdb=np.zeros((npts//2+1))
+            total_spt=np.zeros((npts//2+1))
+            errors_counter = 0
+            EMPTY=True
+            new_filenames = filenames
+            if incremental:
+                stateparams = {'npts': npts, 'window': window, 'welch': welch, \
+                               'overlap': overlap, 'welch_window': welch_window}
+                state, new_filenames = general_tools.state_load(logdirname, 'STATE_IQ-TST', stateparams, filenames)
+                if state is not None:
+                    total_spt = state['total_spt']
+                    errors_counter = int(state['errors_counter'])
+                    nb_short_files = int(state['nb_short_files'])
+                    EMPTY = bool(state['empty'])
     
-        nfiles = len(fichlist)
-        print("{0:3d} files to process...".format(nfiles))
-        file=0
-        errors_counter = 0
-        EMPTY=True
-        for fich in fichlist:
-            file+=1
-            print('Processing file {0:3d}/{1:3d} '.format(file, nfiles), end='')
-            print(fich)
-
-            data, dumptype = get_data.readfile(os.path.join(datadirname, fich))
-            if dumptype != 9:
-                raise ValueError('Wrong dumptype')
-
-            # decommutation des donnees        
-            npts_current = len(data[1:,0])
-
-            if npts_current >= npts:
-
-                modulus = np.sqrt(data[1:npts+1,0].astype('float')**2 + data[1:npts+1,1].astype('float')**2)
+            nfiles = len(new_filenames)
+            print("{0:3d} files to process...".format(nfiles))
+            file=0
+            for filename in new_filenames:
+                file+=1
+                print('Processing file {0:3d}/{1:3d} '.format(file, nfiles), end='')
+                print(os.path.basename(filename))
+
+                data, dumptype = get_data.readfile(filename)
+                if dumptype != 9:
+                    raise ValueError('Wrong dumptype')
+
+                # decommutation des donnees        
+                npts_current = len(data[1:,0])
+
+                if npts_current >= npts:
+
+                    if welch:
+                        spt, nseg = welch_accumulate(data[1:,0], data[1:,1], w, noverlap)
+                        if spt.max() > 0: # data exists
+                            EMPTY=False
+                            # each file has the same weight in the average
+                            total_spt += spt/nseg
+                    else:
+                        modulus = np.sqrt(data[1:npts+1,0].astype('float')**2 + data[1:npts+1,1].astype('float')**2)
                             
-                if modulus.max() > 0: # data exists
-                    EMPTY=False
-                    total_spt += abs(rfft(modulus*win(window, npts)))**2
+                        if modulus.max() > 0: # data exists
+                            EMPTY=False
+                            total_spt += abs(rfft(modulus*win(window, npts)))**2
                                 
-            else:
-                print("File is too short!")
-                nb_short_files += 1 
-
-        print("Data processing is done.")
-        print("{0:4d} corrupted files found.".format(errors_counter))
-        print("{0:4d} files were too short for processing.".format(nb_short_files))
-        print("Doing the plots...", end='')
+                else:
+                    print("File is too short!")
+                    nb_short_files += 1 
+
+            if incremental:
+                general_tools.state_save(logdirname, 'STATE_IQ-TST', stateparams, filenames, \
+                    {'total_spt': total_spt, 'errors_counter': errors_counter, \
+                     'nb_short_files': nb_short_files, 'empty': EMPTY})
+
+            print("Data processing is done.")
+            print("{0:4d} corrupted files found.".format(errors_counter))
+            print("{0:4d} files were too short for processing.".format(nb_short_files))
     
-        if not EMPTY:            
-            sptdb = 10*np.log10(total_spt)
-            # Normalisation wrt carrier
-            sptdb -= sptdb.max()
-            # 3 dB correction to compensate the impact of the rfft on DC bin
-            sptdb[1:] += 3
-            # Normalisation to a RBW of 1Hz
-            if bw_correction:
-                sptdb[1:] += bw_correction_factor_db
-
+            if not EMPTY:            
+                sptdb = 10*np.log10(total_spt)
+                # Normalisation wrt carrier
+                sptdb -= sptdb.max()
+                # 3 dB correction to compensate the impact of the rfft on DC bin
+                sptdb[1:] += 3
+                # Normalisation to a RBW of 1Hz
+                if bw_correction:
+                    sptdb[1:] += bw_correction_factor_db
+
+            cache = {'sptdb': sptdb, 'cf': cf, 'fsr_over_peakpeak': fsr_over_peakpeak, 'ncar': ncar, \
+                     'empty': EMPTY}
+            if use_cache:
+                general_tools.cache_save(logdirname, 'SPECTRA_IQ-TST', cachekey, cache)
+
+        sptdb = cache['sptdb']
+        cf, fsr_over_peakpeak, ncar = float(cache['cf']), float(cache['fsr_over_peakpeak']), int(cache['ncar'])
+        if not cache['empty']:
+            results_store.record(fulldirname, config, 'process_iq_tst_multi', \
+                [('crest_factor', '', cf, ''), ('fsr_over_peakpeak', '', fsr_over_peakpeak, ''), \
+                 ('n_carriers', '', ncar, ''), ('spur_dbc', '', strongest_spurs(sptdb, 10, spur_spread), 'dBc')])
+            print("Doing the plots...", end='')
             npts = len(sptdb)
             f=np.arange(npts)*fs/(2*npts)
             fres=(fs/2)/npts
@@ -1346,7 +1862,7 @@ def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True):
             fig = plt.figure(figsize=(12, 8))
             ax = fig.add_subplot(1, 1, 1)
             ax.semilogx(f[1:], sptdb[1:])
-            i_spurs, i_spur_max = spurdetect(sptdb, 4, 10)
+            i_spurs, i_spur_max = spurdetect(sptdb, 4, 10, spur_spread)
             n_spurs = len(i_spurs)
             ax.semilogx(f[i_spurs], sptdb[i_spurs],'.',color='orange')            
 
@@ -1403,6 +1919,7 @@ def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True):
 
             fig.tight_layout()
             plt.savefig(pltfilename+'.png', bbox_inches='tight')
+            plt.close()
 
     else:
         sptdb=0
@@ -1436,12 +1953,7 @@ def process_dump_delock_iq(fulldirname, config, delock_type):
     fs = config["fs"]/2**config["power_to_fs2"]
     pix=40 # Index of test pixel
 
-    f_type_deb, f_type_fin = -22, -4
-				
-    dumpfilenames = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-4:]=='.dat'\
-                and f[f_type_deb:f_type_fin]==delock_type]
+    dumpfilenames = session_index.get_files(datadirname, suffix=delock_type+'.dat')
 
     if len(dumpfilenames)>0:
         dumpfilename = os.path.join(datadirname, dumpfilenames[0])
@@ -1462,14 +1974,14 @@ def process_dump_delock_iq(fulldirname, config, delock_type):
 
         ymin, ymax = 0, 2**(16-1)
         ax1 = fig.add_subplot(2, 1, 1)
-        ax1.plot(t*1e3, modulus)
+        plot_tools.plot_envelope(ax1, t*1e3, modulus)
         ax1.set_ylim(ymin, ymax)
         ax1.set_title("All pixels")
         ax1.set_ylabel("Modulus")
         ax1.set_xlabel("Time (ms)")
 
         ax2 = fig.add_subplot(2, 1, 2)
-        ax2.plot(t*1e3, modulus[:, pix])
+        plot_tools.plot_envelope(ax2, t*1e3, modulus[:, pix])
         ax2.set_ylim(ymin, ymax)
         ax2.set_title("Test pixel")
         ax2.set_ylabel("Modulus")
@@ -1478,6 +1990,7 @@ def process_dump_delock_iq(fulldirname, config, delock_type):
         fig.tight_layout()
         #plt.show()
         plt.savefig(plotfilename, bbox_inches='tight')
+        plt.close()
 
 # -----------------------------------------------------------------------
 def process_dump_nl(fulldirname, config):
@@ -1502,10 +2015,7 @@ def process_dump_nl(fulldirname, config):
     plotdirname = os.path.join(fulldirname, config['dir_plots'])
     general_tools.checkdir(plotdirname)
 
-    f_type_deb = -22
-    dumpfilenames = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[f_type_deb:]=="_NL-carac_nodelock.dat"]
+    dumpfilenames = session_index.get_files(datadirname, suffix="_NL-carac_nodelock.dat")
 
     if len(dumpfilenames)>0:
         print("Checking non linear module from file: ", dumpfilenames[0])
@@ -1515,10 +2025,7 @@ def process_dump_nl(fulldirname, config):
         plot_nl_module(dumpfilename, plotfilename, title)
 
 
-    f_type_deb = -20
-    dumpfilenames = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[f_type_deb:]=="_NL-carac_delock.dat"]
+    dumpfilenames = session_index.get_files(datadirname, suffix="_NL-carac_delock.dat")
 
     if len(dumpfilenames)>0:
         print("Checking non linear module from file: ", dumpfilenames[0])
@@ -1573,9 +2080,10 @@ def plot_nl_module(dumpfilename, plotfilename, title):
 
     fig.tight_layout()
     plt.savefig(plotfilename, bbox_inches='tight')
+    plt.close()
 
 # -----------------------------------------------------------------------
-def search_period(sig, verbose=False):
+def search_period(sig, verbose=False, nmax=2**20):
     r"""
         This function measures the periodicity of a signal.
         
@@ -1587,27 +2095,16 @@ def search_period(sig, verbose=False):
         verbose: boolean
         if True some informations are printed (Default=False)
 
+        nmax: number
+        Maximum number of samples considered (Default=2**20)
+
         Returns
         -------
-        period
+        period (0 if the signal is not periodic)
 
         """
 
-    period=0
-    i_max=np.where(sig==sig.max())[0]
-    if len(i_max)>1:
-        l=1
-        p=i_max[l]-i_max[0]
-        while p < len(sig)/2:
-            equal = (abs(sig[:p]-sig[p:p*2])).max()==0
-            if equal:
-                period=p
-                break
-            if l < len(i_max)-1:
-                l+=1
-                p=i_max[l]-i_max[0]
-            else:
-                break
+    period, _, _ = get_periodicity(sig, nmax)
     if verbose:
         if period==0:
             print("This signal is not periodic")
@@ -1615,4 +2112,81 @@ def search_period(sig, verbose=False):
             print("The period of the signal is {0:5d} samples".format(period))
 
     return(period)
+
+# -----------------------------------------------------------------------
+def get_periodicity(sig, nmax=2**20, n_candidates=16, threshold=0.999):
+    r"""
+        This function measures the periodicity of a signal from its
+        autocorrelation (computed with FFTs).
+
+        The lags for which the normalised autocorrelation is above a threshold
+        are candidate periods. They are checked by increasing lag and the
+        first one for which the signal is exactly periodic is the period.
+
+        Parameters
+        ----------
+        sig : array
+        The values to be measured
+
+        nmax: number
+        Maximum number of samples considered (Default=2**20). Periods up to
+        nmax/2 can be detected.
+
+        n_candidates: number
+        Maximum number of candidate periods checked (Default=16)
+
+        threshold: number
+        Minimum normalised autocorrelation of a candidate period (Default=0.999)
+
+        Returns
+        -------
+        period: number
+        The period in samples (0 if the signal is not periodic)
+
+        confidence: number
+        The normalised autocorrelation at the period (or the best one over
+        all the lags if the signal is not periodic). 1 for a periodic signal.
+
+        cf: number
+        The crest factor computed over an exact number of periods (over
+        the nmax first samples if the signal is not periodic)
+
+        """
+    sig = np.asarray(sig)[:nmax]
+    n = len(sig)
+    period, confidence = 0, 0.
+
+    if n > 1 and np.all(sig == sig[0]):
+        period, confidence = 1, 1.
+    elif n > 3:
+        x = sig.astype(float) - sig.mean()
+        nlags = n//2
+        # Autocorrelation (the zero padding avoids the circular correlation)
+        nfft = 2**int(np.ceil(np.log2(2*n)))
+        xf = rfft(x, nfft)
+        acf = irfft(xf.real**2 + xf.imag**2, nfft)[:nlags+1]
+        # Normalisation by the energies of the overlapping parts
+        energy = np.concatenate(([0.], np.cumsum(x**2)))
+        lags = np.arange(1, nlags+1)
+        norm = np.sqrt((energy[n-lags]) * (energy[n]-energy[lags]))
+        rho = np.zeros(nlags)
+        inotzero = np.where(norm > 0)[0]
+        rho[inotzero] = acf[1:][inotzero] / norm[inotzero]
+
+        candidates = lags[rho >= threshold][:n_candidates]
+        for p in candidates:
+            if np.array_equal(sig[p:], sig[:n-p]):
+                period, confidence = int(p), float(rho[p-1])
+                break
+        if period == 0 and nlags > 0:
+            confidence = float(rho.max())
+
+    # crest factor over an exact number of periods
+    length = n if period == 0 else (n//period)*period
+    cf = 0.
+    if length > 0 and sig[:length].std() > 0:
+        cf = abs(sig[:length]).max() / sig[:length].std()
+
+    return(period, confidence, cf)
+
 # -----------------------------------------------------------------------
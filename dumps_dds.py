@@ -2,7 +2,7 @@ import numpy as np
 from numpy.fft import rfft
 import os
 import matplotlib.pyplot as plt
-import get_data, general_tools
+import get_data, general_tools, session_index, plot_tools, dumps, results_store
 
 
 # -----------------------------------------------------------------------------
@@ -84,18 +84,10 @@ def process_dump_dds(fulldirname, config, max_duration=0.2):
     plotfilename_d = os.path.join(plotdirname, "PLOT_DUMP_" + name_d + ".png")
     plotfilename_e = os.path.join(plotdirname, "PLOT_DUMP_" + name_e + ".png")
 
-    dumpfilenames1 = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-11:]=="DDSout1.dat"]
-    dumpfilenames2 = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-11:]=="DDSout2.dat"]
-    dumpfilenames3 = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-11:]=="DDSout3.dat"]
-    dumpfilenames4 = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-11:]=="DDSout4.dat"]
+    dumpfilenames1 = session_index.get_files(datadirname, suffix="DDSout1.dat")
+    dumpfilenames2 = session_index.get_files(datadirname, suffix="DDSout2.dat")
+    dumpfilenames3 = session_index.get_files(datadirname, suffix="DDSout3.dat")
+    dumpfilenames4 = session_index.get_files(datadirname, suffix="DDSout4.dat")
 
     if len(dumpfilenames1)>0 and len(dumpfilenames2)>0 and len(dumpfilenames3)>0 and len(dumpfilenames4)>0:
         dumpfilename1 = os.path.join(datadirname, dumpfilenames1[0])
@@ -175,6 +167,9 @@ def process_dump_dds(fulldirname, config, max_duration=0.2):
         efdb, _, _ = analyse_dump(e, nbe, config)
         plot_dump(e, nbe, efdb, f_carriers[0], config, "Signal "+name_e+plot_str, plotfilename_e)
 
+        results_store.record(fulldirname, config, 'process_dump_dds', results_store.make_records('nbits', \
+            [nba_real, nbb_real, nbc_real, nbd_real, nbe_real], '', [name_a, name_b, name_c, name_d, name_e]))
+
     print("Done!")
     print("------------------------------------")
 
@@ -250,18 +245,27 @@ Max of spectrum------------------> {2:9.2f} dB\n'\
         fcarriers = icarriers*df
         ncar=len(fcarriers)
         print(" => {0:3d} carriers detected. \nCarrier frequencies (Hz):".format(ncar))
-        freq_str, power_str =  " > ",  " > "
+        freq_str, power_str, snr_str, spur_str =  " > ",  " > ", " > ", " > "
         if ncar > 0 and ncar < 80:
-            noise_power = noiseandspurpower(sigf, icarriers, df, config) - e_freq_db + e_time_db - e_fsr_db
+            table = dumps.carrier_noise_table(sigf, icarriers, df, config, offset_db=-e_freq_db+e_time_db-e_fsr_db)
+            noise_power = table['noise_db']
             for carrier in range(ncar):
                 freq_str += '{0:12.2f}'.format(fcarriers[carrier])
                 power_str += '{0:12.2f}'.format(noise_power[carrier])
+                snr_str += '{0:12.2f}'.format(table['snr_db'][carrier])
+                spur_str += '{0:12.2f}'.format(table['spur_dbc'][carrier])
                 if (carrier+1) % 8 == 0:
                     freq_str += "\n > "
                     power_str += "\n > "
+                    snr_str += "\n > "
+                    spur_str += "\n > "
             print(freq_str)
             print("\nNoise power calculation... \nMeasured power (dBFS / 2 x Binfo)")
             print(power_str)
+            print("\nCarrier to noise ratio (dB / 2 x Binfo)")
+            print(snr_str)
+            print("\nStrongest spurious in the science bands (dBc)")
+            print(spur_str)
 
         io_str += 'Number of carriers detected------> {0:9d} : \n'\
         .format(ncar)
@@ -423,6 +427,7 @@ def plot_dump(sig, nb, sigfdb, f_car, config, io_str, plotfilename):
     fig.tight_layout()
     #plt.show()
     plt.savefig(plotfilename, bbox_inches='tight')
+    plt.close()
     print('Plots done')
 
 # -----------------------------------------------------------------------------
@@ -499,46 +504,6 @@ def crestfactor(signal):
     peak = abs(signal).max()
     return(peak / signal.std())
 
-# -----------------------------------------------------------------------------
-def noiseandspurpower(sigf, indexes, df, config):
-    r"""
-        This function measures the power of the signal in a band around
-        specific frequency indexes.
-
-        Parameters
-        ----------
-        sig : array_like
-        The signal in which the power is measured.
-
-        indexes : array_like
-        An array containing the indexes of the carriers.
-
-        df : number
-        The frequency resolution.
-
-        config : dictionnary
-        Contains path and constants definitions
-
-        Returns
-        -------
-        The values of the power measured around each carrier.
-
-    """
-
-    powers = np.zeros(len(indexes))
-    for k, index in enumerate(indexes):
-        l_side_1 = index - int(np.ceil(config['ScBandMax']/df))
-        l_side_2 = index - int(np.ceil(config['ScBandMin']/df))
-        r_side_1 = index + int(np.ceil(config['ScBandMin']/df))
-        r_side_2 = index + int(np.ceil(config['ScBandMax']/df))
-        powers[k] = np.sum(sigf.astype(float)[l_side_1:l_side_2]**2) \
-                    + np.sum(sigf.astype(float)[r_side_1:r_side_2]**2)
-
-    powers_db=-1*np.inf*np.ones(len(powers))
-    inotzero=np.where(powers != 0)[0]
-    powers_db[inotzero] = 10*np.log10(powers[inotzero])
-    return(powers_db)
-
 # -----------------------------------------------------------------------
 def process_dump_pulses(fulldirname, config):
     r"""
@@ -566,11 +531,7 @@ def process_dump_pulses(fulldirname, config):
     fs = config["fs"]
     nb = 12 # INPUT signal over 12 bits
 
-    f_type_deb, f_type_fin = 21, 33
-    dumpfilenames = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-4:]=='.dat'\
-                and f[f_type_deb:f_type_fin]=="IN-BIA_PULSE"]
+    dumpfilenames = session_index.get_files(datadirname, ext='.dat', test_prefix="IN-BIA_PULSE")
 
     if len(dumpfilenames)>0:
         dumpfilename = os.path.join(datadirname, dumpfilenames[0])
@@ -655,6 +616,7 @@ def process_dump_pulses(fulldirname, config):
         fig.tight_layout()
         #plt.show()
         plt.savefig(plotfilename, bbox_inches='tight')
+        plt.close()
 
 def mosaic_labels(ax, box, n_cols, n_lines, x_lab, y_lab):
     r"""
@@ -727,6 +689,15 @@ def plot_spectra(sptdb, config, pltfilename, cf, fsr_over_peakpeak, suffixe, bw_
         Nothing           
         """
 
+    plot_tools.submit(render_spectra, sptdb, config, pltfilename, cf, fsr_over_peakpeak, suffixe, bw_correction_factor_db, pix_zoom)
+
+# -----------------------------------------------------------------------
+def render_spectra(sptdb, config, pltfilename, cf, fsr_over_peakpeak, suffixe, bw_correction_factor_db, pix_zoom=40):
+    r"""
+        This function renders the plots of plot_spectra (zoom on a pixel and
+        mosaic of the 40 pixels). The parameters are the ones of plot_spectra.
+        """
+
     npts = len(sptdb[0,:])
     ncar = len(sptdb[:,0])
     fs=float(config["fs"])/2**float(config["power_to_fs2"])
@@ -828,11 +799,7 @@ def get_cf_and_fsroverpeakpeak_from_file(fulldirname, quiet=True):
         Name of the directory
         """
 
-    f_type_deb, f_type_fin = 21, 27
-    dumpfilenames = [f for f in os.listdir(fulldirname) \
-            if os.path.isfile(os.path.join(fulldirname, f)) \
-            and f[-4:]=='.dat'\
-            and f[f_type_deb:f_type_fin]=="IN-BIA"]
+    dumpfilenames = session_index.get_files(fulldirname, ext='.dat', test_prefix="IN-BIA")
 
     if len(dumpfilenames)>0:
         filename = os.path.join(fulldirname, dumpfilenames[0])
@@ -915,11 +882,8 @@ def process_iq_multi(fulldirname, config, pix_zoom=40, window=False, bw_correcti
 
     pltfilename = os.path.join(plotdirname, "PLOT_carrier_spt")
 
-    i_test_deb, i_test_fin = 21, 40
     test = "IQ-ALL_Science-Data"
-    fichlist = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-4:]=='.dat' and f[i_test_deb:i_test_fin]==test]
+    fichlist = session_index.get_files(datadirname, ext='.dat', test_prefix=test)
 
     if len(fichlist)>0:
         print('Measurment of signal crest factor from feedback dump files if they exist')
@@ -1032,12 +996,8 @@ def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True):
 
     pltfilename = os.path.join(plotdirname, "PLOT_carrier-TST_spt")
 
-    i_test_deb, i_test_fin = 21, 40
     test = "IQ-TST_Science-Data"
-    fichlist = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[-4:]=='.dat' \
-                and f[i_test_deb:i_test_fin]==test]
+    fichlist = session_index.get_files(datadirname, ext='.dat', test_prefix=test)
 
     if len(fichlist)>0:
         print('Measurment of signal crest factor from feedback dump files if they exist')
@@ -1161,6 +1121,7 @@ def process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True):
 
             fig.tight_layout()
             plt.savefig(pltfilename+'.png', bbox_inches='tight')
+            plt.close()
 
     else:
         sptdb=0
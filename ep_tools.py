@@ -5,16 +5,24 @@ Created on 26 juil. 2019
 Updated on 3 Sept. 2019 by Laurent Ravera to match the DRE processing environnement
 '''
 import os
+import itertools
 import numpy as np
 import argparse
 import general_tools
 import matplotlib.pyplot as plt
-import general_tools, dre_fits
+import general_tools, dre_fits, session_index, results_store, plot_tools, params
 from astropy.io import fits
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from scipy.optimize.minpack import curve_fit
 
 PREBUFF=180
 JITTER_MARGIN=10
+MIN_COUNTS=100  # minimum number of pulses to measure the energy resolution of a pixel
+
+# Optimal filters shared with the processes measuring the energy resolution
+# (see init_er_worker)
+_shared_filters={}
 
 
 # ############################################################
@@ -29,14 +37,28 @@ def get_testpix_module_from_iqfits(filename, slice_length=2048, verbose=False):
 
     Returns: an arrays containing I and Q for the test pixel and t
     '''
+    return(get_module_from_iqfits(filename, [-1], slice_length, verbose)[0])
+
+
+def get_module_from_iqfits(filename, pixels=None, slice_length=2048, verbose=False):
+    '''Reads i/q data of several pixels from a fits file
 
-    i,q=dre_fits.read_iq(filename, verbose)
-    module=np.sqrt(i[:,-1]**2+q[:,-1]**2) # module of test pixel only
+    Arguments:
+        - filename: name of the file containing the sample records
+        - pixels: list of the pixels to read (Default=None, all the pixels)
+        - slice_length: length of the records
+        - verbose: option to print the number of samples
+
+    Returns: an array containing the module of the pixels sliced in records
+    (pixels x records x slice_length)
+    '''
+    i,q=dre_fits.read_iq(filename, verbose, pixels=pixels)
+    module=np.sqrt(i**2+q**2)
     n_samples=len(module)
     n_slices=int(n_samples/slice_length)
-    module=np.resize(module,(n_slices, slice_length))
+    module=module[:n_slices*slice_length].T.reshape(module.shape[1], n_slices, slice_length)
     if verbose:
-        print("    Number of samples: ", len(n_samples))
+        print("    Number of samples: ", n_samples)
     
     return(module)
     
@@ -72,15 +94,47 @@ def pulse_average(pulse_list,remove_outlayers=True):
     """
     
     # Compute the average of the detected pulses and reject 1% worst if requested
-    pulse_list = np.array(pulse_list)
+    pulse_list = np.asarray(pulse_list)
+    mean_pulse = np.mean(pulse_list,0)
     if remove_outlayers:
-        mean_pulse = np.mean(pulse_list,0)
         diff_list = np.sum(abs(pulse_list-mean_pulse),1)
         pulse_list = pulse_list[(diff_list<np.percentile(diff_list,99))]
             
     return mean_pulse, pulse_list
 
 
+# ############################################################
+# Function to create pulse average from batches of records
+# ############################################################
+def pulse_average_stream(records,remove_outlayers=True):
+    """Same as pulse_average for records read by batches (see dre_fits.iter_records).
+    Only one batch is in memory at a time, the records are read once more to find
+    the outlayers.
+    
+    Arguments:
+        - records: function returning a new iterator over the batches of records
+          (channel ids, pixel ids, records, time stamps)
+        - remove_outlayers: if True outlayers are rejected
+        
+    Returns: mean_pulse, kept
+        - mean_pulse: average of the records
+        - kept: boolean mask of the records which are not outlayers
+    """
+    # First pass: average of the records
+    sum_pulse, nb_records = 0, 0
+    for _, _, batch, _ in records():
+        sum_pulse = sum_pulse + batch.sum(0, dtype=float)
+        nb_records += len(batch)
+    mean_pulse = sum_pulse/nb_records
+
+    # Second pass: distance to the average and rejection of the 1% worst
+    kept = np.ones(nb_records, dtype=bool)
+    if remove_outlayers:
+        diff_list = np.concatenate([np.sum(abs(batch-mean_pulse),1) for _, _, batch, _ in records()])
+        kept = diff_list<np.percentile(diff_list,99)
+    return mean_pulse, kept
+
+
 # ############################################################
 # Function to create pulse average
 # ############################################################
@@ -120,37 +174,67 @@ def pulse_average_old(pulse_list,remove_outlayers=False):
 # ############################################################
 # Function to estimate a noise spectrum average
 # ############################################################
-def accumulate_noise_spectra(noise_records,abs_mean=False,rebin=1,normalize=False,dt=6.4e-6):
-    '''Accumulates noise spectra from pulse free data streams
+def accumulate_noise_spectra(noise_records,abs_mean=False,rebin=1,normalize=False,dt=6.4e-6,
+                             window=None,estimator='mean',chunk_size=1024):
+    '''Accumulates noise spectra from pulse free data streams. The spectra are computed
+    with a real FFT on chunks of records (the memory needed does not depend on the number
+    of records) and mirrored to the length of the records.
     
     Arguments:
-        - noise_records: input pulse-free records
-        - pulse_length: length of the records, fft to perform
+        - noise_records: input pulse-free records (one record per line)
         - abs_mean: option to average the abs values instead of the squares
         - rebin: rebinning factor to apply on the final spectrum
         - normalize: option to normalize the spectrum in proper A/rHz units
         - dt: sampling rate of the data (only relevant in case of normalize option)
+        - window: window applied on the records, None (default), name of a numpy window
+          ('hanning', 'hamming', 'blackman', 'bartlett') or array. The window is normalized
+          to keep the noise level.
+        - estimator: 'mean' (default) or 'median' of the records spectra (the median needs
+          the spectra of all the records in memory)
+        - chunk_size: number of records transformed at once (Default=1024)
         
-    Returns: average noise spectra in a np vector of length pulse_length 
+    Returns: noise_spectrum, variance
+        - noise_spectrum: average noise spectrum in a np vector of length pulse_length/rebin
+        - variance: variance over the records of the averaged quantity (squares or abs
+          values of the spectra) in each bin
     '''
+    if estimator not in ('mean', 'median'):
+        raise ValueError("Unknown estimator: {0:s}".format(estimator))
     nb_records=len(noise_records)
     pulse_length=len(noise_records[0])
-    noise_spectrum_tot = np.zeros(int(pulse_length/rebin))
-    nb_noise_estimates=0
-    for i_record in range(nb_records):
-        record=noise_records[i_record]
-        if abs_mean:
-            noise_spectrum_tot+=(abs(np.fft.fft(record))).reshape(-1,rebin).mean(1)
-        else:
-            noise_spectrum_tot+=(abs(np.fft.fft(record))**2).reshape(-1,rebin).mean(1)
-        nb_noise_estimates+=1
-    print("  Number of records used in noise spectrum calibration:",nb_noise_estimates)
-    noise_spectrum_tot/=nb_noise_estimates
+    if window is not None:
+        if isinstance(window, str):
+            window=getattr(np, window)(pulse_length)
+        window=np.asarray(window, dtype=float)/np.sqrt(np.mean(np.asarray(window, dtype=float)**2))
+    # indexes of the full spectrum in the real FFT (negative frequencies are conjugates)
+    mirror=np.concatenate((np.arange(pulse_length//2+1), np.arange((pulse_length+1)//2-1, 0, -1)))
+
+    sum_spectra, sum_squares, spectra = 0, 0, []
+    for first in range(0, nb_records, chunk_size):
+        records=np.asarray(noise_records[first:first+chunk_size], dtype=float)
+        if window is not None:
+            records=records*window
+        chunk=abs(np.fft.rfft(records, axis=1))[:, mirror]
+        if not abs_mean:
+            chunk=chunk**2
+        chunk=chunk.reshape(len(chunk), -1, rebin).mean(2)
+        sum_spectra=sum_spectra+chunk.sum(0)
+        sum_squares=sum_squares+(chunk**2).sum(0)
+        if estimator=='median':
+            spectra.append(chunk)
+    print("  Number of records used in noise spectrum calibration:",nb_records)
+    if estimator=='median':
+        noise_spectrum_tot=np.median(np.concatenate(spectra), axis=0)
+    else:
+        noise_spectrum_tot=sum_spectra/nb_records
+    variance=np.maximum(sum_squares/nb_records-(sum_spectra/nb_records)**2, 0)
     if not abs_mean:
         noise_spectrum_tot = np.sqrt(noise_spectrum_tot)
     if normalize:
-        noise_spectrum_tot*=np.sqrt(2*dt/pulse_length)
-    return noise_spectrum_tot
+        factor=np.sqrt(2*dt/pulse_length)
+        noise_spectrum_tot*=factor
+        variance*=factor**2 if abs_mean else factor**4
+    return noise_spectrum_tot, variance
 
 
 # ############################################################
@@ -214,6 +298,81 @@ def do_pulse_jitter(opt_filter,pulse_record):
     return energy,pulse_phase+phase_offset
 
 
+# ############################################################
+# Function to perform the "jitter parabola fit" on a set of pulses
+# ############################################################
+def do_pulse_jitter_batch(opt_filter,pulse_records,phase_offset=5,chunk_size=1024):
+    '''Vectorised version of do_pulse_jitter. The correlation between the optimal filter
+    and the records is computed at all the possible phase offsets for a whole set of pulses
+    (FFT correlation), then the same +-1 jitter search and parabola fit are done with array
+    operations.
+    
+    Arguments:
+        - opt_filter: optimal filter
+        - pulse_records: 2 dimensional array containing the data streams to analyze (one record per line)
+        - phase_offset: initial phase offset of the search (default=5)
+        - chunk_size: number of records processed at once (bounds the memory, default=1024)
+
+    Returns: energies, phases, failed
+        - energies: reconstructed energies (-1 when no phase has been found)
+        - phases: arrival phases of the pulses
+        - failed: boolean mask, True when no phase has been found
+    '''
+    pulse_records = np.asarray(pulse_records)
+    nb_pulses, record_length = pulse_records.shape
+    pulse_length = len(opt_filter)
+    n_offsets = record_length-pulse_length+1 # number of possible phase offsets
+    energies = -1*np.ones(nb_pulses)
+    phases = np.zeros(nb_pulses)
+    failed = np.ones(nb_pulses, dtype=bool)
+    if n_offsets < 3:
+        print('Problem to find the phase of the pulse!')
+        return energies, phases, failed
+
+    # Correlation (no wrapping for the offsets 0 to n_offsets-1)
+    filter_f = np.conj(np.fft.rfft(opt_filter, record_length))
+    all_pulses = np.arange(nb_pulses)
+    offsets = phase_offset*np.ones(nb_pulses, dtype=int)
+    corr = np.zeros((nb_pulses, n_offsets))
+    for first in range(0, nb_pulses, chunk_size):
+        records_f = np.fft.rfft(pulse_records[first:first+chunk_size], axis=1)
+        corr[first:first+chunk_size] = np.fft.irfft(records_f*filter_f, record_length, axis=1)[:, :n_offsets]
+
+    # Iterative search of the local maximum (energy2 shall be greater than energy1 and energy3)
+    running = np.ones(nb_pulses, dtype=bool)
+    while running.any():
+        out = running & ((offsets<0) | (offsets+2>=n_offsets))
+        running &= ~out
+        i = all_pulses[running]
+        energy1 = corr[i, offsets[i]]
+        energy2 = corr[i, offsets[i]+1]
+        energy3 = corr[i, offsets[i]+2]
+        left = energy1>energy2
+        right = ~left & (energy3>energy2)
+        offsets[i[left]] -= 1
+        offsets[i[right]] += 1
+        done = i[~left & ~right]
+        running[done] = False
+        failed[done] = False
+
+    nb_failed = failed.sum()
+    if nb_failed > 0:
+        print('Problem to find the phase of {0:d} pulse(s)!'.format(nb_failed))
+
+    # Parabola fit
+    i = all_pulses[~failed]
+    energy1 = corr[i, offsets[i]]
+    energy2 = corr[i, offsets[i]+1]
+    energy3 = corr[i, offsets[i]+2]
+    A = 0.5*(energy1-2*energy2+energy3)
+    B = 0.5*(energy3-energy1)
+    C = energy2
+    energies[i] = C-.25*B**2/A
+    phases[i] = -.5*B/A+offsets[i]
+
+    return energies, phases, failed
+
+
 # ############################################################
 # Gaussian function
 # ############################################################
@@ -294,6 +453,61 @@ def apply_baseline_correction(energies,baseline,baseline_correction):
     return energies_corrected, baseline_correc_poly
 
 
+# ############################################################
+# Function to perform energy reconstruction on a set of pulses
+# ############################################################
+def energy_reconstruction_batch(pulse_list,optimal_filter,prebuffer=PREBUFF,prebuff_exclusion=10):
+    """Perform energy reconstruction on a set of pulses at once, including jitter correction.
+    Also compute baseline value before each pulse
+    
+    Arguments:
+        - pulse_list: list (or 2 dimensional array) of pulses to reconstruct
+        - optimal_filter: filter to use for reconstruction
+        - prebuffer: length of prebuffer data available before each pulse
+        - prebuff_exclusion: number of points to remove from the buffer in baseline estimation 
+        
+    Returns: energies, phases, baselines, failed
+        - energies, phases, baselines: one value per pulse
+        - failed: boolean mask, True for the pulses whose phase has not been found
+    """
+    pulse_list = np.asarray(pulse_list)
+    energies, phases, failed = do_pulse_jitter_batch(optimal_filter, pulse_list)
+    baselines = pulse_list[:,:prebuffer-prebuff_exclusion].mean(axis=1)
+    return energies, phases, baselines, failed
+
+
+# ############################################################
+# Function to perform energy reconstruction on batches of pulses
+# ############################################################
+def energy_reconstruction_stream(records,kept,optimal_filters,prebuffer=PREBUFF,prebuff_exclusion=10):
+    """Perform energy reconstruction on records read by batches (see dre_fits.iter_records),
+    with several optimal filters in a single reading of the records.
+    
+    Arguments:
+        - records: function returning a new iterator over the batches of records
+        - kept: boolean mask of the records to reconstruct
+        - optimal_filters: list of filters to use for reconstruction
+        - prebuffer: length of prebuffer data available before each pulse
+        - prebuff_exclusion: number of points to remove from the buffer in baseline estimation 
+        
+    Returns: a list with the energies, phases and baselines obtained with each filter
+    (the pulses for which no optimal phase has been found are removed)
+    """
+    results = [[] for _ in optimal_filters]
+    first = 0
+    for _, _, batch, _ in records():
+        pulses = batch[kept[first:first+len(batch)]]
+        first += len(batch)
+        for i_filter, optimal_filter in enumerate(optimal_filters):
+            results[i_filter].append(energy_reconstruction_batch(pulses, optimal_filter, prebuffer, prebuff_exclusion))
+
+    reconstructions = []
+    for batches in results:
+        energies, phases, baselines, failed = [np.concatenate(values) for values in zip(*batches)]
+        reconstructions.append((energies[~failed], phases[~failed], baselines[~failed]))
+    return reconstructions
+
+
 # ############################################################
 # Function to perform energy reconstruction
 # ############################################################
@@ -311,23 +525,14 @@ def energy_reconstruction(pulse_list,optimal_filter,prebuffer=PREBUFF,prebuff_ex
     Returns: pulse_template 
         - 
     """
-    # Iterate over available pulses
-    energies = []
-    phases = []
-    times = []
-    baselines = []
-    for i_pulse in range (len(pulse_list)):
-        # Perform reconstruction with jitter
-        e,p = do_pulse_jitter(optimal_filter, pulse_list[i_pulse])
-        if e!=-1:  # an optimal phase has been found
-            energies.append(e)
-            phases.append(p)
-            # Estimate baseline
-            baselines.append(pulse_list[i_pulse][:prebuffer-prebuff_exclusion].mean())
-             
-    energies = np.array(energies)
-    phases = np.array(phases)
-    baselines = np.array(baselines)
+    # Reconstruct all the pulses at once
+    energies, phases, baselines, failed = energy_reconstruction_batch(pulse_list, optimal_filter, \
+                                                                      prebuffer, prebuff_exclusion)
+
+    # Keep only the pulses for which an optimal phase has been found
+    energies = energies[~failed]
+    phases = phases[~failed]
+    baselines = baselines[~failed]
     
     # Return energies, phases and times
     return energies, phases, baselines
@@ -336,9 +541,12 @@ def energy_reconstruction(pulse_list,optimal_filter,prebuffer=PREBUFF,prebuff_ex
 # ############################################################
 # Function to perform all the operations needed to compute the optimal filters
 # ############################################################
-def do_EP_filter(file_noise, file_pulses, file_xifusim_template, file_xifusim_tes_noise, plotdirname, verbose=False, do_plots=True):
+def do_EP_filter(file_noise, file_pulses, file_xifusim_template, file_xifusim_tes_noise, plotdirname, verbose=False, do_plots=True, cachedirname=None):
     """Perform the operations to compute the optimal filters (with and without tes noise)
     and compares the results with xifusim.
+    If a cache directory is given, the filters, the template and the spectra are stored in
+    a npz artefact keyed on the content of the 4 input files, and they are reloaded from it
+    (the whole filter construction is skipped) when the input files have not changed.
     
     Arguments:
         - file_noise: fits file containing DRE noise data
@@ -348,10 +556,21 @@ def do_EP_filter(file_noise, file_pulses, file_xifusim_template, file_xifusim_te
         - plotdirname: location of plotfiles
         - verbose: if True some informations are printed (Default=False)
         - do_plots: if True a plot is done with all the intermediate results (Default=True)
+        - cachedirname: location of the cache of filters (Default=None, no cache)
         
     Returns: optimal_filter (no TES noise), optimal_filter_tot (with TES noise)       
     """
  
+    # ############################################################
+    # Looking for the filters in the cache
+    # ############################################################
+    if cachedirname is not None:
+        cache_key = general_tools.get_cache_key([file_noise, file_pulses, file_xifusim_template, file_xifusim_tes_noise])
+        cached = general_tools.cache_load(cachedirname, 'EP_FILTER', cache_key)
+        if cached is not None:
+            print("\nOptimal filters loaded from the cache (key {0:s})".format(cache_key))
+            return(cached['optimal_filter'], cached['optimal_filter_tot'])
+
     # ############################################################
     # Noise spectrum calibration
     # ############################################################
@@ -364,8 +583,7 @@ def do_EP_filter(file_noise, file_pulses, file_xifusim_template, file_xifusim_te
     print("  Record length = {0:4d}".format(record_length))
         
     # Compute average noise spectrum
-    noise_spectrum = accumulate_noise_spectra(noise_data, normalize=True)
-    np.save('noise_spectrum.npy', noise_spectrum)
+    noise_spectrum, _ = accumulate_noise_spectra(noise_data, normalize=True)
     frequencies = np.fft.fftfreq(record_length,6.4e-6)[1:int(record_length/2)]
     if verbose:
         print("  Noise spectrum:",noise_spectrum)
@@ -375,15 +593,17 @@ def do_EP_filter(file_noise, file_pulses, file_xifusim_template, file_xifusim_te
     # ############################################################
         print("\nPerforming pulse template calibration...")
     
-    # Load pulse data to be used for template calibration
+    # Load pulse data to be used for template calibration (read by batches)
     print("  Loading calibration pulse data from file ", file_pulses)
-    _, _, pulse_list, pulse_times=dre_fits.read_records(file_pulses, verbose=verbose)
-    print("  Record length = {0:4d}, reduced to {1:4d}".format(len(pulse_list[0]), record_length))
-    delta=len(pulse_list[0])-record_length
-    pulse_list=pulse_list[:, int(delta/2):record_length+int(delta/2)] # pulse records are longuer than noise records (by 2)
-
-    # Generate pulse template as average of detected pulses (and removing outlayers)
-    pulse_template, pulse_list = pulse_average(pulse_list,remove_outlayers=True)
+    _, pulse_length = dre_fits.get_records_shape(file_pulses, verbose=verbose)
+    print("  Record length = {0:4d}, reduced to {1:4d}".format(pulse_length, record_length))
+    delta=pulse_length-record_length
+    # pulse records are longuer than noise records (by 2)
+    records = lambda: dre_fits.iter_records(file_pulses, start=int(delta/2), stop=record_length+int(delta/2))
+
+    # Generate pulse template as average of detected pulses (the outlayers are not
+    # removed from the average)
+    pulse_template, _ = pulse_average_stream(records,remove_outlayers=False)
     if verbose:
         print("  Pulse template: ",pulse_template)
 
@@ -559,6 +779,21 @@ def do_EP_filter(file_noise, file_pulses, file_xifusim_template, file_xifusim_te
 
         fig.tight_layout()
         plt.savefig(os.path.join(plotdirname,'PLOT_E_RESOL_TEMPLATES.png'),bbox_inches='tight')
+        plt.close()
+
+    # ############################################################
+    # Storing the filters in the cache
+    # ############################################################
+    if cachedirname is not None:
+        general_tools.cache_save(cachedirname, 'EP_FILTER', cache_key, {
+            'optimal_filter': optimal_filter,
+            'optimal_filter_tot': optimal_filter_tot,
+            'pulse_template': pulse_template,
+            'noise_spectrum': noise_spectrum,
+            'tes_noise': tes_noise,
+            'total_noise': total_noise,
+            'xifusim_PS': xifusim_PS,
+            'DRE_PS': DRE_PS})
 
     return(optimal_filter, optimal_filter_tot)
 
@@ -687,6 +922,7 @@ def plot_er(NONLINEAR_FACTOR,array_to_fit1,bins1,coeffs1,axe_fit1,hist_fit1,base
 
     fig.tight_layout()
     plt.savefig(plotfilename,bbox_inches='tight')
+    plt.close()
 
 
 # ############################################################
@@ -715,16 +951,19 @@ def measure_er(file_measures, optimal_filter, optimal_filter_tot, pixeldirname,
     NONLINEAR_FACTOR=get_nonlinear_factor(pixeldirname, verbose=verbose)
     print("  Loading pixel non linearity factor at 7keV: ", NONLINEAR_FACTOR)
 
-    # Load pulse data containing the events to reconstruct
+    # Load pulse data containing the events to reconstruct (read by batches)
     print("  Loading measured pulse data from file ", file_measures)
-    _, _, pulse_list, _=dre_fits.read_records(file_measures, verbose=verbose)
-    print("  Record length = {0:4d}".format(len(pulse_list[0])))
+    _, pulse_length = dre_fits.get_records_shape(file_measures, verbose=verbose)
+    print("  Record length = {0:4d}".format(pulse_length))
+    records = lambda: dre_fits.iter_records(file_measures)
 
     # Removing outlayers
-    _, pulse_list = pulse_average(pulse_list,remove_outlayers=True)
+    _, kept = pulse_average_stream(records,remove_outlayers=True)
         
-    # Compute first energy estimates
-    energies,phases,baselines = energy_reconstruction(pulse_list, optimal_filter, PREBUFF, JITTER_MARGIN)
+    # Compute first energy estimates (with both filters)
+    reconstruction, reconstruction_tot = energy_reconstruction_stream(records, kept, \
+        [optimal_filter, optimal_filter_tot], PREBUFF, JITTER_MARGIN)
+    energies,phases,baselines = reconstruction
 
     coeffs1, array_to_fit1, bins1, axe_fit1, hist_fit1 = hist_and_fit((energies-7)*1000, 100)
     print("Resolution without TES noise (prior correction): {0:5.3f}eV".format(coeffs1[2]*2.355*NONLINEAR_FACTOR))
@@ -753,8 +992,8 @@ def measure_er(file_measures, optimal_filter, optimal_filter_tot, pixeldirname,
     # ############################################################
     print("\nReconstruction with OF including TES noise...")
         
-    # Compute first energy estimates
-    energies,phases,baselines = energy_reconstruction(pulse_list, optimal_filter_tot, PREBUFF, JITTER_MARGIN)
+    # First energy estimates
+    energies,phases,baselines = reconstruction_tot
 
     coeffs1, array_to_fit1, bins1, axe_fit1, hist_fit1 = hist_and_fit((energies-7)*1000, 100)
     print("Resolution without TES noise (prior correction): {0:5.3f}eV".format(coeffs1[2]*2.355*NONLINEAR_FACTOR))
@@ -782,7 +1021,72 @@ def measure_er(file_measures, optimal_filter, optimal_filter_tot, pixeldirname,
 
 
 # ############################################################
-def ep(fulldirname, config, verbose=False):
+# Parallel pulse reconstruction
+# ############################################################
+def init_er_worker(shm_name, shape):
+    '''Initialises a process measuring the energy resolution: the optimal filters
+    are read from a shared memory block (they are not copied for each file).
+
+    Arguments:
+        - shm_name: name of the shared memory block
+        - shape: shape of the array of filters (2 x filter length)
+    '''
+    plot_tools.init_worker()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _shared_filters['shm'] = shm
+    _shared_filters['filters'] = np.ndarray(shape, dtype=float, buffer=shm.buf)
+
+
+def measure_er_shared(file_measures, pixeldirname, plotdirname, index, verbose=False, do_plots=True):
+    '''Same as measure_er with the optimal filters of the shared memory block
+    (see init_er_worker).
+    '''
+    filters = _shared_filters['filters']
+    return(measure_er(file_measures, filters[0], filters[1], pixeldirname, plotdirname, index, verbose, do_plots))
+
+
+def measure_er_files(list_file_measures, optimal_filter, optimal_filter_tot, pixeldirname, plotdirname, verbose=False, \
+                     do_plots=True, n_workers=None):
+    '''Measures the energy resolution on several files. The files are processed by a pool
+    of processes, the optimal filters are given to the processes through shared memory.
+
+    Arguments:
+        - list_file_measures: names of the files containing the events (with the path)
+        - optimal_filter, optimal_filter_tot: optimal filters (without and with the TES noise)
+        - pixeldirname: directory containing pixel's informations
+        - plotdirname: location of plotfiles
+        - verbose: if True some informations are printed (Default=False)
+        - do_plots: if True the plots are done (Default=True)
+        - n_workers: number of processes (Default=None, number of cores). If n_workers
+          is 1 the files are processed in the current process.
+
+    Returns: the list of the (eres, eres_error) values, in the order of the files
+    '''
+    nfiles = len(list_file_measures)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, nfiles))
+    if n_workers == 1:
+        return([measure_er(file_measures, optimal_filter, optimal_filter_tot, pixeldirname, plotdirname, index, \
+                           verbose, do_plots) for index, file_measures in enumerate(list_file_measures)])
+
+    filters = np.array([optimal_filter, optimal_filter_tot], dtype=float)
+    shm = shared_memory.SharedMemory(create=True, size=filters.nbytes)
+    try:
+        np.ndarray(filters.shape, dtype=float, buffer=shm.buf)[:] = filters
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_er_worker, \
+                                 initargs=(shm.name, filters.shape)) as executor:
+            # map returns the results in the order of the files
+            results = list(executor.map(measure_er_shared, list_file_measures, [pixeldirname]*nfiles, \
+                [plotdirname]*nfiles, range(nfiles), [verbose]*nfiles, [do_plots]*nfiles))
+    finally:
+        shm.close()
+        shm.unlink()
+    return(results)
+
+
+# ############################################################
+def ep(fulldirname, config, verbose=False, n_workers=None):
     """Perform the operations to measure the energy resolution (with and without tes noise).
     
     Arguments:
@@ -795,6 +1099,9 @@ def ep(fulldirname, config, verbose=False):
         verbose: boolean
         If True some informations are printed (Default=False)
 
+        n_workers: number
+        Number of processes measuring the energy resolution (Default=None, number of cores)
+
     Returns:
         eres_ok: boolean
         True if DRE energy resolution contribution is below the requirement       
@@ -803,6 +1110,7 @@ def ep(fulldirname, config, verbose=False):
     datadirname = os.path.join(fulldirname, config['dir_data'])
     plotdirname = os.path.join(fulldirname, config['dir_plots'])
     general_tools.checkdir(plotdirname)
+    logdirname = os.path.join(fulldirname, config['dir_logs'])
     pixeldirname = os.path.normcase("./Pixel_data_LPA75um_AR0.5/")
     file_xifusim_template = os.path.join(pixeldirname,"pulse_withBBFB.npy")
     file_xifusim_tes_noise = os.path.join(pixeldirname,"noise_spectra_bbfb_noFBDAC.fits")
@@ -811,24 +1119,16 @@ def ep(fulldirname, config, verbose=False):
     eres_mean = np.inf
 
     # searching data files
-    f_type_deb = 15
-    list_file_pulses = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[f_type_deb:]=="_mk_EP_filter_events_record.fits"]
-    f_type_deb = 15
-    list_file_noise = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[f_type_deb:]=="_mk_EP_filter_noise_record.fits"]
-    f_type_deb = 15
-    list_file_measures = [f for f in os.listdir(datadirname) \
-                if os.path.isfile(os.path.join(datadirname, f)) \
-                and f[f_type_deb:]=="_meas_E_resol_events_record.fits"]
+    list_file_pulses = session_index.get_files(datadirname, suffix="_mk_EP_filter_events_record.fits")
+    list_file_noise = session_index.get_files(datadirname, suffix="_mk_EP_filter_noise_record.fits")
+    list_file_measures = session_index.get_files(datadirname, suffix="_meas_E_resol_events_record.fits")
 
     # Computing EP filter
     if len(list_file_pulses)==1 and len(list_file_noise)==1:
         file_pulses=os.path.join(datadirname, list_file_pulses[0])
         file_noise=os.path.join(datadirname, list_file_noise[0])
-        optimal_filter, optimal_filter_tot=do_EP_filter(file_noise, file_pulses, file_xifusim_template, file_xifusim_tes_noise, plotdirname, verbose)
+        optimal_filter, optimal_filter_tot=do_EP_filter(file_noise, file_pulses, file_xifusim_template, file_xifusim_tes_noise, plotdirname, verbose, \
+                                                        cachedirname=logdirname)
         EP_filter_exist=True
     else:
         print("No file available for EP processing")
@@ -841,19 +1141,304 @@ def ep(fulldirname, config, verbose=False):
         summary_file.write(";Energy resolution (with TES noise);Error;Unit;\n")
         index=0
         eres_list=[]
-        for file_measures_name in list_file_measures:
-            file_measures_fullname=os.path.join(datadirname, file_measures_name)
-            eres, eres_error=measure_er(file_measures_fullname, optimal_filter, optimal_filter_tot, pixeldirname, plotdirname, index, verbose)
+        records=[]
+        # the files are processed concurrently, the results are in the order of the files
+        results=measure_er_files([os.path.join(datadirname, name) for name in list_file_measures], \
+                                 optimal_filter, optimal_filter_tot, pixeldirname, plotdirname, verbose, n_workers=n_workers)
+        for file_measures_name, (eres, eres_error) in zip(list_file_measures, results):
             eres_list.append(eres)
             summary_file.write(";{0:6.4f};{1:6.4f};eV;\n".format(eres,eres_error))
+            records+=[('energy_resolution', file_measures_name, eres, 'eV'), \
+                      ('energy_resolution_error', file_measures_name, eres_error, 'eV')]
             index+=1
         eres_mean=np.array(eres_list).mean()
         summary_file.write("Mean value;{0:6.4f};;eV;\n".format(eres_mean))
+        records.append(('mean_energy_resolution', '', eres_mean, 'eV'))
         if index>1:
             summary_file.write("Standard dev.;{0:6.4f};;eV;\n".format(np.array(eres_list).std()))
+            records.append(('std_energy_resolution', '', np.array(eres_list).std(), 'eV'))
         summary_file.close()
+        records.append(('eres_ok', '', eres_mean<config['eres_req_cbe_dre_7kev'], ''))
+        results_store.record(fulldirname, config, 'ep', records)
 
     return(eres_mean<config['eres_req_cbe_dre_7kev'])
 
 # ############################################################
+# Multi-pixel energy resolution
+# ############################################################
+def pulse_average_groups(records):
+    """Creates the average pulse of each (channel, pixel) in a single reading of the records
+    (see dre_fits.iter_records). The outlayers are not removed.
+    
+    Arguments:
+        - records: function returning a new iterator over the batches of records
+          (channel ids, pixel ids, records, time stamps)
+        
+    Returns: templates, counts
+        - templates: dictionnary (channel, pixel) -> average pulse
+        - counts: dictionnary (channel, pixel) -> number of records
+    """
+    sums, counts = {}, {}
+    for chid, pixid, batch, _ in records():
+        groups = np.stack((chid, pixid), axis=1).astype(int)
+        for group in np.unique(groups, axis=0):
+            rows = np.all(groups==group, axis=1)
+            key = (int(group[0]), int(group[1]))
+            sums[key] = sums.get(key, 0) + batch[rows].sum(0, dtype=float)
+            counts[key] = counts.get(key, 0) + int(rows.sum())
+    templates = {key: sums[key]/counts[key] for key in sorted(sums.keys())}
+    return templates, counts
+
+
+def do_EP_filters_pixels(file_noise, file_pulses, file_xifusim_template, file_xifusim_tes_noise, verbose=False, cachedirname=None):
+    """Computes the optimal filters (with and without tes noise) of every (channel, pixel)
+    of the calibration pulse file. The noise IQ file has no channel information: the noise
+    spectrum of a pixel is used for the pixels with the same number in all the channels.
+    The pixels which are not active in the noise file are ignored.
+    
+    Arguments:
+        - file_noise: fits file containing DRE noise data
+        - file_pulses: fits file containing DRE pulses data
+        - file_xifusim_template: file containing xifusim template
+        - file_xifusim_tes_noise: file containing tes noise compute by xifusim
+        - verbose: if True some informations are printed (Default=False)
+        - cachedirname: location of the cache of filters (Default=None, no cache)
+        
+    Returns: groups, filters
+        - groups: array of the (channel, pixel) of the filters (n x 2)
+        - filters: array of the optimal filters, without and with TES noise (n x 2 x length)
+    """
+    if cachedirname is not None:
+        cache_key = general_tools.get_cache_key([file_noise, file_pulses, file_xifusim_template, file_xifusim_tes_noise])
+        cached = general_tools.cache_load(cachedirname, 'EP_FILTERS_PIXELS', cache_key)
+        if cached is not None:
+            print("\nOptimal filters of the pixels loaded from the cache (key {0:s})".format(cache_key))
+            return(cached['groups'], cached['filters'])
+
+    # Templates of all the pixels (one reading of the calibration file)
+    print("\nPerforming pulse template calibration of the pixels...")
+    _, pulse_length = dre_fits.get_records_shape(file_pulses, verbose=verbose)
+    print("  Loading noise data from file ", file_noise)
+    all_pixels = list(range(params.npix))
+    noise_data = get_module_from_iqfits(file_noise, all_pixels, verbose=verbose)
+    record_length = noise_data.shape[2]
+    delta = pulse_length-record_length
+    records = lambda: dre_fits.iter_records(file_pulses, start=int(delta/2), stop=record_length+int(delta/2))
+    templates, counts = pulse_average_groups(records)
+
+    # Noise spectra of the pixels used by the templates
+    print("\nPerforming noise spectrum calibration of the pixels...")
+    noise_spectra = {}
+    for pixel in sorted(set([pixel for _, pixel in templates.keys()])):
+        if np.any(noise_data[pixel]!=0):    # the module of inactive pixels is null
+            noise_spectra[pixel], _ = accumulate_noise_spectra(noise_data[pixel], normalize=True)
+
+    xifusim_time,xifusim_template = np.load(file_xifusim_template)
+    tes_noise_csd = fits.getdata(file_xifusim_tes_noise,"SPEC{0:04d}".format(record_length))["CSD"]
+
+    print('\nComputing optimal filters of the pixels...')
+    groups, filters = [], []
+    for (channel, pixel), pulse_template in templates.items():
+        if pixel not in noise_spectra:
+            print("  Channel {0:d} pixel {1:2d}: no noise data, pixel ignored".format(channel, pixel))
+            continue
+        noise_spectrum = noise_spectra[pixel]
+        baseline_scaling = pulse_template[0]/xifusim_template[0]
+        total_noise = np.sqrt((tes_noise_csd*baseline_scaling)**2+noise_spectrum**2)
+        groups.append((channel, pixel))
+        filters.append((compute_optimal_filter(pulse_template,noise_spectrum,7.), \
+                        compute_optimal_filter(pulse_template,total_noise,7.)))
+        if verbose:
+            print("  Channel {0:d} pixel {1:2d}: {2:6d} calibration pulses".format(channel, pixel, counts[(channel, pixel)]))
+    groups = np.array(groups, dtype=int).reshape(-1, 2)
+    filters = np.array(filters, dtype=float).reshape(len(groups), 2, record_length)
+
+    if cachedirname is not None:
+        general_tools.cache_save(cachedirname, 'EP_FILTERS_PIXELS', cache_key, {'groups': groups, 'filters': filters})
+
+    return(groups, filters)
+
+
+def measure_er_pixel(list_file_measures, channel, pixel, optimal_filter, nonlinear_factor):
+    """Measures the energy resolution of a pixel on the pulses of several files (only the
+    records of the pixel are read). The baseline and the phase corrections are applied.
+    
+    Arguments:
+        - list_file_measures: names of the files containing the events (with the path)
+        - channel, pixel: the pixel
+        - optimal_filter: optimal filter of the pixel
+        - nonlinear_factor: pixel non linearity factor at 7keV
+        
+    Returns: eres, eres_error, counts (the resolution is nan if the pixel has less than
+    MIN_COUNTS pulses or if the fit has failed)
+    """
+    bcorr=3 # Order of polynomial baseline correction
+    pcorr=8 # Order of polynomial arrival phase correction
+    records = lambda: itertools.chain.from_iterable( \
+        [dre_fits.iter_records(file_measures, channels=[channel], pixels=[pixel]) for file_measures in list_file_measures])
+
+    nb_records = sum([len(batch) for _, _, batch, _ in records()])
+    if nb_records < MIN_COUNTS:
+        return(np.nan, np.nan, nb_records)
+
+    _, kept = pulse_average_stream(records,remove_outlayers=True)
+    (energies,phases,baselines), = energy_reconstruction_stream(records, kept, [optimal_filter], PREBUFF, JITTER_MARGIN)
+    if len(energies) < MIN_COUNTS:
+        return(np.nan, np.nan, len(energies))
+    try:
+        energies_c_bl, _ = apply_baseline_correction(energies, baselines, bcorr)
+        energies_c_ph, _ = apply_phase_correction(energies_c_bl, phases, pcorr)
+        coeffs, _, _, _, _ = hist_and_fit((energies_c_ph-7)*1000, 100)
+    except RuntimeError:
+        print("  Channel {0:d} pixel {1:2d}: fit failed".format(channel, pixel))
+        return(np.nan, np.nan, len(energies))
+    eres = abs(coeffs[2])*2.355*nonlinear_factor
+    return(eres, eres/(np.sqrt(2.*len(energies))), len(energies))
+
+
+def measure_er_pixel_shared(list_file_measures, i_group, channel, pixel, nonlinear_factor):
+    """Same as measure_er_pixel with the optimal filter (with TES noise) of the shared
+    memory block (see init_er_worker).
+    """
+    return(measure_er_pixel(list_file_measures, channel, pixel, _shared_filters['filters'][i_group,1], nonlinear_factor))
+
+
+def measure_er_pixels(list_file_measures, groups, filters, nonlinear_factor, n_workers=None):
+    """Measures the energy resolution of several pixels. The pixels are processed by a
+    pool of processes, the optimal filters are given to the processes through shared memory.
+    
+    Arguments:
+        - list_file_measures: names of the files containing the events (with the path)
+        - groups: array of the (channel, pixel) of the filters (n x 2)
+        - filters: array of the optimal filters, without and with TES noise (n x 2 x length)
+        - nonlinear_factor: pixel non linearity factor at 7keV
+        - n_workers: number of processes (Default=None, number of cores). If n_workers
+          is 1 the pixels are processed in the current process.
+        
+    Returns: the list of the (eres, eres_error, counts) values, in the order of the groups
+    """
+    ngroups = len(groups)
+    if ngroups == 0:
+        return([])
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, ngroups))
+    if n_workers == 1:
+        return([measure_er_pixel(list_file_measures, channel, pixel, filters[i_group,1], nonlinear_factor) \
+                for i_group, (channel, pixel) in enumerate(groups)])
+
+    filters = np.ascontiguousarray(filters, dtype=float)
+    shm = shared_memory.SharedMemory(create=True, size=filters.nbytes)
+    try:
+        np.ndarray(filters.shape, dtype=float, buffer=shm.buf)[:] = filters
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_er_worker, \
+                                 initargs=(shm.name, filters.shape)) as executor:
+            results = list(executor.map(measure_er_pixel_shared, [list_file_measures]*ngroups, range(ngroups), \
+                [int(channel) for channel in groups[:,0]], [int(pixel) for pixel in groups[:,1]], [nonlinear_factor]*ngroups))
+    finally:
+        shm.close()
+        shm.unlink()
+    return(results)
+
+
+def plot_er_pixels(eres_map, plotfilename):
+    """Plots the energy resolution of the pixels as a channel x pixel map.
+    
+    Arguments:
+        - eres_map: energy resolution of the pixels (channels x pixels, nan if not measured)
+        - plotfilename: name of the plot file
+    """
+    fig = plt.figure(figsize=(12, 2+eres_map.shape[0]))
+    ax = fig.add_subplot(1,1,1)
+    image = ax.imshow(np.ma.masked_invalid(eres_map), aspect='auto', origin='lower', cmap='viridis')
+    for channel, pixel in zip(*np.where(~np.isnan(eres_map))):
+        ax.text(pixel, channel, "{0:.2f}".format(eres_map[channel, pixel]), ha='center', va='center', fontsize=5, color='w')
+    ax.set_xticks(np.arange(eres_map.shape[1]))
+    ax.set_yticks(np.arange(eres_map.shape[0]))
+    ax.set_xlabel('Pixel')
+    ax.set_ylabel('Channel')
+    ax.set_title('Energy resolution with TES noise [eV]')
+    for item in (ax.get_xticklabels() + ax.get_yticklabels()):
+        item.set_fontsize(6)
+    fig.colorbar(image, ax=ax)
+    fig.tight_layout()
+    plt.savefig(plotfilename,bbox_inches='tight')
+    plt.close()
+
+
+# ############################################################
+def ep_pixels(fulldirname, config, verbose=False, n_workers=None):
+    """Measures the energy resolution of every active pixel of all the channels (with tes noise).
+    Each pixel has its own template and optimal filter.
+    
+    Arguments:
+        fulldirname: string
+        The name of the directory containing the data files
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        verbose: boolean
+        If True some informations are printed (Default=False)
+
+        n_workers: number
+        Number of processes measuring the energy resolution (Default=None, number of cores)
+
+    Returns:
+        eres: array
+        Energy resolution of the pixels (channels x pixels, nan if not measured)
+    """
+    datadirname = os.path.join(fulldirname, config['dir_data'])
+    plotdirname = os.path.join(fulldirname, config['dir_plots'])
+    general_tools.checkdir(plotdirname)
+    logdirname = os.path.join(fulldirname, config['dir_logs'])
+    pixeldirname = os.path.normcase("./Pixel_data_LPA75um_AR0.5/")
+    file_xifusim_template = os.path.join(pixeldirname,"pulse_withBBFB.npy")
+    file_xifusim_tes_noise = os.path.join(pixeldirname,"noise_spectra_bbfb_noFBDAC.fits")
+
+    eres_map = np.full((params.nchan, params.npix), np.nan)
+
+    # searching data files
+    list_file_pulses = session_index.get_files(datadirname, suffix="_mk_EP_filter_events_record.fits")
+    list_file_noise = session_index.get_files(datadirname, suffix="_mk_EP_filter_noise_record.fits")
+    list_file_measures = session_index.get_files(datadirname, suffix="_meas_E_resol_events_record.fits")
+    if len(list_file_pulses)!=1 or len(list_file_noise)!=1 or len(list_file_measures)==0:
+        print("No file available for multi-pixel EP processing")
+        return(eres_map)
+
+    # Computing the EP filters of the pixels
+    groups, filters = do_EP_filters_pixels(os.path.join(datadirname, list_file_noise[0]), \
+        os.path.join(datadirname, list_file_pulses[0]), file_xifusim_template, file_xifusim_tes_noise, \
+        verbose, cachedirname=logdirname)
+
+    # Measuring the energies of the pixels (the pixels are processed concurrently)
+    nonlinear_factor = get_nonlinear_factor(pixeldirname, verbose=verbose)
+    results = measure_er_pixels([os.path.join(datadirname, name) for name in list_file_measures], \
+                                groups, filters, nonlinear_factor, n_workers)
+
+    if len(groups) > 0:
+        eres_map = np.full((max(params.nchan, groups[:,0].max()+1), params.npix), np.nan)
+    summary_file_name=os.path.join(plotdirname, "er_pixels_results.csv")
+    records=[]
+    with open(summary_file_name, "w") as summary_file:
+        summary_file.write("Channel;Pixel;Counts;Energy resolution (with TES noise);Error;Unit;\n")
+        for (channel, pixel), (eres, eres_error, counts) in zip(groups, results):
+            eres_map[channel, pixel] = eres
+            summary_file.write("{0:d};{1:d};{2:d};{3:6.4f};{4:6.4f};eV;\n".format(channel, pixel, counts, eres, eres_error))
+            item = 'ch{0:d}_pix{1:02d}'.format(channel, pixel)
+            records+=[('energy_resolution', item, eres, 'eV'), ('energy_resolution_error', item, eres_error, 'eV'), \
+                      ('counts', item, counts, '')]
+        measured = eres_map[~np.isnan(eres_map)]
+        if len(measured) > 0:
+            summary_file.write("Mean value;;;{0:6.4f};;eV;\n".format(measured.mean()))
+            summary_file.write("Standard dev.;;;{0:6.4f};;eV;\n".format(measured.std()))
+            records+=[('mean_energy_resolution', '', measured.mean(), 'eV'), \
+                      ('std_energy_resolution', '', measured.std(), 'eV')]
+    records.append(('nb_pixels', '', len(measured), ''))
+    results_store.record(fulldirname, config, 'ep_pixels', records)
+
+    plot_tools.submit(plot_er_pixels, eres_map, os.path.join(plotdirname, 'PLOT_E_RESOL_PIXELS.png'))
+    return(eres_map)
+
+# ############################################################
 
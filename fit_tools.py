@@ -119,6 +119,7 @@ def gauss_fit(array_to_fit, bins, show=True, pltfilename='ER', inf=None):
 
 
         plt.savefig(pltfilename+'.png', bbox_inches='tight')
+        plt.close()
 
     return(nrj, nrj_resol_at_7kev)
 
@@ -3,7 +3,7 @@
 import numpy as np
 import os
 import matplotlib.pyplot as plt
-import get_data, general_tools, fit_tools
+import get_data, general_tools, fit_tools, session_index, results_store
 
 # -----------------------------------------------------------------------
 def get_files_freq(fulldirname, dumptype):
@@ -28,25 +28,13 @@ def get_files_freq(fulldirname, dumptype):
         Contains the frequencies found in the file names
 
         """
-    i_fich_deb, i_fich_fin = 16, 20
-    i_type_deb, i_type_fin = 21, 27
-    i_freq_deb, i_freq_fin = 32, 39
-    i_gbw_deb, i_gbw_fin = 27, 31
-    
-    fnames = [f for f in os.listdir(fulldirname) \
-                if os.path.isfile(os.path.join(fulldirname, f)) \
-                and f[-4:]=='.dat'\
-                and f[i_type_deb:i_type_fin]==dumptype\
-                and f[i_gbw_deb:i_gbw_fin]=="_GBW"]
+    files = session_index.select(fulldirname, ext='.dat', test_prefix=dumptype+"_GBW")
  
-    if len(fnames)>0:
-        freqs = file_nb = np.zeros(len(fnames))
-        fichlist = fnames.copy()
-        for i in range(len(fnames)):
-            name=fnames[i]
-            file_nb=int(name[i_fich_deb: i_fich_fin])
-            fichlist[file_nb]=name 
-            freqs[file_nb]=float(name[i_freq_deb:i_freq_fin])
+    if len(files['name'])>0:
+        # Files are sorted by file number
+        order = np.argsort(files['file_nb'])
+        fichlist = [str(name) for name in files['name'][order]]
+        freqs = files['gbw_freq'][order]
     else:
         fichlist=freqs=[] 
     return(fichlist, freqs)
@@ -130,18 +118,22 @@ def get_gbw_freq_and_amp(datadirname, dumptype, chan):
         for fich in fichlist:
             print('Processing file ' + fich)
             if dumptype=="IQ-ALL":
-                chan0_i, chan0_q, chan1_i, chan1_q, _ = get_data.read_iq(os.path.join(datadirname, fich))
-                if chan==0:
-                    modulus = \
-                        np.sqrt(chan0_i[:,pix_test].astype('float')**2 + chan0_q[:,pix_test].astype('float')**2)
-                else:
-                    modulus = \
-                        np.sqrt(chan1_i[:,pix_test].astype('float')**2 + chan1_q[:,pix_test].astype('float')**2)    
+                # the file is processed block by block (only the test pixel is used)
+                mod_min, mod_max = np.inf, -np.inf
+                for _, chan0_i, chan0_q, chan1_i, chan1_q, _ in get_data.read_iq_blocks(os.path.join(datadirname, fich)):
+                    if chan==0:
+                        modulus = \
+                            np.sqrt(chan0_i[:,pix_test].astype('float')**2 + chan0_q[:,pix_test].astype('float')**2)
+                    else:
+                        modulus = \
+                            np.sqrt(chan1_i[:,pix_test].astype('float')**2 + chan1_q[:,pix_test].astype('float')**2)    
+                    mod_min, mod_max = min(mod_min, modulus.min()), max(mod_max, modulus.max())
             else: # Le dumptype est "IQ-TEST"
                 data, _ = get_data.readfile(os.path.join(datadirname, fich))
                 modulus = np.sqrt(data[1:,0].astype('float')**2 + data[1:,1].astype('float')**2)
+                mod_min, mod_max = modulus.min(), modulus.max()
 
-            amplitudes=np.append(amplitudes, modulus.max()-modulus.min())
+            amplitudes=np.append(amplitudes, mod_max-mod_min)
     
     return(f, amplitudes, gain_dre)
                     
@@ -235,6 +227,10 @@ def process_gbw(fulldirname, config, chan, margin_pc=5):
 
         fig.tight_layout()
         plt.savefig(pltfilename, bbox_inches='tight')
+        plt.close()
+
+        results_store.record(fulldirname, config, 'process_gbw', \
+            [('gbw', chan, gbw, 'Hz'), ('gain_dre', chan, gain_dre, ''), ('gbwp_ok', chan, gbwp_ok, '')])
     else:
         f=a_db=0
         gbwp_ok=False
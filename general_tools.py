@@ -15,7 +15,7 @@
 
 # -----------------------------------------------------------------------
 # Imports
-import os, csv
+import os, csv, hashlib
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
@@ -129,6 +129,12 @@ def save_test_report(fulldirname, config, test_report):
     report_file_name=os.path.join(plotdirname, "report_summary.txt")
     report_file=open(report_file_name, "w")
 
+    if 'hk_ok' in test_report:
+        if test_report['hk_ok']:
+            report_file.write('House keeping: -----------> OK\n')
+        else:
+            report_file.write('House keeping: ----------->>> Not OK\n')
+
     if test_report['scanfb_ok']:
         report_file.write('Scan feedback: -----------> OK\n')
     else:
@@ -144,5 +150,237 @@ def save_test_report(fulldirname, config, test_report):
     else:
         report_file.write('Energy resolution: ------->>> Not OK\n')
 
+    if test_report.get('hk_violations') is not None and len(test_report['hk_violations']['hk']) > 0:
+        violations = test_report['hk_violations']
+        report_file.write('\nHouse keeping limits exceeded:\n')
+        for i in range(len(violations['hk'])):
+            report_file.write('  {0:s} {1:10s} from {2} to {3} ({4:.0f}s), peak excursion {5:.4g}\n' \
+                .format(violations['hk'][i], violations['level'][i], violations['start'][i], \
+                        violations['end'][i], violations['duration'][i], violations['peak'][i]))
+
+    if 'durations' in test_report:
+        report_file.write('\nProcessing durations:\n')
+        for name in test_report['durations'].keys():
+            report_file.write('  {0:15s} {1:8.1f}s\n'.format(name, test_report['durations'][name]))
+
+    report_file.close()
+
+
+# ---------------------------------------------------------------------------
+_file_hashes={}
+
+def get_file_hash(filename):
+    r"""
+        This function computes the hash (sha1) of the content of a file.
+        The result is memorised for the current process (as long as the size
+        and the modification time of the file do not change).
+
+        Parameters:
+        -----------
+        filename: string
+        The name of the file (with the path)
+
+        Returns
+        -------
+        file_hash: string
+        hexadecimal hash of the file content
+
+        """
+    stat=os.stat(filename)
+    memo_key=(os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if memo_key not in _file_hashes:
+        sha=hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                sha.update(block)
+        _file_hashes[memo_key]=sha.hexdigest()
+    return(_file_hashes[memo_key])
+
+# ---------------------------------------------------------------------------
+def get_cache_key(filenames, params=None):
+    r"""
+        This function computes a key identifying a set of input files
+        (from their content) and a set of processing parameters.
+
+        Parameters:
+        -----------
+        filenames: list of strings
+        The names of the input files (with the path)
+
+        params: dictionnary
+        The processing parameters (default is None)
+
+        Returns
+        -------
+        key: string
+        hexadecimal key (16 characters)
+
+        """
+    sha=hashlib.sha1()
+    for filename in filenames:
+        sha.update(get_file_hash(filename).encode())
+    if params is not None:
+        sha.update(repr(sorted(params.items())).encode())
+    return(sha.hexdigest()[:16])
+
+# ---------------------------------------------------------------------------
+def cache_load(cachedirname, name, key):
+    r"""
+        This function loads a set of arrays from a cache file (npz format).
+
+        Parameters:
+        -----------
+        cachedirname: string
+        The name of the cache directory
+
+        name: string
+        The name of the cached artefact
+
+        key: string
+        The key of the artefact (see get_cache_key)
+
+        Returns
+        -------
+        arrays: dictionnary
+        The cached arrays (None if the artefact is not in the cache)
+
+        """
+    cachefilename=os.path.join(cachedirname, name+'_'+key+'.npz')
+    arrays=None
+    if os.path.isfile(cachefilename):
+        with np.load(cachefilename) as npz:
+            arrays={k: npz[k] for k in npz.files}
+    return(arrays)
+
+# ---------------------------------------------------------------------------
+def cache_save(cachedirname, name, key, arrays):
+    r"""
+        This function saves a set of arrays in a cache file (compressed npz format).
+
+        Parameters:
+        -----------
+        cachedirname: string
+        The name of the cache directory
+
+        name: string
+        The name of the cached artefact
+
+        key: string
+        The key of the artefact (see get_cache_key)
+
+        arrays: dictionnary
+        The arrays to be saved
+
+        Returns
+        -------
+        Nothing
+
+        """
+    checkdir(cachedirname)
+    cachefilename=os.path.join(cachedirname, name+'_'+key+'.npz')
+    # the file is renamed once complete (other processes may read the cache)
+    tmpfilename=cachefilename+'.{0:d}.tmp'.format(os.getpid())
+    with open(tmpfilename, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmpfilename, cachefilename)
+
+# ---------------------------------------------------------------------------
+def get_file_signature(filename):
+    r"""
+        This function returns a cheap signature of a file (size and
+        modification time). It is used to check that a file already
+        processed has not changed, without reading it.
+
+        Parameters:
+        -----------
+        filename: string
+        The name of the file (with the path)
+
+        Returns
+        -------
+        signature: string
+
+        """
+    stat=os.stat(filename)
+    return('{0:d}_{1:d}'.format(stat.st_size, stat.st_mtime_ns))
+
+# ---------------------------------------------------------------------------
+def state_load(statedirname, name, params, filenames):
+    r"""
+        This function loads the state of an incremental processing: the
+        partial accumulators and the list of the input files already
+        consumed. The state is discarded (full processing) if the processing
+        parameters have changed or if a consumed file has been modified or
+        removed.
+
+        Parameters:
+        -----------
+        statedirname: string
+        The name of the directory containing the states
+
+        name: string
+        The name of the processing
+
+        params: dictionnary
+        The processing parameters
+
+        filenames: list of strings
+        The names of the input files currently available (with the path)
+
+        Returns
+        -------
+        state: dictionnary
+        The partial accumulators (None if there is no valid state)
+
+        new_filenames: list of strings
+        The input files which have not been consumed yet
+
+        """
+    state=cache_load(statedirname, name, get_cache_key([], params))
+    if state is None:
+        return(None, list(filenames))
+    consumed=dict(zip(state['consumed_files'], state['consumed_signatures']))
+    available={os.path.basename(filename): filename for filename in filenames}
+    for consumed_file in consumed.keys():
+        if consumed_file not in available \
+            or get_file_signature(available[consumed_file]) != consumed[consumed_file]:
+            print("File {0:s} has changed since the last run, full processing.".format(consumed_file))
+            return(None, list(filenames))
+    new_filenames=[filename for filename in filenames if os.path.basename(filename) not in consumed]
+    print("{0:3d} files already processed, {1:3d} new files.".format(len(consumed), len(new_filenames)))
+    return(state, new_filenames)
+
+# ---------------------------------------------------------------------------
+def state_save(statedirname, name, params, filenames, accumulators):
+    r"""
+        This function saves the state of an incremental processing (see
+        state_load).
+
+        Parameters:
+        -----------
+        statedirname: string
+        The name of the directory containing the states
+
+        name: string
+        The name of the processing
+
+        params: dictionnary
+        The processing parameters
+
+        filenames: list of strings
+        The names of all the input files consumed (with the path)
+
+        accumulators: dictionnary
+        The partial accumulators (arrays or numbers)
+
+        Returns
+        -------
+        Nothing
+
+        """
+    state=dict(accumulators)
+    state['consumed_files']=np.array([os.path.basename(filename) for filename in filenames], dtype=str)
+    state['consumed_signatures']=np.array([get_file_signature(filename) for filename in filenames], dtype=str)
+    cache_save(statedirname, name, get_cache_key([], params), state)
 
 # ---------------------------------------------------------------------------
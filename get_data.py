@@ -41,12 +41,79 @@ def dumpstr(dumptype):
     return(dumptype_str)
 
 
+# -----------------------------------------------------------------------------
+def get_dumptype(header2):
+    r"""
+        This function decodes the dump type from the second header word of a
+        DRE dump file.
+
+        Parameters
+        ----------
+        header2 : number
+        The second 16-bit word of the file (format <h)
+
+        Returns
+        -------
+        dumptype : number
+        Identifier for the type of dump.
+        
+        """
+    header2=int(np.uint16(header2))
+    header24=header2//2**12
+    header23=(header2-header24*2**12)//2**8
+    header22=(header2-header24*2**12-header23*2**8)//2**4
+    #header21=header2-header24*2**12-header23*2**8-header22*2**4 not used
+    return(header22)
+
+# -----------------------------------------------------------------------------
+def mapfile(dumpfilename, quiet=True):
+    r"""
+        This function memory-maps a DRE dump file (format <h) and returns a
+        read-only (N,2) view of its content. No data is copied: only the pages
+        which are actually sliced by the caller are read from the disk.
+        The first line of the view contains the file header (first 32-bit word).
+
+        Parameters
+        ----------
+        dumpfilename : string
+        The name of the dump file (with the path and the extension)
+
+        quiet : boolean
+        Defines if text info shall be written by the routine
+
+        Returns
+        -------
+        data : array type
+        read-only view of the values of the file (format int16).
+        data[:,0] and data[:,1] are strided views of the two columns.
+            
+        dumptype : number 'uint16'
+        Identifier for the type of dump.
+        
+        """
+    raw=np.memmap(dumpfilename, dtype='<h', mode='r')
+
+    DADA=-9510      # 0xDADA interpreted as int16
+    if raw[0] != DADA:
+        raise ValueError('Problem with file format!')
+    dumptype=get_dumptype(raw[1])
+    if not quiet:
+        print('  Dump type is: ' + dumpstr(dumptype))
+
+    # plain ndarray view of the mapping (the mapping is kept alive by the view)
+    nlines=len(raw)//2
+    data=raw[:2*nlines].reshape((nlines, 2)).view(np.ndarray)
+
+    return(data, dumptype)
+
 # -----------------------------------------------------------------------------
 def readfile(dumpfilename, quiet=True):
     r"""
         This function reads data from a DRE dump file, and returns 2 arrays
         (format <h).
-        The file header (first 32-bit) word is removed from the data
+        The file header (first 32-bit word) is the first line of the data.
+        The file is memory-mapped (see mapfile): the returned array is a
+        read-only view of the file, the data are not copied in memory.
 
         Parameters
         ----------
@@ -65,32 +132,73 @@ def readfile(dumpfilename, quiet=True):
         Identifier for the type of dump.
         
         """
+    return(mapfile(dumpfilename, quiet))
+
+# -----------------------------------------------------------------------------
+def get_iq_frames(data):
+    r"""
+        This function reshapes the content of a DRE IQ file into frames.
+        Each frame contains the DADA flag, the channel id and the I/Q values
+        of the 41 pixels for the two channels. No data is copied.
+
+        Parameters
+        ----------
+        data : array type
+        The (N,2) content of the IQ file (see mapfile)
+
+        Returns
+        -------
+        frames : array type
+        A (nframes, 2*(npix+2), 2) view of the data (format int16).
+        frames[:,:,0] are I values and frames[:,:,1] are Q values.
+                    
+        """
+    npix = 41
+    frame_length = 2*(npix+2)
+    nframes = len(data[:,0]) // frame_length
+    return(data[:nframes*frame_length].reshape((nframes, frame_length, 2)))
+
+# -----------------------------------------------------------------------------
+def decommute_iq(frames):
+    r"""
+        This function demultiplexes IQ frames (see get_iq_frames).
+
+        Parameters
+        ----------
+        frames : array type
+        IQ frames
+
+        Returns
+        -------
+        Chan0_i, Chan0_q, Chan1_i, Chan1_q : array type
+        contains the values of the I and Q science data (format int16).
+
+        dada_ch0, dada_ch1, chan0_id, chan1_id : array type
+        dada flags and channel ids for channels 0 and 1
+                    
+        """
+    npix = 41
+
+    dada_ch0 = frames[:, 0, 0]
+    dada_ch1 = frames[:, npix+2, 0]
     
-    fdat=open(dumpfilename, 'rb')
-    data=np.fromfile(fdat, dtype='<h')
-    fdat.close()
-        
-    DADA=-9510      # 0xDADA interpreted as int16
-    if data[0] != DADA:
-        raise ValueError('Problem with file format!')
-    header2=data[1].astype('uint16')
-    header24=int(header2/2**12)
-    header23=int((header2-header24*2**12)/2**8)
-    header22=int((header2-header24*2**12-header23*2**8)/2**4)
-    #header21=header2-header24*2**12-header23*2**8-header22*2**4 not used
-    dumptype=header22
-    if not quiet:
-        print('  Dump type is: ' + dumpstr(dumptype))
+    chan0_id = frames[:, 0, 1]
+    chan1_id = frames[:, npix+2, 1]
+    
+    chan0_i = frames[:, 2:2+npix, 0]
+    chan1_i = frames[:, 2+npix+2:, 0]
     
-    data = np.resize(data, (len(data)//2, 2))
+    chan0_q = frames[:, 2:2+npix, 1]
+    chan1_q = frames[:, 2+npix+2:, 1]
 
-    return(data, dumptype)
+    return(chan0_i, chan0_q, chan1_i, chan1_q, dada_ch0, dada_ch1, chan0_id, chan1_id)
 
 # -----------------------------------------------------------------------------
 def read_iq(filename):
     r"""
         This function reads IQ data from a DRE IQ file.
         (this corresponds to standard observation data)
+        The returned arrays are read-only views of the memory-mapped file.
 
         Parameters
         ----------
@@ -111,32 +219,57 @@ def read_iq(filename):
         raise ValueError('Wrong dumptype')
 
     # decommutation des donnees
-    npix = 41
-    
-    npts = len(data[:,0]) // (2*(npix+2))        
-    tab_i = np.resize(data[:,0], (npts, 2*(npix+2)))
-    tab_q = np.resize(data[:,1], (npts, 2*(npix+2)))
-    
-    dada_ch0 = tab_i[:, 0]
-    dada_ch1 = tab_i[:, npix+2]
-    
-    chan0_id = tab_q[:, 0]
-    chan1_id = tab_q[:, npix+2]
-    
-    chan0_i = tab_i[:, 2:2+npix]
-    chan1_i = tab_i[:, 2+npix+2:]
-    
-    chan0_q = tab_q[:, 2:2+npix]
-    chan1_q = tab_q[:, 2+npix+2:]
+    chan0_i, chan0_q, chan1_i, chan1_q, dada_ch0, dada_ch1, chan0_id, chan1_id = \
+        decommute_iq(get_iq_frames(data))
 
     flag_error = check_data(dada_ch0, dada_ch1, chan0_id, chan1_id)
 
     return(chan0_i, chan0_q, chan1_i, chan1_q, flag_error)
 
 # -----------------------------------------------------------------------------
-def check_data(dada_ch0, dada_ch1, chan0_id, chan1_id):
+def read_iq_blocks(filename, block_size=2**14):
     r"""
-        This function reads IQ data from a DRE IQ file.
+        This generator reads IQ data from a DRE IQ file block by block.
+        The frames are validated as they are read, the offsets of the
+        corrupted frames are reported with each block.
+        Peak memory scales with block_size, not with the file size.
+
+        Parameters
+        ----------
+        filename : string
+        The name of the dump file (with the path and the extension)
+
+        block_size : number
+        Number of frames (i.e. samples per pixel) in each block (default is 2**14)
+
+        Yields
+        ------
+        offset : number
+        index of the first frame of the block in the file.
+
+        Chan0_i, Chan0_q, Chan1_i, Chan1_q : array type
+        contains the values of the I and Q science data of the block (format int16).
+
+        bad_frames : array type
+        indexes (within the file) of the corrupted frames of the block.
+                    
+        """
+    data, dumptype = readfile(filename)
+    if dumptype != 8:
+        raise ValueError('Wrong dumptype')
+
+    frames = get_iq_frames(data)
+    nframes = len(frames)
+    for offset in range(0, nframes, block_size):
+        chan0_i, chan0_q, chan1_i, chan1_q, dada_ch0, dada_ch1, chan0_id, chan1_id = \
+            decommute_iq(frames[offset:offset+block_size])
+        bad_frames = offset + find_bad_frames(dada_ch0, dada_ch1, chan0_id, chan1_id)
+        yield(offset, chan0_i, chan0_q, chan1_i, chan1_q, bad_frames)
+
+# -----------------------------------------------------------------------------
+def find_bad_frames(dada_ch0, dada_ch1, chan0_id, chan1_id):
+    r"""
+        This function looks for corrupted frames in IQ data.
 
         Parameters
         ----------
@@ -145,21 +278,35 @@ def check_data(dada_ch0, dada_ch1, chan0_id, chan1_id):
 
         Returns
         -------
-        FLAG_ERROR : boolean
-        True if the data format is not correct
+        bad_frames : array type
+        indexes of the frames with a wrong dada flag or a wrong channel id.
                     
         """
-    flag_error = False
     dada = -9510
     ch0_id = 10880
     ch1_id = 10881
-    check_dada0 = np.where(dada_ch0 != dada)
-    check_dada1 = np.where(dada_ch1 != dada)
-    check_ch0 = np.where(chan0_id != ch0_id)
-    check_ch1 = np.where(chan1_id != ch1_id)
+    bad = (dada_ch0 != dada) | (dada_ch1 != dada) \
+        | (chan0_id != ch0_id) | (chan1_id != ch1_id)
+    return(np.where(bad)[0])
 
-    if len(check_dada0[0]) > 0 or len(check_dada1[0]) > 0 \
-        or len(check_ch0[0]) > 0 or len(check_ch1[0]) > 0:
+# -----------------------------------------------------------------------------
+def check_data(dada_ch0, dada_ch1, chan0_id, chan1_id):
+    r"""
+        This function checks the format of IQ data.
+
+        Parameters
+        ----------
+        dada_ch0, dada_ch1, chan0_id, chan1_id : array type
+        dada flags and channel ids for channels 0 and 1
+
+        Returns
+        -------
+        FLAG_ERROR : boolean
+        True if the data format is not correct
+                    
+        """
+    flag_error = False
+    if len(find_bad_frames(dada_ch0, dada_ch1, chan0_id, chan1_id)) > 0:
         print(" Error! Problem in the data set !!!!")
         flag_error = True        
 
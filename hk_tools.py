@@ -18,13 +18,13 @@
 
 # -----------------------------------------------------------------------
 # Imports
-import os, csv, general_tools
+import os, general_tools, session_index, plot_tools, results_store
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
 
 # -----------------------------------------------------------------------
-def get_hk(fulldirname, config):
+def get_hk(fulldirname, config, use_cache=True):
     r"""
         This function gets the hk of the demux prototype from a csv file.
 
@@ -36,41 +36,105 @@ def get_hk(fulldirname, config):
         config: dictionnary
         Contains path and constants definitions
 
+        use_cache: boolean
+        If True the hk are read from (or saved in) a binary file next to
+        the csv file (see read_hk_csv). Default is True.
+
         Returns
         -------
         hk : dictionnary
+        (0 if the hk file is not found)
+
+        hk_lims : dictionnary
+        hk limits.
 
         """
 
-    hk=hk_lims={}
     hkdirname = os.path.join(os.path.normcase(fulldirname), os.path.normcase(config['dir_hk']))
-    hkfilename = [f for f in os.listdir(hkdirname) \
-            if os.path.isfile(os.path.join(hkdirname, f)) and f[-4:]=='.csv']
+    hkfilename = session_index.get_files(hkdirname, ext='.csv')
     if len(hkfilename) == 0:
         print("Hk file not found.")
-        hk = 0
-    else:
-        print("Reading HKs...")
-        hkfullfilename=os.path.join(hkdirname, hkfilename[0])
-        with open(hkfullfilename, newline='') as csvfile:
-            reader = csv.reader(csvfile, delimiter=';', quotechar='|')
-
-            for row in reader:
-                n = len(row)
-                if reader.line_num == 1:
-                    keys = row
-                    for i in range(n):
-                        hk[keys[i]]=np.array([]) # Initialises an empty array
-                else:
-                    for i in range(n):
-                        if keys[i] == 'Date':
-                            hk[keys[i]] = np.append(hk[keys[i]], row[i])
-                        else:
-                            hk[keys[i]] = np.append(hk[keys[i]], float(row[i].replace(',','.')))
+        return(0, {})
 
+    print("Reading HKs...")
+    hkfullfilename=os.path.join(hkdirname, hkfilename[0])
+    hk = read_hk_csv(hkfullfilename, use_cache)
     hk_lims = get_hk_lims(fulldirname, config, hk)
     return(hk, hk_lims)
 
+# -----------------------------------------------------------------------
+def read_hk_csv(hkfullfilename, use_cache=True):
+    r"""
+        This function reads a GSE hk csv file (semicolon separated, comma
+        as decimal separator) in a single pass.
+
+        Parameters:
+        -----------
+        hkfullfilename: string
+        The name of the csv file (with the path)
+
+        use_cache: boolean
+        If True the columns are saved in a binary file next to the csv file
+        (same name with extension .hk.npz) and this file is read instead of
+        the csv file as long as the csv file is not modified. Default is True.
+
+        Returns
+        -------
+        hk : dictionnary
+        One array per column. The Date column is converted to datetime64,
+        the other columns to float (nan for empty cells).
+
+        """
+    cachefilename = os.path.splitext(hkfullfilename)[0]+'.hk.npz'
+    stat = os.stat(hkfullfilename)
+    signature = np.array([stat.st_size, stat.st_mtime_ns])
+
+    if use_cache and os.path.isfile(cachefilename):
+        try:
+            with np.load(cachefilename) as cache:
+                if np.array_equal(cache['signature'], signature):
+                    keys = cache['keys']
+                    return({str(keys[i]): cache['col{0:d}'.format(i)] for i in range(len(keys))})
+        except (OSError, KeyError, ValueError):
+            pass    # the cache is rebuilt
+
+    with open(hkfullfilename, newline='') as csvfile:
+        lines = csvfile.read().splitlines()
+    keys = lines[0].split(';')
+    ncols = len(keys)
+    rows = [line.split(';') for line in lines[1:] if line != '']
+    # Short rows are completed with empty cells
+    rows = [row+['']*(ncols-len(row)) if len(row) < ncols else row[:ncols] for row in rows]
+    table = np.array(rows, dtype=str).reshape((len(rows), ncols))
+
+    hk = {}
+    for i in range(ncols):
+        if keys[i] == 'Date':
+            hk[keys[i]] = dates_to_datetime64(table[:,i])
+        else:
+            column = np.char.replace(np.char.strip(table[:,i]), ',', '.')
+            column[column == ''] = 'nan'
+            hk[keys[i]] = column.astype(float)
+
+    if use_cache:
+        arrays = {'col{0:d}'.format(i): hk[keys[i]] for i in range(ncols)}
+        try:
+            tmpfilename = cachefilename+'.tmp.npz'
+            np.savez(tmpfilename, keys=np.array(keys, dtype=str), signature=signature, **arrays)
+            os.replace(tmpfilename, cachefilename)
+        except OSError as err:
+            print("Hk cache file could not be written: {0}".format(err))
+    return(hk)
+
+# -----------------------------------------------------------------------
+def dates_to_datetime64(datetxt):
+    r"""
+        This function converts an array of date strings as used by the GSE
+        (YYYYMMDD_HHMMSS) into datetime64 values.
+        """
+    isotxt = [d[:4]+'-'+d[4:6]+'-'+d[6:8]+'T'+d[9:11]+':'+d[11:13]+':'+d[13:15] for d in datetxt]
+    return(np.array(isotxt, dtype='datetime64[s]'))
+
 # -----------------------------------------------------------------------
 def print_hk(hk):
     r"""
@@ -157,16 +221,14 @@ def plot_hk(hk, hk_lims, fulldirname, config, plt_temp=True):
     if n_valid_hk % n_cols != 0:
         n_lines = n_lines+1
 
-    deltatime = np.array([0])
-    for i in range(len(hk['Date'])-1):
-        deltatime = np.append(deltatime, (datetxt_to_date(hk['Date'][i+1])-datetxt_to_date(hk['Date'][0])).total_seconds())
+    deltatime = (hk['Date']-hk['Date'][0]).astype(float)    # in seconds
 
     fig = plt.figure(figsize=(12, 18))
     ihk=1
     for key in hk.keys():
         if key !='Date' and ihk <= n_valid_hk:
             ax = fig.add_subplot(n_lines, n_cols, ihk)
-            ax.plot(deltatime, hk[key], linewidth=3)
+            plot_tools.plot_envelope(ax, deltatime, hk[key], linewidth=3)
             ax.grid(color='k', linestyle=':', linewidth=0.5)
             ax.set_title(key[1:-1])
             ax.set_xlabel('time (s)')
@@ -186,6 +248,7 @@ def plot_hk(hk, hk_lims, fulldirname, config, plt_temp=True):
             ihk=ihk+1
     fig.tight_layout()
     plt.savefig(pltfilename2, bbox_inches='tight')
+    plt.close()
 
     fig = plt.figure(figsize=(12, 18))
     ihk=1
@@ -193,7 +256,7 @@ def plot_hk(hk, hk_lims, fulldirname, config, plt_temp=True):
         #print(key)
         if key !='Date' and ihk <= n_valid_hk:
             ax = fig.add_subplot(n_lines, n_cols, ihk)
-            ax.plot(deltatime, hk[key], linewidth=3)
+            plot_tools.plot_envelope(ax, deltatime, hk[key], linewidth=3)
             ax.grid(color='k', linestyle=':', linewidth=0.5)
             ax.set_title(key[1:-1])
             ax.set_xlabel('time (s)')
@@ -207,12 +270,13 @@ def plot_hk(hk, hk_lims, fulldirname, config, plt_temp=True):
             ihk=ihk+1
     fig.tight_layout()
     plt.savefig(pltfilename1, bbox_inches='tight')
+    plt.close()
     
     if plt_temp:
         fig = plt.figure(figsize=(9, 5))
         key="\"Temperature DAC CH1 (C)\""
         ax = fig.add_subplot(1, 1, 1)
-        ax.plot(deltatime, hk[key], linewidth=3)
+        plot_tools.plot_envelope(ax, deltatime, hk[key], linewidth=3)
         ax.grid(color='k', linestyle=':', linewidth=0.5)
         ax.set_ylabel(key[1:-1])
         ax.set_xlabel('time (s)')
@@ -228,6 +292,7 @@ def plot_hk(hk, hk_lims, fulldirname, config, plt_temp=True):
             item.set_fontsize(15)
         fig.tight_layout()
         plt.savefig(pltfilename3, bbox_inches='tight')
+        plt.close()
 
     return()
 
@@ -280,7 +345,62 @@ def init_hk_lims(hk):
     return(default_hk_lims_list)
 
 # -----------------------------------------------------------------------
-def get_hk_lims(fulldirname, config, hk):
+_dispatcher_tables = {}     # absolute file name -> (modification time, limits table)
+
+def read_dispatcher(fullfilename):
+    r"""
+        This function reads the hk limits defined in a GSE dispatcher file
+        (parametersTF.dispatcher). The file is read once and the result
+        is kept in memory as long as the file is not modified.
+
+        In the file, the definition of a hk starts with a line realname=<name>.
+        It is followed by 5 unused lines and by the 8 lines of the limits
+        (lowalert, lowalertv, lowwarn, lowwarnv, highwarn, highwarnv,
+        highalert, highalertv).
+
+        Parameters
+        ----------
+        fullfilename : string
+        The name of the dispatcher file (with the path)
+
+        Returns
+        -------
+        table: Dictionnary
+        hk limits indexed by the hk real name.
+
+        """
+    fullfilename = os.path.abspath(fullfilename)
+    mtime = os.stat(fullfilename).st_mtime_ns
+    if fullfilename in _dispatcher_tables and _dispatcher_tables[fullfilename][0] == mtime:
+        return(_dispatcher_tables[fullfilename][1])
+
+    with open(fullfilename, "r") as fich:
+        lines = fich.read().splitlines()
+
+    lims_names = ['lowalert', 'lowalertv', 'lowwarn', 'lowwarnv', \
+                  'highwarn', 'highwarnv', 'highalert', 'highalertv']
+    n_skipped = 5
+    table = {}
+    for i_line in range(len(lines)):
+        if lines[i_line][:9] == 'realname=':
+            values = lines[i_line+1+n_skipped:i_line+1+n_skipped+len(lims_names)]
+            if len(values) < len(lims_names):
+                print("Incomplete limits for hk {0:s} in file {1:s}".format(lines[i_line][9:], fullfilename))
+                continue
+            lims = {}
+            for name, line in zip(lims_names, values):
+                value = line.split('=')[1]
+                if name[-1] == 'v':
+                    lims[name] = float(value.replace(',','.'))
+                else:
+                    lims[name] = value == 'true'
+            table[lines[i_line][9:]] = lims
+
+    _dispatcher_tables[fullfilename] = (mtime, table)
+    return(table)
+
+# -----------------------------------------------------------------------
+def get_hk_lims(fulldirname, config, hk, missing='warn'):
     r"""
         This function gets the hk limits from a text file.
 
@@ -295,6 +415,12 @@ def get_hk_lims(fulldirname, config, hk):
         hk: Dictionnary
         hk values.
 
+        missing: string
+        Policy for the hks which are not defined in the limits file:
+        'warn' (the default limits are used and a message lists the
+        missing hks), 'ignore' (the default limits are used) or 'raise'
+        (a KeyError is raised). Default is 'warn'.
+
         Returns
         -------
         hk_lims: Dictionnary
@@ -311,26 +437,21 @@ def get_hk_lims(fulldirname, config, hk):
     if not os.path.isfile(fullfilename):
         print(filename+" file not found.")
     else:
+        table = read_dispatcher(fullfilename)
+        missing_hks = []
         for key in hk.keys():
             if key!='Date' and key[1:9]!="DRE_Hks_":
-                fich = open(fullfilename, "r")
-                # looking for hk informations in the file
-                line = ''
                 hk_real_name = key[1:-5]
-                while line != 'realname='+hk_real_name+'\n':
-                    line=fich.readline()
-                # skipping unwanted lines
-                [fich.readline() for i in range(5)]
-                # getting hk limits
-                hk_lims_list[key]['lowalert']=fich.readline().split("=")[1]=='true\n'
-                hk_lims_list[key]['lowalertv']=float(fich.readline().split('=')[1].replace(',','.'))
-                hk_lims_list[key]['lowwarn']=fich.readline().split('=')[1]=='true\n'
-                hk_lims_list[key]['lowwarnv']=float(fich.readline().split('=')[1].replace(',','.'))
-                hk_lims_list[key]['highwarn']=fich.readline().split('=')[1]=='true\n'
-                hk_lims_list[key]['highwarnv']=float(fich.readline().split('=')[1].replace(',','.'))
-                hk_lims_list[key]['highalert']=fich.readline().split('=')[1]=='true\n'
-                hk_lims_list[key]['highalertv']=float(fich.readline().split('=')[1].replace(',','.'))
-                fich.close()
+                if hk_real_name in table:
+                    hk_lims_list[key].update(table[hk_real_name])
+                else:
+                    missing_hks.append(hk_real_name)
+        if len(missing_hks) > 0:
+            if missing == 'raise':
+                raise KeyError("Hk limits not found in {0:s}: {1:s}".format(filename, ", ".join(missing_hks)))
+            if missing == 'warn':
+                print("Hk limits not found in {0:s} (default limits are used): {1:s}" \
+                    .format(filename, ", ".join(missing_hks)))
 
     return(hk_lims_list)
 
@@ -357,6 +478,113 @@ def print_hk_lims(hk_lims_list):
             for key2 in hk_lims_list[key1].keys():
                 print(key2, ': ', hk_lims_list[key1][key2])
 
+# -----------------------------------------------------------------------
+def find_hk_violations(hk, hk_lims):
+    r"""
+        This function evaluates the warning and alert limits of all the hks
+        at once and returns the intervals during which the limits are
+        exceeded.
+
+        A warning interval includes the samples which are also in an alert
+        interval. NaN values are never considered as out of limits.
+
+        Parameters
+        ----------
+        hk: Dictionnary
+        hk values (the Date column is a datetime64 array).
+
+        hk_lims: Dictionnary
+        hk limits.
+
+        Returns
+        -------
+        violations: Dictionnary of arrays (one entry per interval, sorted by hk, level and start)
+        hk (name), level ('lowalert', 'lowwarn', 'highwarn' or 'highalert'),
+        start and end (datetime64 of the first and last samples out of limits),
+        duration (s, 0 for a single sample), n_samples,
+        peak (maximum excursion beyond the limit, always positive)
+
+        """
+    levels = [('lowalert', -1), ('lowwarn', -1), ('highwarn', 1), ('highalert', 1)]
+    keys = [key for key in hk_lims.keys() if key in hk]
+    violations = {'hk': [], 'level': [], 'start': [], 'end': [], 'duration': [], \
+                  'n_samples': [], 'peak': []}
+
+    if len(keys) > 0 and len(hk['Date']) > 0:
+        dates = hk['Date']
+        values = np.stack([hk[key] for key in keys])     # (n_hk, n_samples)
+        n_samples = values.shape[1]
+        for level, sign in levels:
+            enabled = np.array([hk_lims[key][level] for key in keys], dtype=bool)
+            limits = np.array([hk_lims[key][level+'v'] for key in keys], dtype=float)
+            # Excursion beyond the limit (positive when the limit is exceeded)
+            with np.errstate(invalid='ignore'):
+                excursion = sign*(values - limits[:,None])
+                out = (excursion > 0) & enabled[:,None]
+            if not out.any():
+                continue
+            # Edges of the intervals
+            edges = np.diff(np.pad(out.astype(np.int8), ((0,0),(1,1))), axis=1)
+            i_hk, i_start = np.nonzero(edges == 1)
+            _, i_end = np.nonzero(edges == -1)      # first sample back within the limits
+            # Peak excursion of each interval (the intervals don't overlap)
+            flat = np.append(np.where(out, excursion, 0).ravel(), 0)
+            bounds = np.ravel(np.column_stack((i_hk*n_samples+i_start, i_hk*n_samples+i_end)))
+            peaks = np.maximum.reduceat(flat, bounds)[::2]
+
+            violations['hk'] += [keys[i] for i in i_hk]
+            violations['level'] += [level]*len(i_hk)
+            violations['start'].append(dates[i_start])
+            violations['end'].append(dates[i_end-1])
+            violations['duration'].append((dates[i_end-1]-dates[i_start]).astype('timedelta64[ms]').astype(float)/1000)
+            violations['n_samples'].append(i_end-i_start)
+            violations['peak'].append(peaks)
+
+    violations = {
+        'hk': np.array(violations['hk'], dtype=str),
+        'level': np.array(violations['level'], dtype=str),
+        'start': np.concatenate(violations['start']+[np.array([], dtype='datetime64[s]')]),
+        'end': np.concatenate(violations['end']+[np.array([], dtype='datetime64[s]')]),
+        'duration': np.concatenate(violations['duration']+[np.array([], dtype=float)]),
+        'n_samples': np.concatenate(violations['n_samples']+[np.array([], dtype=int)]).astype(int),
+        'peak': np.concatenate(violations['peak']+[np.array([], dtype=float)])
+        }
+    order = np.lexsort((violations['start'], violations['level'], violations['hk']))
+    return({key: violations[key][order] for key in violations.keys()})
+
+# -----------------------------------------------------------------------
+def print_hk_violations(violations, detailed=False):
+    r"""
+        This function prints the intervals during which the hk limits are
+        exceeded (see find_hk_violations).
+
+        Parameters
+        ----------
+        violations: Dictionnary of arrays
+        The intervals (see find_hk_violations).
+
+        detailed: boolean
+        If True each interval is printed, otherwise a summary is printed
+        for each hk and level (default is False).
+
+        Returns
+        -------
+        Nothing.
+
+        """
+    if not detailed:
+        for hk_name in np.unique(violations['hk']):
+            for level in np.unique(violations['level'][violations['hk'] == hk_name]):
+                selection = (violations['hk'] == hk_name) & (violations['level'] == level)
+                print("  {0:s} {1:10s} {2:5d} intervals, {3:.0f}s in total, peak excursion {4:.4g}" \
+                    .format(hk_name, level, np.sum(selection), violations['duration'][selection].sum(), \
+                            violations['peak'][selection].max()))
+        return()
+    for i in range(len(violations['hk'])):
+        print("  {0:s} {1:10s} from {2} to {3} ({4:.0f}s, {5:d} samples), peak excursion {6:.4g}" \
+            .format(violations['hk'][i], violations['level'][i], violations['start'][i], violations['end'][i], \
+                    violations['duration'][i], violations['n_samples'][i], violations['peak'][i]))
+
 # -----------------------------------------------------------------------
 def check_hk(fulldirname, config, plt_temp=False):
     r"""
@@ -375,13 +603,30 @@ def check_hk(fulldirname, config, plt_temp=False):
 
         Returns
         -------
-        Nothing.
+        hk_ok: boolean
+        True if the hk file has been found and no alert limit is exceeded.
+
+        violations: Dictionnary of arrays
+        The intervals during which the limits are exceeded (see find_hk_violations).
 
         """
 
     hk, hk_lims = get_hk(fulldirname, config)
-    if hk != 0:
-        plot_hk(hk, hk_lims, fulldirname, config, plt_temp)
-    return(hk!=0)
+    if hk == 0:
+        results_store.record(fulldirname, config, 'check_hk', [('hk_ok', '', False, '')])
+        return(False, find_hk_violations({}, {}))
+
+    plot_hk(hk, hk_lims, fulldirname, config, plt_temp)
+    violations = find_hk_violations(hk, hk_lims)
+    n_alerts = np.sum(np.char.endswith(violations['level'], 'alert'))
+    if len(violations['hk']) > 0:
+        print("Hk limits exceeded:")
+        print_hk_violations(violations)
+
+    results_store.record(fulldirname, config, 'check_hk', \
+        [('hk_ok', '', n_alerts == 0, ''), ('n_violations', '', len(violations['hk']), ''), \
+         ('n_alerts', '', n_alerts, '')])
+    results_store.record_hk_violations(fulldirname, config, violations)
+    return(n_alerts == 0, violations)
 
 # -----------------------------------------------------------------------
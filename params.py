@@ -1 +1,2 @@
-npix=41 # number of pixels (includes the test pixel)
\ No newline at end of file
+npix=41 # number of pixels (includes the test pixel)
+nchan=2 # number of channels
\ No newline at end of file
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------
+"""
+    plot_tools module
+    =================
+
+    Developped by: L. Ravera
+
+    Project: Athena X-IFU / DRE-DEMUX
+
+    Tools to render the plots outside of the critical path of the data
+    processing.
+
+    A plot is described by a rendering function (defined at the top level
+    of a module) and the arrays it needs. The rendering functions are run
+    with the non interactive Agg backend, the figures are always closed
+    after rendering.
+
+    Rendering modes:
+        'async': the plots are rendered by a pool of background processes
+        'sync': the plots are rendered immediately in the calling process
+        'off': the plots are not rendered (numbers-only processing)
+
+    """
+
+# -----------------------------------------------------------------------
+# Imports
+import os, atexit
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+
+_modes = ('async', 'sync', 'off')
+_settings = {'mode': os.environ.get('DEMUX_PLOT_MODE', 'async'), 'n_workers': 2}
+_executor = None
+_futures = []
+
+# -----------------------------------------------------------------------
+def set_mode(mode, n_workers=None):
+    r"""
+        This function selects the rendering mode of the plots. Pending plots
+        are rendered before the mode is changed.
+
+        Parameters:
+        -----------
+        mode: string
+        'async', 'sync' or 'off' (see module description)
+
+        n_workers: number
+        Number of background processes used in 'async' mode (default is
+        None, the current value is kept)
+
+        Returns
+        -------
+        Nothing
+
+        """
+    if mode not in _modes:
+        raise ValueError("Unknown plot mode: {0:s} (expected one of {1})".format(mode, _modes))
+    wait()
+    _shutdown()
+    _settings['mode'] = mode
+    # The mode is also given to the processes started later on
+    os.environ['DEMUX_PLOT_MODE'] = mode
+    if n_workers is not None:
+        _settings['n_workers'] = n_workers
+
+# -----------------------------------------------------------------------
+def get_mode():
+    r"""
+        This function returns the current rendering mode.
+        """
+    return(_settings['mode'])
+
+# -----------------------------------------------------------------------
+def init_worker():
+    r"""
+        This function initialises the rendering processes.
+        """
+    matplotlib.use('Agg')
+
+# -----------------------------------------------------------------------
+def render(func, args, kwargs):
+    r"""
+        This function runs a rendering function and closes its figures.
+        """
+    try:
+        func(*args, **kwargs)
+    finally:
+        plt.close('all')
+
+# -----------------------------------------------------------------------
+def submit(func, *args, **kwargs):
+    r"""
+        This function submits a plot to the rendering service.
+
+        Parameters:
+        -----------
+        func: function
+        The rendering function (it must be defined at the top level of a
+        module so that it can be sent to another process)
+
+        args, kwargs:
+        The arguments of the rendering function (computed arrays, file names...)
+
+        Returns
+        -------
+        Nothing
+
+        """
+    global _executor
+    mode = _settings['mode']
+    if mode == 'off':
+        return
+    if mode == 'sync':
+        if matplotlib.get_backend().lower() != 'agg':
+            matplotlib.use('Agg')
+        render(func, args, kwargs)
+        return
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=_settings['n_workers'], initializer=init_worker)
+    _futures.append(_executor.submit(render, func, args, kwargs))
+
+# -----------------------------------------------------------------------
+def wait():
+    r"""
+        This function waits for the end of the pending plots. The rendering
+        errors are reported.
+
+        Returns
+        -------
+        n_errors: number
+        The number of plots which failed
+
+        """
+    n_errors = 0
+    while len(_futures) > 0:
+        future = _futures.pop(0)
+        try:
+            future.result()
+        except Exception as err:
+            print("Plot rendering failed: {0}".format(err))
+            n_errors += 1
+    return(n_errors)
+
+# -----------------------------------------------------------------------
+def envelope(t, y, n_bins):
+    r"""
+        This function decimates a time series for plotting. The samples are
+        gathered in n_bins bins and the minimum and the maximum of each bin
+        are kept (in their time order), so that peaks such as pulses or
+        delocks are preserved.
+
+        Parameters
+        ----------
+        t : array
+        Time (or any abscissa), 1 dimension.
+
+        y : array
+        Values, 1 dimension or 2 dimensions (one column per trace, as
+        accepted by matplotlib's plot).
+
+        n_bins: number
+        Number of bins (about the width of the plot in pixels).
+
+        Returns
+        -------
+        t_env, y_env : arrays
+        The decimated time series (2*n_bins samples at most). When y has 2
+        dimensions t_env has the same shape as y_env (the positions of the
+        extrema depend on the trace).
+
+        """
+    t = np.asarray(t)
+    y = np.asarray(y)
+    n = len(t)
+    n_bins = max(1, int(n_bins))
+    if n <= 2*n_bins:
+        return(t, y)
+
+    bin_size = -(-n//n_bins)
+    n_bins = -(-n//bin_size)
+    # The last bin is completed with the last sample
+    y2 = y.reshape((n, -1))
+    padded = np.concatenate((y2, np.repeat(y2[-1:], n_bins*bin_size-n, axis=0)))
+    padded = padded.reshape((n_bins, bin_size, -1))
+    offsets = (np.arange(n_bins)*bin_size)[:, None]
+    i_min = np.minimum(offsets + padded.argmin(axis=1), n-1)
+    i_max = np.minimum(offsets + padded.argmax(axis=1), n-1)
+    # Extrema in their time order (n_bins*2, n_traces)
+    i_env = np.stack((np.minimum(i_min, i_max), np.maximum(i_min, i_max)), axis=1).reshape((2*n_bins, -1))
+    y_env = np.take_along_axis(y2, i_env, axis=0)
+    if y.ndim == 1:
+        return(t[i_env[:, 0]], y_env[:, 0])
+    return(t[i_env], y_env)
+
+# -----------------------------------------------------------------------
+def plot_envelope(ax, t, y, *args, n_bins=None, **kwargs):
+    r"""
+        This function plots a (long) time series decimated with envelope.
+        By default the number of bins is the width of the axes in pixels.
+        The other arguments are given to ax.plot.
+        """
+    if n_bins is None:
+        fig = ax.get_figure()
+        n_bins = fig.get_figwidth()*fig.dpi*ax.get_position().width
+    t_env, y_env = envelope(t, y, n_bins)
+    return(ax.plot(t_env, y_env, *args, **kwargs))
+
+# -----------------------------------------------------------------------
+def _shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+@atexit.register
+def _flush():
+    wait()
+    _shutdown()
+
+# -----------------------------------------------------------------------
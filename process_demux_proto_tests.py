@@ -7,73 +7,163 @@ import baseline
 import os
 import ep_tools
 import scan_feedback_tools
+import scheduler_tools
+import plot_tools
+import results_store
 
 # ---------------------------------------------------------------------------
-def process_demux_proto_tests(dirname, verbose=False):
+# Processing stages (see scheduler_tools)
+tst_pix=40 # test pixel index
 
-    test_report={
-        'scanfb_ok':False,
-        'gbwp_ok':False,
-        'eres_ok':False
-        }
-
-    # -----------------------------------------------------------------------
-    # Reading demux and session informations 
-    config = general_tools.get_csv('demux_tools_cfg.csv')
-
-    fulldirname = os.path.join(os.path.normcase(config['path_tests']), dirname)
-    session_info = general_tools.get_csv(os.path.join(fulldirname, config['session_info']))
-
-    if verbose:
-        general_tools.print_dict(config, 'demux')
-        general_tools.print_dict(session_info, 'session')
-
-    # -----------------------------------------------------------------------
+def stage_hk(fulldirname, config):
     # Processing of hk files 
-    _=hk_tools.check_hk(fulldirname, config, plt_temp=True)
- 
-    # -----------------------------------------------------------------------
+    hk_ok, hk_violations=hk_tools.check_hk(fulldirname, config, plt_temp=True)
+    return({'hk_ok': hk_ok, 'hk_violations': hk_violations})
+
+def stage_scanfb(fulldirname, config):
     # Processing scan feedback data 
-    test_report['scanfb_ok']=scan_feedback_tools.check_scanfb(fulldirname, config)
+    return({'scanfb_ok': scan_feedback_tools.check_scanfb(fulldirname, config)})
 
-    # -----------------------------------------------------------------------
+def stage_iq_multi(fulldirname, config):
     # Processing "Carriers spectra characterization"
-    tst_pix=40 # test pixel index
-    _, pix_pos=dumps.process_iq_multi(fulldirname, config, pix_zoom=tst_pix)
-    dumps.process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True)
+    _, pix_pos=dumps.process_iq_multi(fulldirname, config, pix_zoom=tst_pix, \
+                                      incremental=config.get('incremental', False))
+    return({'pix_pos': pix_pos})
 
-    # -----------------------------------------------------------------------
+def stage_iq_tst_multi(fulldirname, config):
+    dumps.process_iq_tst_multi(fulldirname, config, window=False, bw_correction=True, \
+                               incremental=config.get('incremental', False))
+
+def stage_dump(fulldirname, config, pix_pos):
     # Processing "BIAS, FEEDBAC and INPUT" dump files 
     dumps.process_dump(fulldirname, config, max_duration=1.0, pix_id=pix_pos)
+
+def stage_dump_dds(fulldirname, config):
     dumps_dds.process_dump_dds(fulldirname, config, max_duration=1.0)
 
-    # -----------------------------------------------------------------------
+def stage_gbw(fulldirname, config):
     # Processing "Gain bandwidth characterization" 
     channel=0
-    test_report['gbwp_ok']=gbw.process_gbw(fulldirname, config, channel)
+    return({'gbwp_ok': gbw.process_gbw(fulldirname, config, channel)})
 
-    # -----------------------------------------------------------------------
+def stage_baseline(fulldirname, config):
     # Checking baseline level
     baseline.check_baseline(fulldirname, config)
 
-    # -----------------------------------------------------------------------
+def stage_delock(fulldirname, config):
     # Checking delock behaviour
     dumps.process_dump_nl(fulldirname, config)
     dumps.process_dump_delock_iq(fulldirname, config, "NL_anti-Delock-OFF")
     dumps.process_dump_delock_iq(fulldirname, config, "NL_anti-Delock--ON")
 
-    # -----------------------------------------------------------------------
+def stage_pulses(fulldirname, config):
     # Checking pulse generator behaviour
     dumps.process_dump_pulses_adc_dac(fulldirname, config, 'IN-BIA_PULSE', zoom_factor=50)
     dumps.process_dump_pulses_adc_dac(fulldirname, config, 'IN-FBK_PULSE', zoom_factor=50)
     dumps.process_dump_pulses_iq(fulldirname, config)
 
-    # -----------------------------------------------------------------------
+def stage_ep(fulldirname, config):
     # Measuring energy resolution
-    test_report['eres_ok']=ep_tools.ep(fulldirname, config)
+    return({'eres_ok': ep_tools.ep(fulldirname, config)})
+
+def stage_ep_pixels(fulldirname, config):
+    # Measuring energy resolution of all the pixels
+    ep_tools.ep_pixels(fulldirname, config)
+
+stages=[
+    {'name': 'hk',          'func': stage_hk,           'inputs': [],          'outputs': ['hk_ok', 'hk_violations']},
+    {'name': 'scanfb',      'func': stage_scanfb,       'inputs': [],          'outputs': ['scanfb_ok']},
+    {'name': 'iq_multi',    'func': stage_iq_multi,     'inputs': [],          'outputs': ['pix_pos']},
+    {'name': 'iq_tst_multi','func': stage_iq_tst_multi, 'inputs': [],          'outputs': []},
+    {'name': 'dump',        'func': stage_dump,         'inputs': ['pix_pos'], 'outputs': []},
+    {'name': 'dump_dds',    'func': stage_dump_dds,     'inputs': [],          'outputs': []},
+    {'name': 'gbw',         'func': stage_gbw,          'inputs': [],          'outputs': ['gbwp_ok']},
+    {'name': 'baseline',    'func': stage_baseline,     'inputs': [],          'outputs': []},
+    {'name': 'delock',      'func': stage_delock,       'inputs': [],          'outputs': []},
+    {'name': 'pulses',      'func': stage_pulses,       'inputs': [],          'outputs': []},
+    {'name': 'ep',          'func': stage_ep,           'inputs': [],          'outputs': ['eres_ok']},
+    {'name': 'ep_pixels',   'func': stage_ep_pixels,    'inputs': [],          'outputs': []}
+    ]
+
+# Input files of the stages (used to find the stages affected by a new file):
+# (directory, kind of match, pattern, stage names). For the DATA files the
+# pattern is compared to the test name ('prefix') or to the file name ('suffix',
+# 'contains'). Every file of the HK directory feeds the hk stage.
+stage_triggers=[
+    ('dir_hk',   'contains', '',                    ['hk']),
+    ('dir_data', 'suffix',   'scanFB.fits',         ['scanfb']),
+    ('dir_data', 'prefix',   'IQ-ALL_Science-Data', ['iq_multi', 'baseline']),
+    ('dir_data', 'prefix',   'IQ-TST_Science-Data', ['iq_tst_multi']),
+    ('dir_data', 'suffix',   '_IN-BIA.dat',         ['dump']),
+    ('dir_data', 'suffix',   '_IN-FBK.dat',         ['dump']),
+    ('dir_data', 'contains', 'DDSout',              ['dump_dds']),
+    ('dir_data', 'contains', '_GBW_',               ['gbw']),
+    ('dir_data', 'contains', 'Delock',              ['delock']),
+    ('dir_data', 'contains', 'NL-carac',            ['delock']),
+    ('dir_data', 'contains', '_PULSE',              ['pulses']),
+    ('dir_data', 'suffix',   '_record.fits',        ['ep', 'ep_pixels'])
+    ]
+
+# ---------------------------------------------------------------------------
+def process_demux_proto_tests(dirname, verbose=False, n_workers=None, plot_mode='async', incremental=False, \
+                              stage_names=None):
+
+    test_report={
+        'hk_ok':False,
+        'hk_violations':None,
+        'scanfb_ok':False,
+        'gbwp_ok':False,
+        'eres_ok':False
+        }
+
+    # -----------------------------------------------------------------------
+    # Reading demux and session informations 
+    config = general_tools.get_csv('demux_tools_cfg.csv')
+    # the accumulating stages only process the files added since the last run
+    config['incremental'] = incremental
+
+    fulldirname = os.path.join(os.path.normcase(config['path_tests']), dirname)
+    session_info = general_tools.get_csv(os.path.join(fulldirname, config['session_info']))
+
+    if verbose:
+        general_tools.print_dict(config, 'demux')
+        general_tools.print_dict(session_info, 'session')
+
+    # 'off' gives a numbers-only processing
+    plot_tools.set_mode(plot_mode)
 
     # -----------------------------------------------------------------------
-    # writing test report
-    general_tools.save_test_report(fulldirname, config, test_report)
+    # Running the processing stages (independent stages are run concurrently)
+    # a subset of the stages can be run (the stages producing their inputs are added)
+    if stage_names is None:
+        selected_stages=stages
+    else:
+        selected_stages=scheduler_tools.select_stages(stages, stage_names)
+    results, durations=scheduler_tools.run_stages(selected_stages, fulldirname, config, \
+                                                  n_workers=n_workers, verbose=verbose)
+    for key in test_report.keys():
+        if key in results:
+            test_report[key]=results[key]
+    test_report['durations']=durations
+    plot_tools.wait()
+    # one source per stage (a partial run does not erase the other durations)
+    for name in durations.keys():
+        results_store.record(fulldirname, config, 'stage_'+name, [('duration', '', durations[name], 's')])
+
+    if verbose:
+        print("Stage durations:")
+        for name in durations.keys():
+            print("  {0:15s} {1:8.1f}s".format(name, durations[name]))
+
+    # -----------------------------------------------------------------------
+    # writing test report (it is only complete if all the stages have been run)
+    if stage_names is None:
+        general_tools.save_test_report(fulldirname, config, test_report)
+    else:
+        for key in results.keys():
+            if key in test_report:
+                print("  {0:s}: {1}".format(key, results[key]))
+
+    return(test_report)
 
 # ---------------------------------------------------------------------------
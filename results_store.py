@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------
+"""
+    results_store module
+    ====================
+
+    Developped by: L. Ravera
+
+    Project: Athena X-IFU / DRE-DEMUX
+
+    Store of the measurements of a test session (SQLite data base in the
+    LOGS directory of the session).
+
+    Each measurement is a record:
+        source: name of the processing function which produced it
+        metric: name of the measured quantity (crest_factor, gbw, ...)
+        item: element concerned by the measurement (pixel, data stream,
+              file...), '' if not relevant
+        value: numerical value (NULL for text values)
+        text: text value (NULL for numerical values)
+        unit: unit of the value ('' if not relevant)
+        recorded: date of the recording (ISO format)
+
+    When a processing function records its measurements, its previous
+    records are replaced. The house keeping limit violations are stored
+    in a dedicated table.
+
+    """
+
+# -----------------------------------------------------------------------
+# Imports
+import os, sqlite3, datetime
+import numpy as np
+import general_tools
+
+store_filename = 'results.sqlite'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS metrics (
+    source TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    item TEXT NOT NULL DEFAULT '',
+    value REAL,
+    text TEXT,
+    unit TEXT NOT NULL DEFAULT '',
+    recorded TEXT NOT NULL,
+    PRIMARY KEY (source, metric, item)
+);
+CREATE TABLE IF NOT EXISTS hk_violations (
+    hk TEXT NOT NULL,
+    level TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    duration REAL,
+    n_samples INTEGER,
+    peak REAL
+);
+"""
+
+_metrics_columns = ('source', 'metric', 'item', 'value', 'text', 'unit', 'recorded')
+
+# -----------------------------------------------------------------------
+def get_store_filename(fulldirname, config):
+    r"""
+        This function returns the name of the results store of a session.
+        """
+    return(os.path.join(fulldirname, config['dir_logs'], store_filename))
+
+# -----------------------------------------------------------------------
+def connect(fulldirname, config, create=True):
+    r"""
+        This function opens the results store of a session. The stages
+        of a session are run by several processes, a process waits for
+        the end of the transaction of another one (timeout of 60s).
+
+        Parameters:
+        -----------
+        fulldirname: string
+        The name of the session directory
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        create: boolean
+        If True the store is created if it does not exist (default is True)
+
+        Returns
+        -------
+        connection: sqlite3 connection (None if the store does not exist
+        and create is False)
+
+        """
+    filename = get_store_filename(fulldirname, config)
+    if not os.path.isfile(filename):
+        if not create:
+            return(None)
+        general_tools.checkdir(os.path.dirname(filename))
+    connection = sqlite3.connect(filename, timeout=60)
+    connection.executescript(_schema)
+    return(connection)
+
+# -----------------------------------------------------------------------
+def make_records(metric, values, unit='', items=None):
+    r"""
+        This function builds the records of a set of values.
+
+        Parameters:
+        -----------
+        metric: string
+        The name of the measured quantity
+
+        values: number, string or array
+        The values
+
+        unit: string
+        The unit of the values (default is '')
+
+        items: list of strings
+        The items of the values (default is None, '' for a single value
+        and the index of the value otherwise)
+
+        Returns
+        -------
+        records: list of tuples (metric, item, value, unit)
+
+        """
+    if np.ndim(values) == 0:
+        return([(metric, '' if items is None else items[0], values, unit)])
+    if items is None:
+        items = ['{0:02d}'.format(i) for i in range(len(values))]
+    return([(metric, item, value, unit) for item, value in zip(items, values)])
+
+# -----------------------------------------------------------------------
+def record(fulldirname, config, source, records):
+    r"""
+        This function saves the measurements of a processing function. The
+        previous records of the function are replaced.
+
+        Parameters:
+        -----------
+        fulldirname: string
+        The name of the session directory
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        source: string
+        The name of the processing function
+
+        records: list of tuples (metric, item, value, unit)
+        The measurements (see make_records). The values can be numbers,
+        booleans or strings.
+
+        Returns
+        -------
+        Nothing
+
+        """
+    recorded = datetime.datetime.now().isoformat(timespec='seconds')
+    rows = []
+    for metric, item, value, unit in records:
+        if isinstance(value, (str, np.str_)):
+            rows.append((source, metric, str(item), None, str(value), unit, recorded))
+        else:
+            rows.append((source, metric, str(item), float(value), None, unit, recorded))
+    connection = connect(fulldirname, config)
+    try:
+        with connection:
+            connection.execute("DELETE FROM metrics WHERE source = ?", (source,))
+            connection.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        connection.close()
+
+# -----------------------------------------------------------------------
+def record_hk_violations(fulldirname, config, violations):
+    r"""
+        This function saves the house keeping limit violations of a session
+        (see hk_tools.find_hk_violations). The previous ones are replaced.
+        """
+    rows = [(str(violations['hk'][i]), str(violations['level'][i]), str(violations['start'][i]), \
+             str(violations['end'][i]), float(violations['duration'][i]), \
+             int(violations['n_samples'][i]), float(violations['peak'][i])) \
+            for i in range(len(violations['hk']))]
+    connection = connect(fulldirname, config)
+    try:
+        with connection:
+            connection.execute("DELETE FROM hk_violations")
+            connection.executemany("INSERT INTO hk_violations VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        connection.close()
+
+# -----------------------------------------------------------------------
+def to_columns(rows, columns):
+    r"""
+        This function converts rows of a query to a dictionnary of arrays.
+        """
+    table = {}
+    for i, column in enumerate(columns):
+        values = [row[i] for row in rows]
+        if column == 'value':
+            table[column] = np.array([np.nan if value is None else value for value in values], dtype=float)
+        else:
+            table[column] = np.array(['' if value is None else value for value in values], dtype=str)
+    return(table)
+
+# -----------------------------------------------------------------------
+def query(fulldirname, config, source=None, metric=None, item=None):
+    r"""
+        This function reads measurements of a session.
+
+        Parameters:
+        -----------
+        fulldirname: string
+        The name of the session directory
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        source, metric, item: strings
+        Selection of the records (default is None, no selection). The SQL
+        wildcards can be used ('%' and '_').
+
+        Returns
+        -------
+        results: dictionnary of arrays
+        source, metric, item, value (nan for text values), text, unit,
+        recorded (one entry per record)
+
+        """
+    conditions, parameters = [], []
+    for column, pattern in (('source', source), ('metric', metric), ('item', item)):
+        if pattern is not None:
+            conditions.append(column+" LIKE ?")
+            parameters.append(pattern)
+    request = "SELECT "+", ".join(_metrics_columns)+" FROM metrics"
+    if len(conditions) > 0:
+        request += " WHERE "+" AND ".join(conditions)
+    request += " ORDER BY source, metric, item"
+
+    rows = []
+    connection = connect(fulldirname, config, create=False)
+    if connection is not None:
+        try:
+            rows = connection.execute(request, parameters).fetchall()
+        finally:
+            connection.close()
+    return(to_columns(rows, _metrics_columns))
+
+# -----------------------------------------------------------------------
+def get_value(fulldirname, config, metric, item='', source=None):
+    r"""
+        This function returns the value of a measurement of a session
+        (nan if it has not been recorded).
+        """
+    results = query(fulldirname, config, source, metric, item)
+    if len(results['value']) == 0:
+        return(np.nan)
+    return(results['value'][0])
+
+# -----------------------------------------------------------------------
+def get_hk_violations(fulldirname, config):
+    r"""
+        This function reads the house keeping limit violations of a session.
+
+        Returns
+        -------
+        violations: dictionnary of arrays
+        hk, level, start, end, duration, n_samples, peak
+
+        """
+    columns = ('hk', 'level', 'start', 'end', 'duration', 'n_samples', 'peak')
+    rows = []
+    connection = connect(fulldirname, config, create=False)
+    if connection is not None:
+        try:
+            rows = connection.execute("SELECT "+", ".join(columns)+" FROM hk_violations").fetchall()
+        finally:
+            connection.close()
+    violations = {
+        'hk': np.array([row[0] for row in rows], dtype=str),
+        'level': np.array([row[1] for row in rows], dtype=str),
+        'start': np.array([row[2] for row in rows], dtype='datetime64[ms]'),
+        'end': np.array([row[3] for row in rows], dtype='datetime64[ms]'),
+        'duration': np.array([row[4] for row in rows], dtype=float),
+        'n_samples': np.array([row[5] for row in rows], dtype=int),
+        'peak': np.array([row[6] for row in rows], dtype=float)
+        }
+    return(violations)
+
+# -----------------------------------------------------------------------
+def query_sessions(path_tests, config, sessions, source=None, metric=None, item=None):
+    r"""
+        This function reads measurements of several sessions (for trends).
+
+        Parameters:
+        -----------
+        path_tests: string
+        The name of the directory containing the sessions
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        sessions: list of strings
+        The names of the sessions
+
+        source, metric, item: strings
+        Selection of the records (see query)
+
+        Returns
+        -------
+        results: dictionnary of arrays
+        session and the columns returned by query
+
+        """
+    tables = []
+    for session in sessions:
+        table = query(os.path.join(path_tests, session), config, source, metric, item)
+        table['session'] = np.array([session]*len(table['value']), dtype=str)
+        tables.append(table)
+    if len(tables) == 0:
+        tables.append(dict(to_columns([], _metrics_columns), session=np.array([], dtype=str)))
+    return({key: np.concatenate([table[key] for table in tables]) for key in tables[0].keys()})
+
+# -----------------------------------------------------------------------
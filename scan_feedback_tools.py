@@ -17,6 +17,7 @@
 # Imports
 import os
 import general_tools
+import results_store
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits
@@ -121,6 +122,7 @@ def plot_scanfb(scanfbdata, fulldirname, config, limit_error):
     ax2.set_ylabel('Phase - fit (deg)')
     fig.tight_layout()
     plt.savefig(pltfilename, bbox_inches='tight')
+    plt.close()
 
 # -----------------------------------------------------------------------
 def check_scanfb(fulldirname, config, limit_error=1.5, make_plot=True):
@@ -152,6 +154,7 @@ def check_scanfb(fulldirname, config, limit_error=1.5, make_plot=True):
     fmax_khz=5e3
 
     scanfb_ok=False
+    records=[]
     sfb_dat = get_scanfb(fulldirname, config)
 
     if sfb_dat !=0:
@@ -159,12 +162,16 @@ def check_scanfb(fulldirname, config, limit_error=1.5, make_plot=True):
             plot_scanfb(sfb_dat, fulldirname, config, limit_error)
         # computing index of the band of interest
         i_interest=np.where((sfb_dat['Freq(kHz)']>fmin_khz) & (sfb_dat['Freq(kHz)']<fmax_khz))[0]
-        scanfb_ok=abs(sfb_dat['Phi-fit(deg)'][i_interest]).max()<=limit_error
+        phase_error=abs(sfb_dat['Phi-fit(deg)'][i_interest]).max()
+        scanfb_ok=phase_error<=limit_error
+        records.append(('max_phase_error', '', phase_error, 'deg'))
         if not scanfb_ok:
             print('   >> Warning Phase compensation error is greater than {0:3.1} deg'.format(limit_error))
     else:
         print('  >> Warning! There is no scanfeedback data.')
 
+    records.append(('scanfb_ok', '', scanfb_ok, ''))
+    results_store.record(fulldirname, config, 'check_scanfb', records)
     return(scanfb_ok)
 
 # -----------------------------------------------------------------------
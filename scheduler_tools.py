@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------
+"""
+    scheduler_tools module
+    ======================
+
+    Developped by: L. Ravera
+
+    Project: Athena X-IFU / DRE-DEMUX
+
+    Tools to run the processing stages of a test session concurrently.
+
+    A stage is a dictionnary with the keys:
+        'name': name of the stage
+        'func': function called as func(fulldirname, config, **inputs), it
+                returns a dictionnary containing the outputs of the stage
+        'inputs': list of the names of the outputs needed by the stage
+        'outputs': list of the names of the outputs produced by the stage
+
+    Independent stages are run on a pool of processes. A stage is started
+    as soon as all its inputs are available.
+
+    """
+
+# -----------------------------------------------------------------------
+# Imports
+import time
+import numpy as np
+import matplotlib
+import plot_tools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# -----------------------------------------------------------------------
+def init_worker():
+    r"""
+        This function initialises the worker processes. Plots are only
+        saved in files, a non interactive backend is used.
+        """
+    matplotlib.use('Agg')
+
+# -----------------------------------------------------------------------
+def run_stage(func, fulldirname, config, inputs):
+    r"""
+        This function runs a stage and measures its duration (including
+        the rendering of its plots).
+
+        Returns
+        -------
+        outputs: dictionnary
+        The outputs of the stage
+
+        duration: number
+        The duration of the stage (s)
+
+        """
+    t0 = time.perf_counter()
+    outputs = func(fulldirname, config, **inputs)
+    plot_tools.wait()
+    if outputs is None:
+        outputs = {}
+    return(outputs, time.perf_counter()-t0)
+
+# -----------------------------------------------------------------------
+def check_stages(stages):
+    r"""
+        This function checks the consistency of a list of stages: the names
+        must be unique, each input must be produced by exactly one stage and
+        the dependencies must not contain any cycle.
+        """
+    names = [stage['name'] for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Stage names must be unique")
+
+    producers = {}
+    for stage in stages:
+        for output in stage['outputs']:
+            if output in producers:
+                raise ValueError("Output {0:s} is produced by stages {1:s} and {2:s}" \
+                    .format(output, producers[output], stage['name']))
+            producers[output] = stage['name']
+    for stage in stages:
+        for item in stage['inputs']:
+            if item not in producers:
+                raise ValueError("Input {0:s} of stage {1:s} is not produced by any stage" \
+                    .format(item, stage['name']))
+
+    # Topological sort (the stages which can't be sorted are in a cycle)
+    available = set()
+    remaining = list(stages)
+    while len(remaining) > 0:
+        ready = [stage for stage in remaining if set(stage['inputs']) <= available]
+        if len(ready) == 0:
+            raise ValueError("Cycle in the dependencies of stages: " \
+                + ", ".join([stage['name'] for stage in remaining]))
+        for stage in ready:
+            available.update(stage['outputs'])
+            remaining.remove(stage)
+
+# -----------------------------------------------------------------------
+def select_stages(stages, names):
+    r"""
+        This function selects some stages of a list and the stages producing
+        their inputs (recursively).
+
+        Parameters:
+        -----------
+        stages: list of dictionnaries
+        The stages (see module description)
+
+        names: list of strings
+        The names of the stages to be selected
+
+        Returns
+        -------
+        selection: list of dictionnaries
+        The selected stages (in the order of the list)
+
+        """
+    producers = {}
+    for stage in stages:
+        for output in stage['outputs']:
+            producers[output] = stage['name']
+    by_name = {stage['name']: stage for stage in stages}
+    for name in names:
+        if name not in by_name:
+            raise ValueError("Unknown stage: {0:s}".format(name))
+
+    selected = set()
+    to_visit = list(names)
+    while len(to_visit) > 0:
+        name = to_visit.pop()
+        if name not in selected:
+            selected.add(name)
+            to_visit.extend([producers[item] for item in by_name[name]['inputs'] if item in producers])
+    return([stage for stage in stages if stage['name'] in selected])
+
+# -----------------------------------------------------------------------
+def run_stages(stages, fulldirname, config, n_workers=None, verbose=False):
+    r"""
+        This function runs a list of stages on a pool of processes. Each
+        stage is submitted as soon as its inputs are available. If a stage
+        fails its error is reported and the stages depending on it are
+        skipped, the other stages are still run.
+
+        Parameters:
+        -----------
+        stages: list of dictionnaries
+        The stages (see module description)
+
+        fulldirname: string
+        The name of the session directory
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        n_workers: number
+        Number of processes (default is None, the number of processors).
+        If n_workers is 1 the stages are run sequentially in the calling
+        process.
+
+        verbose: boolean
+        If True the start and the end of the stages are printed
+
+        Returns
+        -------
+        results: dictionnary
+        The outputs of all the stages which have been run successfully
+
+        durations: dictionnary
+        The duration (s) of each stage (nan if the stage failed or was skipped)
+
+        """
+    check_stages(stages)
+
+    results = {}
+    durations = {}
+    missing = set()         # outputs which will never be available
+    pending = list(stages)
+    running = {}
+
+    def finish(stage, outputs, duration):
+        durations[stage['name']] = duration
+        for output in stage['outputs']:
+            if output in outputs:
+                results[output] = outputs[output]
+            else:
+                print("  Stage {0:s} did not produce {1:s}".format(stage['name'], output))
+                missing.add(output)
+        if verbose:
+            print("  Stage {0:s} done in {1:.1f}s".format(stage['name'], duration))
+
+    def fail(stage, err):
+        print("  Stage {0:s} failed: {1}".format(stage['name'], err))
+        durations[stage['name']] = np.nan
+        missing.update(stage['outputs'])
+
+    def next_stages():
+        # Removes the stages which can't be run anymore and returns the ready ones
+        ready = []
+        for stage in list(pending):
+            if len(missing.intersection(stage['inputs'])) > 0:
+                print("  Stage {0:s} skipped (missing inputs)".format(stage['name']))
+                durations[stage['name']] = np.nan
+                missing.update(stage['outputs'])
+                pending.remove(stage)
+            elif set(stage['inputs']) <= set(results.keys()):
+                ready.append(stage)
+                pending.remove(stage)
+        return(ready)
+
+    if n_workers == 1:
+        while len(pending) > 0:
+            for stage in next_stages():
+                if verbose:
+                    print("  Starting stage {0:s}".format(stage['name']))
+                inputs = {item: results[item] for item in stage['inputs']}
+                try:
+                    outputs, duration = run_stage(stage['func'], fulldirname, config, inputs)
+                except Exception as err:
+                    fail(stage, err)
+                else:
+                    finish(stage, outputs, duration)
+        return(results, durations)
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for stage in next_stages():
+                if verbose:
+                    print("  Starting stage {0:s}".format(stage['name']))
+                inputs = {item: results[item] for item in stage['inputs']}
+                future = executor.submit(run_stage, stage['func'], fulldirname, config, inputs)
+                running[future] = stage
+            if len(running) == 0:
+                continue
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    outputs, duration = future.result()
+                except Exception as err:
+                    fail(stage, err)
+                else:
+                    finish(stage, outputs, duration)
+    return(results, durations)
+
+# -----------------------------------------------------------------------
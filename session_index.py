@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------
+"""
+    session_index module
+    ====================
+
+    Developped by: L. Ravera
+
+    Project: Athena X-IFU / DRE-DEMUX
+
+    Tools to index the files of a test session. Each directory (DATA, HK)
+    is scanned once, the file names are parsed and the result is kept in
+    a cached table which is queried by the processing modules.
+
+    File names follow the convention YYYYMMDD_HHMMSS_NNNN_<test>.<ext>
+    and for GBW tests <test> is <type>_GBW_<frequency>_..._<gain>.
+
+    """
+
+# -----------------------------------------------------------------------
+# Imports
+import os
+import numpy as np
+import get_data
+
+# Cached indexes: absolute directory name -> (modification time, index)
+_indexes = {}
+
+# -----------------------------------------------------------------------
+def get_dumptype_from_file(filename):
+    r"""
+        This function reads the header of a DRE dump file and returns its dump type.
+
+        Parameters:
+        -----------
+        filename: string
+        The name of the dump file (with the path)
+
+        Returns
+        -------
+        dumptype: number
+        Identifier for the type of dump (-1 if the file is not a DRE dump file).
+
+        """
+    DADA=-9510      # 0xDADA interpreted as int16
+    with open(filename, 'rb') as f:
+        header=np.frombuffer(f.read(4), dtype='<h')
+    if len(header) < 2 or header[0] != DADA:
+        return(-1)
+    return(get_data.get_dumptype(header[1]))
+
+# -----------------------------------------------------------------------
+def parse_filename(name):
+    r"""
+        This function extracts the informations coded in a file name.
+
+        Parameters:
+        -----------
+        name: string
+        The name of the file (without the path)
+
+        Returns
+        -------
+        fields: dictionnary
+        timestamp (datetime64, NaT if not available), file_nb (-1 if not available),
+        test (characters 21 up to the extension), ext (extension),
+        gbw_freq (GBW tests only, nan otherwise), gain (GBW tests only, '' otherwise)
+
+        """
+    ext = os.path.splitext(name)[1]
+    i_fich_deb, i_fich_fin = 16, 20
+    i_test_deb = 21
+    i_gbw_deb, i_gbw_fin = 27, 31
+    i_freq_deb, i_freq_fin = 32, 39
+    i_gain_deb = 46
+
+    timestamp = np.datetime64('NaT')
+    if len(name) >= 15 and name[:8].isdigit() and name[8] == '_' and name[9:15].isdigit():
+        timestamp = np.datetime64('{0:s}-{1:s}-{2:s}T{3:s}:{4:s}:{5:s}' \
+            .format(name[:4], name[4:6], name[6:8], name[9:11], name[11:13], name[13:15]))
+
+    file_nb = -1
+    if name[i_fich_deb:i_fich_fin].isdigit():
+        file_nb = int(name[i_fich_deb:i_fich_fin])
+
+    test = name[i_test_deb:len(name)-len(ext)]
+
+    gbw_freq, gain = np.nan, ''
+    if name[i_gbw_deb:i_gbw_fin] == "_GBW":
+        try:
+            gbw_freq = float(name[i_freq_deb:i_freq_fin])
+        except ValueError:
+            pass
+        gain = name[i_gain_deb:len(name)-len(ext)]
+
+    return({'timestamp': timestamp, 'file_nb': file_nb, 'test': test, 'ext': ext, \
+            'gbw_freq': gbw_freq, 'gain': gain})
+
+# -----------------------------------------------------------------------
+def scan_dir(dirname):
+    r"""
+        This function scans a directory and builds the index of its files.
+
+        Parameters:
+        -----------
+        dirname: string
+        The name of the directory
+
+        Returns
+        -------
+        index: dictionnary of arrays (one entry per file, sorted by name)
+        name, timestamp, file_nb, test, ext, gbw_freq, gain, dumptype (-1 if
+        the file is not a DRE .dat dump file)
+
+        """
+    with os.scandir(dirname) as entries:
+        names = sorted([entry.name for entry in entries if entry.is_file()])
+
+    columns = {'name': names, 'timestamp': [], 'file_nb': [], 'test': [], 'ext': [], \
+               'gbw_freq': [], 'gain': [], 'dumptype': []}
+    for name in names:
+        fields = parse_filename(name)
+        for key in fields.keys():
+            columns[key].append(fields[key])
+        dumptype = -1
+        if fields['ext'] == '.dat':
+            dumptype = get_dumptype_from_file(os.path.join(dirname, name))
+        columns['dumptype'].append(dumptype)
+
+    index = {
+        'name': np.array(columns['name'], dtype=str),
+        'timestamp': np.array(columns['timestamp'], dtype='datetime64[s]'),
+        'file_nb': np.array(columns['file_nb'], dtype=int),
+        'test': np.array(columns['test'], dtype=str),
+        'ext': np.array(columns['ext'], dtype=str),
+        'gbw_freq': np.array(columns['gbw_freq'], dtype=float),
+        'gain': np.array(columns['gain'], dtype=str),
+        'dumptype': np.array(columns['dumptype'], dtype=int)
+        }
+    return(index)
+
+# -----------------------------------------------------------------------
+def empty_index():
+    r"""
+        This function returns an empty index.
+        """
+    return({'name': np.array([], dtype=str), 'timestamp': np.array([], dtype='datetime64[s]'), \
+            'file_nb': np.array([], dtype=int), 'test': np.array([], dtype=str), \
+            'ext': np.array([], dtype=str), 'gbw_freq': np.array([], dtype=float), \
+            'gain': np.array([], dtype=str), 'dumptype': np.array([], dtype=int)})
+
+# -----------------------------------------------------------------------
+def get_index(dirname):
+    r"""
+        This function returns the index of a directory. The directory is
+        scanned only if it has been modified since the last scan.
+
+        Parameters:
+        -----------
+        dirname: string
+        The name of the directory
+
+        Returns
+        -------
+        index: dictionnary of arrays (see scan_dir)
+
+        """
+    fulldirname = os.path.abspath(dirname)
+    if not os.path.isdir(fulldirname):
+        return(empty_index())
+    mtime = os.stat(fulldirname).st_mtime_ns
+    if fulldirname not in _indexes or _indexes[fulldirname][0] != mtime:
+        _indexes[fulldirname] = (mtime, scan_dir(fulldirname))
+    return(_indexes[fulldirname][1])
+
+# -----------------------------------------------------------------------
+def select(dirname, ext=None, test=None, test_prefix=None, suffix=None, dumptype=None):
+    r"""
+        This function selects the entries of a directory index.
+
+        Parameters:
+        -----------
+        dirname: string
+        The name of the directory
+
+        ext: string
+        Extension of the files (for instance '.dat'), default is None (no selection)
+
+        test: string
+        Exact test name (characters 21 up to the extension), default is None
+
+        test_prefix: string
+        Beginning of the test name, default is None
+
+        suffix: string
+        End of the file name (including the extension), default is None
+
+        dumptype: number
+        Dump type read from the file header, default is None
+
+        Returns
+        -------
+        index: dictionnary of arrays (see scan_dir) restricted to the selected files
+
+        """
+    index = get_index(dirname)
+    selection = np.ones(len(index['name']), dtype=bool)
+    if ext is not None:
+        selection &= index['ext'] == ext
+    if test is not None:
+        selection &= index['test'] == test
+    if test_prefix is not None:
+        selection &= np.char.startswith(index['test'], test_prefix)
+    if suffix is not None:
+        selection &= np.char.endswith(index['name'], suffix)
+    if dumptype is not None:
+        selection &= index['dumptype'] == dumptype
+    return({key: index[key][selection] for key in index.keys()})
+
+# -----------------------------------------------------------------------
+def get_files(dirname, ext=None, test=None, test_prefix=None, suffix=None, dumptype=None):
+    r"""
+        This function returns the names of the files of a directory which
+        match a selection (see select).
+
+        Returns
+        -------
+        names: list of strings
+        The selected file names (without the path), sorted by name
+
+        """
+    return([str(name) for name in select(dirname, ext, test, test_prefix, suffix, dumptype)['name']])
+
+# -----------------------------------------------------------------------
+def get_session_index(fulldirname, config):
+    r"""
+        This function returns the indexes of the DATA and HK directories of
+        a test session.
+
+        Parameters:
+        -----------
+        fulldirname: string
+        The name of the session directory
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        Returns
+        -------
+        session_index: dictionnary
+        'data' and 'hk' indexes (see scan_dir)
+
+        """
+    return({'data': get_index(os.path.join(fulldirname, config['dir_data'])), \
+            'hk': get_index(os.path.join(fulldirname, config['dir_hk']))})
+
+# -----------------------------------------------------------------------
+def get_sessions(path_tests, config):
+    r"""
+        This function returns the names of the session directories (the
+        directories containing a DATA or a HK directory).
+
+        Parameters:
+        -----------
+        path_tests: string
+        The name of the directory containing the sessions
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        Returns
+        -------
+        sessions: list of strings
+        The names of the sessions (without the path)
+
+        """
+    sessions = []
+    with os.scandir(path_tests) as entries:
+        for entry in entries:
+            if entry.is_dir() and (os.path.isdir(os.path.join(entry.path, config['dir_data'])) \
+                                   or os.path.isdir(os.path.join(entry.path, config['dir_hk']))):
+                sessions.append(entry.name)
+    return(sorted(sessions))
+
+# -----------------------------------------------------------------------
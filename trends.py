@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------
+"""
+    trends module
+    =============
+
+    Developped by: L. Ravera
+
+    Project: Athena X-IFU / DRE-DEMUX
+
+    Trends of the main performances over the test sessions of path_tests
+    (GBW, mean spurious level, carrier noise power, energy resolution).
+
+    The measurements are read from the results store of each session (see
+    results_store). The sessions are read concurrently and a summary of
+    each session is kept in a cache (TRENDS directory of path_tests), a
+    session is read again only if its results store has changed.
+
+    Usage:
+        python trends.py
+
+    """
+
+# -----------------------------------------------------------------------
+# Imports
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+import general_tools, session_index, results_store, plot_tools
+
+dir_trends = 'TRENDS'
+
+# Trended quantities: (name, source, metric, item, unit, label)
+trend_metrics = [
+    ('gbw', 'process_gbw', 'gbw', '0', 'Hz', 'Gain bandwidth product'),
+    ('mean_spur', 'process_iq_multi', 'mean_spur_dbc', '', 'dBc', 'Mean strongest spurious (IQ)'),
+    ('carrier_noise_fbck', 'process_dump', 'mean_noise_db', 'FBCK', 'dBFS', 'Carrier noise power (feedback)'),
+    ('carrier_noise_bias', 'process_dump', 'mean_noise_db', 'BIAS', 'dBFS', 'Carrier noise power (bias)'),
+    ('energy_resolution', 'ep', 'mean_energy_resolution', '', 'eV', 'Energy resolution')
+    ]
+
+# -----------------------------------------------------------------------
+def get_store_signature(fulldirname, config):
+    r"""
+        This function returns the signature of the results store of a
+        session ('' if the session has no results store).
+        """
+    filename = results_store.get_store_filename(fulldirname, config)
+    if not os.path.isfile(filename):
+        return('')
+    return(general_tools.get_file_signature(filename))
+
+# -----------------------------------------------------------------------
+def get_session_summary(path_tests, session, config):
+    r"""
+        This function reads the trended quantities of a session.
+
+        Parameters:
+        -----------
+        path_tests: string
+        The name of the directory containing the sessions
+
+        session: string
+        The name of the session
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        Returns
+        -------
+        summary: dictionnary
+        session, signature (of the results store), time (date of the first
+        data or hk file of the session) and the trended quantities (nan if not
+        measured)
+
+        """
+    fulldirname = os.path.join(path_tests, session)
+    summary = {'session': session, 'signature': get_store_signature(fulldirname, config)}
+
+    index = session_index.get_session_index(fulldirname, config)
+    timestamps = np.concatenate((index['data']['timestamp'], index['hk']['timestamp']))
+    timestamps = timestamps[~np.isnat(timestamps)]
+    summary['time'] = timestamps.min() if len(timestamps) > 0 else np.datetime64('NaT', 's')
+
+    results = results_store.query(fulldirname, config)
+    for name, source, metric, item, _, _ in trend_metrics:
+        i = np.where((results['source'] == source) & (results['metric'] == metric) \
+                     & (results['item'] == item))[0]
+        summary[name] = results['value'][i[0]] if len(i) > 0 else np.nan
+    return(summary)
+
+# -----------------------------------------------------------------------
+def load_summaries(cachefilename):
+    r"""
+        This function loads the cached session summaries.
+
+        Returns
+        -------
+        summaries: dictionnary
+        session name -> summary (see get_session_summary)
+
+        """
+    summaries = {}
+    if os.path.isfile(cachefilename):
+        with np.load(cachefilename) as npz:
+            columns = {key: npz[key] for key in npz.files}
+        if all([name in columns for name, _, _, _, _, _ in trend_metrics]):
+            for i in range(len(columns['session'])):
+                session = str(columns['session'][i])
+                summaries[session] = {key: columns[key][i] for key in columns.keys()}
+                summaries[session]['session'] = session
+                summaries[session]['signature'] = str(columns['signature'][i])
+    return(summaries)
+
+# -----------------------------------------------------------------------
+def to_columns(summaries):
+    r"""
+        This function converts a list of session summaries to a dictionnary
+        of arrays sorted by time.
+        """
+    columns = {
+        'session': np.array([summary['session'] for summary in summaries], dtype=str),
+        'signature': np.array([summary['signature'] for summary in summaries], dtype=str),
+        'time': np.array([summary['time'] for summary in summaries], dtype='datetime64[s]')
+        }
+    for name, _, _, _, _, _ in trend_metrics:
+        columns[name] = np.array([summary[name] for summary in summaries], dtype=float)
+    order = np.lexsort((columns['session'], columns['time']))
+    return({key: columns[key][order] for key in columns.keys()})
+
+# -----------------------------------------------------------------------
+def collect_summaries(path_tests, config, n_workers=16, use_cache=True):
+    r"""
+        This function collects the summaries of all the sessions of
+        path_tests. The sessions are read by a pool of threads (the work is
+        mostly waiting for the file system).
+
+        Parameters:
+        -----------
+        path_tests: string
+        The name of the directory containing the sessions
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        n_workers: number
+        Number of threads (default is 16)
+
+        use_cache: boolean
+        If True the summaries of the unchanged sessions are read from the
+        cache (default is True)
+
+        Returns
+        -------
+        summaries: dictionnary of arrays
+        One entry per session, sorted by time (see get_session_summary)
+
+        """
+    trendsdirname = os.path.join(path_tests, dir_trends)
+    cachefilename = os.path.join(trendsdirname, 'trends_summaries.npz')
+    cached = load_summaries(cachefilename) if use_cache else {}
+
+    sessions = session_index.get_sessions(path_tests, config)
+    print("{0:4d} sessions found.".format(len(sessions)))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        signatures = list(executor.map(lambda session: \
+            get_store_signature(os.path.join(path_tests, session), config), sessions))
+        to_read = [session for session, signature in zip(sessions, signatures) \
+                   if session not in cached or cached[session]['signature'] != signature]
+        print("{0:4d} sessions to read ({1:d} from the cache).".format(len(to_read), len(sessions)-len(to_read)))
+        new_summaries = list(executor.map(lambda session: \
+            get_session_summary(path_tests, session, config), to_read))
+
+    read = set(to_read)
+    summaries = [cached[session] for session in sessions if session not in read] + new_summaries
+    summaries = to_columns(summaries)
+
+    general_tools.checkdir(trendsdirname)
+    tmpfilename = cachefilename+'.{0:d}.tmp'.format(os.getpid())
+    with open(tmpfilename, 'wb') as f:
+        np.savez(f, **summaries)
+    os.replace(tmpfilename, cachefilename)
+    return(summaries)
+
+# -----------------------------------------------------------------------
+def save_trends_csv(summaries, csvfilename):
+    r"""
+        This function writes the session summaries in a csv file (one line
+        per session, ';' separated).
+        """
+    names = [name for name, _, _, _, _, _ in trend_metrics]
+    units = [unit for _, _, _, _, unit, _ in trend_metrics]
+    with open(csvfilename, 'w') as csvfile:
+        csvfile.write("Session;Date;"+";".join(names)+";\n")
+        csvfile.write(";;"+";".join(units)+";\n")
+        for i in range(len(summaries['session'])):
+            values = ["" if np.isnan(summaries[name][i]) else "{0:.4f}".format(summaries[name][i]) for name in names]
+            time = "" if np.isnat(summaries['time'][i]) else str(summaries['time'][i])
+            csvfile.write(summaries['session'][i]+";"+time+";"+";".join(values)+";\n")
+
+# -----------------------------------------------------------------------
+def plot_trends(summaries, pltfilename):
+    r"""
+        This function plots the trended quantities versus the date of the
+        sessions (the sessions without date are not plotted).
+        """
+    dated = ~np.isnat(summaries['time'])
+    fig = plt.figure(figsize=(10, 3*len(trend_metrics)))
+    for i_metric, (name, _, _, _, unit, label) in enumerate(trend_metrics):
+        ax = fig.add_subplot(len(trend_metrics), 1, i_metric+1)
+        measured = dated & ~np.isnan(summaries[name])
+        ax.plot(summaries['time'][measured], summaries[name][measured], 'o-')
+        ax.set_ylabel(unit)
+        ax.set_title(label)
+        ax.grid(alpha=0.5)
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    plt.savefig(pltfilename, bbox_inches='tight')
+    plt.close()
+
+# -----------------------------------------------------------------------
+def trends(path_tests=None, n_workers=16, use_cache=True):
+    r"""
+        This function computes the trends over the test sessions and saves
+        them in the TRENDS directory of path_tests (csv file and plot).
+
+        Parameters:
+        -----------
+        path_tests: string
+        The name of the directory containing the sessions (default is None,
+        the path_tests value of the configuration file)
+
+        n_workers: number
+        Number of threads reading the sessions (default is 16)
+
+        use_cache: boolean
+        If True the cached summaries of the unchanged sessions are used
+        (default is True)
+
+        Returns
+        -------
+        summaries: dictionnary of arrays
+        One entry per session, sorted by time (see get_session_summary)
+
+        """
+    config = general_tools.get_csv('demux_tools_cfg.csv')
+    if path_tests is None:
+        path_tests = os.path.normcase(config['path_tests'])
+
+    summaries = collect_summaries(path_tests, config, n_workers, use_cache)
+
+    trendsdirname = os.path.join(path_tests, dir_trends)
+    save_trends_csv(summaries, os.path.join(trendsdirname, 'trends.csv'))
+    plot_tools.submit(plot_trends, summaries, os.path.join(trendsdirname, 'PLOT_TRENDS.png'))
+    plot_tools.wait()
+    return(summaries)
+
+# -----------------------------------------------------------------------
+# The guard is needed because the plots are rendered by a pool of processes
+if __name__ == "__main__":
+    trends()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------
+"""
+    watch_sessions module
+    =====================
+
+    Developped by: L. Ravera
+
+    Project: Athena X-IFU / DRE-DEMUX
+
+    Watcher of the test sessions directory (path_tests). The new session
+    directories and the new files of the sessions (DATA and HK directories)
+    are detected and only the processing stages fed by these files are run
+    (see process_demux_proto_tests.stage_triggers), in incremental mode.
+
+    A file is processed once its size and its modification time have not
+    changed for settle_time seconds (files still being written are not
+    read). The sessions are processed by a bounded pool of processes, a
+    session is never processed by two processes at the same time.
+
+    The directories are watched with inotify if the inotify_simple package
+    is available (Linux), they are polled otherwise. The files written by
+    the processing itself (LOGS, PLOTS, cache files) are ignored.
+
+    Usage:
+        python watch_sessions.py
+
+    """
+
+# -----------------------------------------------------------------------
+# Imports
+import os, time, signal
+from concurrent.futures import ProcessPoolExecutor
+import general_tools
+import session_index
+import process_demux_proto_tests as pdpt
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Files written by the processing
+ignored_extensions = ('.npz', '.tmp')
+
+# -----------------------------------------------------------------------
+def get_affected_stages(dir_key, name):
+    r"""
+        This function returns the processing stages fed by a file.
+
+        Parameters:
+        -----------
+        dir_key: string
+        The key of the directory of the file in the configuration
+        ('dir_data' or 'dir_hk')
+
+        name: string
+        The name of the file (without the path)
+
+        Returns
+        -------
+        stage_names: set of strings
+        The names of the stages (empty if the file is not an input file)
+
+        """
+    stage_names = set()
+    if os.path.splitext(name)[1] in ignored_extensions:
+        return(stage_names)
+    test = session_index.parse_filename(name)['test']
+    for trigger_dir, kind, pattern, names in pdpt.stage_triggers:
+        if trigger_dir != dir_key:
+            continue
+        if (kind == 'prefix' and test.startswith(pattern)) \
+            or (kind == 'suffix' and name.endswith(pattern)) \
+            or (kind == 'contains' and pattern in name):
+            stage_names.update(names)
+    return(stage_names)
+
+# -----------------------------------------------------------------------
+def snapshot(fulldirname, config):
+    r"""
+        This function lists the input files of a session with their
+        signature (size and modification time).
+
+        Parameters:
+        -----------
+        fulldirname: string
+        The name of the session directory
+
+        config: dictionnary
+        Contains path and constants definitions
+
+        Returns
+        -------
+        files: dictionnary
+        (directory key, file name) -> signature
+
+        """
+    files = {}
+    for dir_key in ('dir_data', 'dir_hk'):
+        dirname = os.path.join(fulldirname, config[dir_key])
+        if not os.path.isdir(dirname):
+            continue
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                if entry.is_file() and os.path.splitext(entry.name)[1] not in ignored_extensions:
+                    try:
+                        files[(dir_key, entry.name)] = general_tools.get_file_signature(entry.path)
+                    except FileNotFoundError:
+                        pass    # removed meanwhile
+    return(files)
+
+# -----------------------------------------------------------------------
+def init_worker():
+    r"""
+        This function initialises the processes of the watcher pool. Ctrl-C
+        only stops the watcher, the running tasks are completed.
+        """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# -----------------------------------------------------------------------
+def process_session(fulldirname, stage_names):
+    r"""
+        This function runs the stages affected by new files on a session
+        (task of the watcher pool). The stages are run sequentially in the
+        process of the task, the plots are rendered synchronously.
+        """
+    pdpt.process_demux_proto_tests(fulldirname, n_workers=1, plot_mode='sync', incremental=True, \
+                                   stage_names=sorted(stage_names))
+
+# -----------------------------------------------------------------------
+def init_inotify(path_tests, sessions, config):
+    r"""
+        This function creates the inotify watches on the sessions directory,
+        on the sessions and on their DATA and HK directories.
+
+        Returns
+        -------
+        inotify: INotify object (None if inotify is not available)
+
+        watches: dictionnary
+        watch descriptor -> (session name or None, directory key or None)
+
+        """
+    if INotify is None:
+        return(None, {})
+    inotify = INotify()
+    watches = {}
+    watches[inotify.add_watch(path_tests, flags.CREATE | flags.MOVED_TO)] = (None, None)
+    for session in sessions:
+        add_session_watches(inotify, watches, path_tests, session, config)
+    return(inotify, watches)
+
+# -----------------------------------------------------------------------
+def add_session_watches(inotify, watches, path_tests, session, config):
+    r"""
+        This function creates the inotify watches of a session (the session
+        directory for the creation of its DATA and HK directories, and the
+        DATA and HK directories for their files).
+        """
+    fulldirname = os.path.join(path_tests, session)
+    if not os.path.isdir(fulldirname):
+        return
+    watches[inotify.add_watch(fulldirname, flags.CREATE | flags.MOVED_TO)] = (session, None)
+    for dir_key in ('dir_data', 'dir_hk'):
+        dirname = os.path.join(fulldirname, config[dir_key])
+        if os.path.isdir(dirname):
+            mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+            watches[inotify.add_watch(dirname, mask)] = (session, dir_key)
+
+# -----------------------------------------------------------------------
+def wait_for_changes(inotify, watches, path_tests, config, poll_period):
+    r"""
+        This function waits for changes in the sessions directory.
+
+        Returns
+        -------
+        changed: set of strings
+        The names of the sessions which may have changed (None if all the
+        sessions have to be checked, when inotify is not available)
+
+        """
+    if inotify is None:
+        time.sleep(poll_period)
+        return(None)
+    changed = set()
+    for event in inotify.read(timeout=int(poll_period*1000)):
+        if event.wd not in watches:
+            continue
+        session, dir_key = watches[event.wd]
+        if session is None:
+            # new session
+            add_session_watches(inotify, watches, path_tests, event.name, config)
+            changed.add(event.name)
+        elif dir_key is None:
+            # new DATA or HK directory
+            if event.name in (config['dir_data'], config['dir_hk']):
+                add_session_watches(inotify, watches, path_tests, session, config)
+                changed.add(session)
+        else:
+            changed.add(session)
+    return(changed)
+
+# -----------------------------------------------------------------------
+def watch_sessions(path_tests=None, settle_time=5., poll_period=2., max_workers=2, \
+                   process_existing=False, verbose=True):
+    r"""
+        This function watches the sessions directory and processes the new
+        files. It runs until it is interrupted (Ctrl-C).
+
+        Parameters:
+        -----------
+        path_tests: string
+        The name of the directory containing the sessions (default is None,
+        the path_tests value of the configuration file)
+
+        settle_time: number
+        Time (s) during which a file must not change before it is processed
+        (default is 5)
+
+        poll_period: number
+        Period (s) of the checks of the directories (default is 2)
+
+        max_workers: number
+        Maximum number of sessions processed at the same time (default is 2)
+
+        process_existing: boolean
+        If True the files present at start-up are processed, otherwise only
+        the files added later on are processed (default is False)
+
+        verbose: boolean
+        If True the detected files and the started tasks are printed
+
+        Returns
+        -------
+        Nothing
+
+        """
+    config = general_tools.get_csv('demux_tools_cfg.csv')
+    if path_tests is None:
+        path_tests = os.path.normcase(config['path_tests'])
+
+    sessions = session_index.get_sessions(path_tests, config)
+    known = {}          # session -> {(directory key, file name): signature} of the processed files
+    for session in sessions:
+        known[session] = {} if process_existing else snapshot(os.path.join(path_tests, session), config)
+    candidates = {}     # (session, directory key, file name) -> (signature, time of the last change)
+    queued = {}         # session -> names of the stages to be run
+    running = {}        # future -> session
+
+    inotify, watches = init_inotify(path_tests, sessions, config)
+    print("Watching {0:s} ({1:s}), {2:d} sessions found." \
+        .format(path_tests, 'inotify' if inotify is not None else 'polling', len(sessions)))
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        try:
+            to_check = set(sessions) if process_existing else set()
+            while True:
+                # -----------------------------------------------------------
+                # Looking for new or modified files
+                now = time.monotonic()
+                if to_check is None:
+                    to_check = set(session_index.get_sessions(path_tests, config))
+                to_check.update([key[0] for key in candidates.keys()])
+                for session in to_check:
+                    fulldirname = os.path.join(path_tests, session)
+                    if not os.path.isdir(fulldirname):
+                        continue
+                    known.setdefault(session, {})
+                    for (dir_key, name), signature in snapshot(fulldirname, config).items():
+                        if known[session].get((dir_key, name)) == signature:
+                            continue
+                        key = (session, dir_key, name)
+                        if key not in candidates or candidates[key][0] != signature:
+                            # new file or file still being written
+                            candidates[key] = (signature, now)
+                        elif now - candidates[key][1] >= settle_time:
+                            # the file is complete
+                            del candidates[key]
+                            known[session][(dir_key, name)] = signature
+                            stage_names = get_affected_stages(dir_key, name)
+                            if len(stage_names) > 0:
+                                if verbose:
+                                    print("New file {0:s}/{1:s}: {2:s}" \
+                                        .format(session, name, ", ".join(sorted(stage_names))))
+                                queued.setdefault(session, set()).update(stage_names)
+
+                # -----------------------------------------------------------
+                # Collecting the finished tasks
+                for future in [future for future in running.keys() if future.done()]:
+                    session = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as err:
+                        print("Processing of session {0:s} failed: {1}".format(session, err))
+                    else:
+                        if verbose:
+                            print("Processing of session {0:s} done.".format(session))
+
+                # -----------------------------------------------------------
+                # Starting the processing of the sessions (one task per session)
+                for session in sorted(queued.keys()):
+                    if len(running) >= max_workers:
+                        break
+                    if session in running.values():
+                        continue
+                    stage_names = queued.pop(session)
+                    if verbose:
+                        print("Processing session {0:s}: {1:s}".format(session, ", ".join(sorted(stage_names))))
+                    fulldirname = os.path.abspath(os.path.join(path_tests, session))
+                    running[executor.submit(process_session, fulldirname, stage_names)] = session
+
+                to_check = wait_for_changes(inotify, watches, path_tests, config, poll_period)
+        except KeyboardInterrupt:
+            print("Watcher stopped, waiting for the running tasks...")
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+# -----------------------------------------------------------------------
+# The guard is needed because the processing uses pools of processes
+if __name__ == "__main__":
+    watch_sessions()